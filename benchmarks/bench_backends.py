@@ -0,0 +1,119 @@
+"""Accuracy against speed of the inference backends on the sample image.
+
+Every backend runs in a fresh process so that load time and peak RSS belong
+to it alone. The labels of each backend are compared with the TensorFlow
+path: object count, F1 and mean IoU of the objects matched at IoU 0.5
+(stardist.matching), and the relative difference of the total signal.
+Exported backends are skipped until flask/export_model.py has written them.
+
+Usage: python benchmarks/bench_backends.py [--backends tensorflow onnx onnx-int8] [--threads 4] [--repeat 10] [image]
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+from isolated import report, run_child
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+
+SAMPLE_IMAGE = os.path.join(ROOT, 'Sample Images', 'sample 1.jpg')
+BACKENDS = ['tensorflow', 'onnx', 'onnx-int8', 'tflite', 'tflite-int8']
+
+
+def backend_config(backend):
+    from model_registry import DEFAULT_MODEL, load_model_configs
+
+    name, _, precision = backend.partition('-')
+    return dict(load_model_configs()[DEFAULT_MODEL], backend=name, quantize=precision == 'int8')
+
+
+def measure(path, backend, threads, repeat, output):
+    """Runs in the child process, saves the labels to output"""
+    from model_registry import DEFAULT_MODEL, ModelRegistry
+    from pipeline import analyze
+
+    image = cv2.imread(path)
+    start = time.perf_counter()
+    registry = ModelRegistry({DEFAULT_MODEL: backend_config(backend)}, threads=threads)
+    registry.load_all()
+    load_seconds = time.perf_counter() - start
+
+    def predict(blue_channel_norm, **kwargs):
+        return registry.predict(blue_channel_norm, **kwargs)[0]
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        labels, object_table, _, _ = analyze(image, predict)
+        times.append(time.perf_counter() - start)
+    np.savez(output, labels=labels, signal=np.array([row['Signal'] for row in object_table]))
+
+    predict_seconds = registry.status()['models'][DEFAULT_MODEL]['steady_state_seconds']['p50']
+    report({
+        'backend': backend,
+        'load_seconds': round(load_seconds, 3),
+        'predict_seconds': predict_seconds,
+        'analyze_seconds': round(statistics.median(times), 4),
+    })
+
+
+def compare(reference, result):
+    """Object count, F1 and mean IoU at IoU 0.5 and total signal difference against the reference labels"""
+    from stardist.matching import matching
+
+    stats = matching(reference['labels'], result['labels'], thresh=0.5)
+    total = reference['signal'].sum()
+    return {
+        'objects': int(stats.n_pred),
+        'f1': float(stats.f1),
+        'mean_iou': float(stats.mean_matched_score),
+        'signal_diff': float(abs(result['signal'].sum() - total) / total) if total else 0.0,
+    }
+
+
+def main():
+    from inference import export_path
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('image', nargs='?', default=SAMPLE_IMAGE)
+    parser.add_argument('--backends', nargs='+', choices=BACKENDS, default=BACKENDS)
+    parser.add_argument('--threads', type=int, default=0, help='intra-op threads, 0 for the runtime default')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--child', nargs=2, metavar=('BACKEND', 'OUTPUT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure(args.image, args.child[0], args.threads, args.repeat, args.child[1])
+        return
+
+    backends = ['tensorflow'] + [backend for backend in args.backends if backend != 'tensorflow']
+    print(f'{"backend":<12} {"load s":>7} {"predict ms":>10} {"analyze ms":>10} {"peak MB":>8} '
+          f'{"objects":>8} {"F1":>6} {"IoU":>6} {"signal":>7}')
+    with tempfile.TemporaryDirectory() as folder:
+        reference = None
+        for backend in backends:
+            config = backend_config(backend)
+            if config['backend'] != 'tensorflow' and not os.path.exists(export_path(config, config['backend'])):
+                print(f'{backend:<12} not exported, run flask/export_model.py --backend {config["backend"]}'
+                      f'{" --int8" if config["quantize"] else ""}')
+                continue
+            output = os.path.join(folder, f'{backend}.npz')
+            result = run_child(__file__, args.image, '--threads', args.threads, '--repeat', args.repeat,
+                               '--child', backend, output)
+            labels = dict(np.load(output))
+            reference = reference or labels
+            accuracy = compare(reference, labels)
+            print(f'{backend:<12} {result["load_seconds"]:>7.2f} {result["predict_seconds"] * 1000:>10.1f} '
+                  f'{result["analyze_seconds"] * 1000:>10.1f} {result["peak_rss_mb"]:>8.0f} {accuracy["objects"]:>8} '
+                  f'{accuracy["f1"]:>6.3f} {accuracy["mean_iou"]:>6.3f} {accuracy["signal_diff"]:>7.2%}')
+
+
+if __name__ == '__main__':
+    main()
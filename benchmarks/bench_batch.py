@@ -0,0 +1,52 @@
+"""Compare batched and sequential StarDist segmentation throughput on CPU.
+
+Usage: python benchmarks/bench_batch.py [--images 16] [--batch-size 8] [image ...]
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+
+from model_registry import ModelRegistry  # noqa: E402
+from pipeline import prepare_image, preprocess  # noqa: E402
+
+SAMPLE_IMAGE = os.path.join(ROOT, 'Sample Images', 'sample 1.jpg')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('paths', nargs='*', default=[SAMPLE_IMAGE])
+    parser.add_argument('--images', type=int, default=16, help='number of images per run')
+    parser.add_argument('--batch-size', type=int, default=8)
+    args = parser.parse_args()
+
+    inputs = []
+    for i in range(args.images):
+        image = prepare_image(cv2.imread(args.paths[i % len(args.paths)]))
+        inputs.append(preprocess(image)[1])
+
+    registry = ModelRegistry()
+    registry.load_all()
+
+    start = time.perf_counter()
+    for image in inputs:
+        registry.predict(image)
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    registry.predict_batch(inputs, batch_size=args.batch_size)
+    batched = time.perf_counter() - start
+
+    print(f'images:      {len(inputs)}')
+    print(f'sequential:  {sequential:.2f} s  {len(inputs) / sequential:.2f} images/s')
+    print(f'batched:     {batched:.2f} s  {len(inputs) / batched:.2f} images/s  (batch size {args.batch_size})')
+    print(f'speedup:     {sequential / batched:.2f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Speed and well count of the app's on-device analysis.
+
+Runs offline.analyze, the path the app takes without a server, on the sample
+image and on synthetic plates with a known number of wells. Only the app's
+own dependencies (numpy, scipy, Pillow) are needed. Exits with status 1
+when a plate takes longer than --budget seconds or a synthetic plate does
+not come back with every well; desktops are several times faster than a
+mid-range phone, so keep the budget well below the one second target.
+
+Usage: python benchmarks/bench_offline.py [--repeat 5] [--budget 0.25]
+"""
+import argparse
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import offline  # noqa: E402
+
+SAMPLE_IMAGE = os.path.join(ROOT, 'Sample Images', 'sample 1.jpg')
+
+# name, width, height, well rows, well columns
+CASES = [
+    ('plate-640x480-12', 640, 480, 3, 4),
+    ('plate-800x1066-24', 800, 1066, 4, 6),
+    ('plate-4000x3000-96', 4000, 3000, 8, 12),
+]
+
+
+def synthetic_plate(width, height, rows, cols, seed=0):
+    """JPEG bytes of a dark plate with a grid of blurred luminescent wells of random brightness"""
+    rng = np.random.default_rng(seed)
+    image = Image.new('RGB', (width, height), (8, 8, 15))
+    draw = ImageDraw.Draw(image)
+    radius = int(0.35 * min(width / cols, height / rows))
+    for row in range(rows):
+        for col in range(cols):
+            x, y = int((col + 0.5) * width / cols), int((row + 0.5) * height / rows)
+            brightness = int(rng.integers(60, 255))
+            draw.ellipse((x - radius, y - radius, x + radius, y + radius),
+                         fill=(int(brightness * 0.4), int(brightness * 0.8), brightness))
+    image = image.filter(ImageFilter.GaussianBlur(max(radius / 8, 1)))
+    noisy = np.clip(np.asarray(image) + rng.normal(0, 4, (height, width, 3)), 0, 255).astype(np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(noisy).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget', type=float, default=0.25, help='seconds per plate on this machine')
+    args = parser.parse_args()
+
+    failed = False
+    print(f'{"image":<22} {"wells":>6} {"found":>6} {"median ms":>10} {"max ms":>8}')
+    with tempfile.TemporaryDirectory() as folder:
+        images = [('sample 1.jpg', SAMPLE_IMAGE, None)]
+        for name, width, height, rows, cols in CASES:
+            path = os.path.join(folder, name + '.jpg')
+            with open(path, 'wb') as f:
+                f.write(synthetic_plate(width, height, rows, cols))
+            images.append((name, path, rows * cols))
+
+        for name, path, wells in images:
+            times = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                result, _ = offline.analyze(path, folder)
+                times.append(time.perf_counter() - start)
+            found = len(result['object_table']['Object'])
+            median = statistics.median(times)
+            ok = median <= args.budget and (wells is None or found == wells)
+            failed = failed or not ok
+            print(f'{name:<22} {wells or "-":>6} {found:>6} {median * 1000:>10.1f} {max(times) * 1000:>8.1f}'
+                  f'{"" if ok else "  FAIL"}')
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""Stage-by-stage benchmark and regression check of the segmentation pipeline.
+
+Times every stage of the pipeline (decode, resize, grayscale/contrast,
+normalize, predict, measurement, annotation, encode) on synthetic plates of
+different sizes and well counts. Wall time and CPU time are the median of
+--repeat runs; peak memory comes from one extra run under tracemalloc, which
+sees Python and numpy allocations but not TensorFlow's own buffers.
+
+Each run is appended to a JSON history, benchmarks/history.json unless
+--history says otherwise; git ignores it as its timings belong to one
+machine. A stage fails the run when its wall time is more than --threshold
+above the median of the last runs in the history. A golden check on
+'Sample Images/sample 1.jpg' guards the numbers: the object tables must
+match the stored golden output, and the vectorized measurement must match
+the original per-pixel regionprops loop. The golden file holds the table of
+the model's segmentation and, independent of the model and its runtime, the
+table of wells found with an Otsu threshold, which covers decoding,
+resizing, contrast stretch and measurement. A missing golden file or
+section fails the check.
+
+Usage: python benchmarks/bench_pipeline.py [--repeat 3] [--threshold 0.25] [--update-golden]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+
+from model_registry import ModelRegistry  # noqa: E402
+from pipeline import (STAGES, analyze, build_object_table, decode_image, enhance, measure_objects,  # noqa: E402
+                      prepare_image)
+
+SAMPLE_IMAGE = os.path.join(ROOT, 'Sample Images', 'sample 1.jpg')
+HISTORY = os.path.join(ROOT, 'benchmarks', 'history.json')
+GOLDEN = os.path.join(ROOT, 'benchmarks', 'golden', 'sample_1.json')
+
+# name, width, height, well rows, well columns, full resolution
+CASES = [
+    ('plate-640x480-12', 640, 480, 3, 4, False),
+    ('plate-800x1066-24', 800, 1066, 4, 6, False),
+    ('plate-3000x2000-96', 3000, 2000, 8, 12, False),
+    ('plate-3000x2000-96-full', 3000, 2000, 8, 12, True),
+]
+
+# Stage regressions smaller than this are noise whatever the relative change
+MIN_REGRESSION_SECONDS = 0.005
+# Relative tolerance of the golden tables, JPEG decoders differ by a grey level here and there
+GOLDEN_RTOL = 1e-3
+
+
+def synthetic_plate(width, height, rows, cols, seed=0):
+    """JPEG bytes of a dark plate with a grid of blurred luminescent wells"""
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 15, np.uint8)
+    radius = int(0.35 * min(width / cols, height / rows))
+    for row in range(rows):
+        for col in range(cols):
+            center = (int((col + 0.5) * width / cols), int((row + 0.5) * height / rows))
+            brightness = int(rng.integers(60, 255))
+            cv2.circle(image, center, radius, (brightness, int(brightness * 0.8), int(brightness * 0.4)), -1)
+    image = cv2.GaussianBlur(image, (0, 0), max(radius / 8, 1))
+    noise = rng.normal(0, 4, image.shape)
+    image = np.clip(image + noise, 0, 255).astype(np.uint8)
+    return cv2.imencode('.jpg', image)[1].tobytes()
+
+
+class StageRecorder:
+    """Timer for pipeline.analyze that records wall time, CPU time and traced peak memory per stage"""
+
+    def __init__(self, track_memory=False):
+        self.track_memory = track_memory
+        self.stages = {}
+
+    @contextmanager
+    def __call__(self, stage):
+        if self.track_memory:
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        start_wall, start_cpu = time.perf_counter(), time.process_time()
+        yield
+        record = {'wall': time.perf_counter() - start_wall, 'cpu': time.process_time() - start_cpu}
+        if self.track_memory:
+            record['peak_mb'] = (tracemalloc.get_traced_memory()[1] - start_memory) / 2 ** 20
+        self.stages[stage] = record
+
+
+def run_pipeline(registry, data, full_resolution=False, track_memory=False):
+    recorder = StageRecorder(track_memory)
+    with recorder('decode'):
+        image = decode_image(data)
+    labels, object_table, _, _ = analyze(image, lambda x, **kwargs: registry.predict(x, **kwargs)[0],
+                                      full_resolution=full_resolution, timer=recorder)
+    return recorder.stages, labels, object_table
+
+
+def benchmark_case(registry, data, full_resolution, repeat):
+    run_pipeline(registry, data, full_resolution)  # warm-up
+
+    runs = []
+    for _ in range(repeat):
+        stages, _, object_table = run_pipeline(registry, data, full_resolution)
+        runs.append(stages)
+
+    tracemalloc.start()
+    try:
+        memory, _, _ = run_pipeline(registry, data, full_resolution, track_memory=True)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'objects': len(object_table),
+        'stages': {
+            stage: {
+                'wall': statistics.median(run[stage]['wall'] for run in runs),
+                'cpu': statistics.median(run[stage]['cpu'] for run in runs),
+                'peak_mb': memory[stage]['peak_mb'],
+            }
+            for stage in STAGES
+        },
+    }
+
+
+def find_regressions(history, results, threshold, baseline_runs):
+    """Stages slower than threshold over the median of the previous runs"""
+    regressions = []
+    for case, result in results.items():
+        for stage, timing in result['stages'].items():
+            previous = [run['cases'][case]['stages'][stage]['wall'] for run in history[-baseline_runs:]
+                        if case in run['cases'] and stage in run['cases'][case]['stages']]
+            if not previous:
+                continue
+            baseline = statistics.median(previous)
+            if timing['wall'] > baseline * (1 + threshold) and timing['wall'] - baseline > MIN_REGRESSION_SECONDS:
+                regressions.append(f'{case} {stage}: {timing["wall"]:.4f} s vs baseline {baseline:.4f} s')
+    return regressions
+
+
+def reference_object_table(labels, blue_channel):
+    """The original per-object regionprops loop, kept as the reference for the vectorized measurement"""
+    import pandas as pd
+    from skimage.measure import regionprops
+
+    object_table = pd.DataFrame(columns=['Object', 'Area'])
+    for i, prop in enumerate(regionprops(labels)):
+        intensity_sum = 0
+        for coord in prop.coords:
+            intensity_sum += int(blue_channel[coord[0], coord[1]])
+        new_data = pd.DataFrame({'Object': [i + 1], 'Area': [prop.area], 'Signal': [intensity_sum]})
+        object_table = pd.concat([object_table, new_data], ignore_index=True)
+
+    max_area = object_table['Area'].max()
+    object_table['Signal/Unit_Area'] = object_table['Signal'] / max_area
+    object_table['Signal'] = object_table['Signal'] / max_area
+    max_obj = object_table['Signal/Unit_Area'].max()
+    for i in range(len(object_table)):
+        object_table.at[i, 'Signal/Unit_Area'] = (((max_obj) - (object_table.at[i, 'Signal/Unit_Area'])) / (max_obj))*100
+    object_table = object_table.sort_values(by='Signal/Unit_Area', ascending=True)
+    return object_table[object_table['Signal/Unit_Area'] >= 0]
+
+
+def tables_match(expected, actual, rtol=1e-6):
+    if len(expected) != len(actual):
+        return False
+    # Rows with equal relative change may come in either order
+    expected = sorted(expected, key=lambda row: row['Object'])
+    actual = sorted(actual, key=lambda row: row['Object'])
+    for expected_row, actual_row in zip(expected, actual):
+        for column in ('Object', 'Area', 'Signal', 'Signal/Unit_Area'):
+            if not np.isclose(float(expected_row[column]), float(actual_row[column]), rtol=rtol, atol=1e-9):
+                return False
+    return True
+
+
+def threshold_labels(intensity):
+    """Wells of an enhanced image from an Otsu threshold, a model-free stand-in for the segmentation"""
+    smooth = cv2.GaussianBlur(intensity, (5, 5), 0)
+    _, mask = cv2.threshold(smooth, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    return cv2.connectedComponents(mask, connectivity=4, ltype=cv2.CV_32S)[1]
+
+
+def golden_check(registry, update):
+    """Return a list of failures of the golden output and reference measurement checks"""
+    with open(SAMPLE_IMAGE, 'rb') as f:
+        data = f.read()
+    _, labels, object_table = run_pipeline(registry, data)
+
+    failures = []
+    blue_channel = enhance(prepare_image(decode_image(data)))
+    reference = reference_object_table(labels, blue_channel).to_dict(orient='records')
+    vectorized = build_object_table(measure_objects(labels, blue_channel)).to_dict(orient='records')
+    if not tables_match(reference, vectorized, rtol=1e-9):
+        failures.append('vectorized measurement differs from the regionprops loop on the sample image')
+
+    threshold_table = build_object_table(measure_objects(threshold_labels(blue_channel), blue_channel))
+    outputs = {'threshold': threshold_table.to_dict(orient='records'), 'model': object_table}
+    if update:
+        os.makedirs(os.path.dirname(GOLDEN), exist_ok=True)
+        with open(GOLDEN, 'w') as f:
+            json.dump({name: {'objects': len(table), 'object_table': table} for name, table in outputs.items()},
+                      f, indent=1)
+        print(f'golden output written to {GOLDEN}')
+        return failures
+    if not os.path.exists(GOLDEN):
+        return failures + [f'no golden output at {GOLDEN}, create it with --update-golden']
+
+    with open(GOLDEN) as f:
+        golden = json.load(f)
+    for name, table in outputs.items():
+        if name not in golden:
+            failures.append(f'{GOLDEN} has no {name} output, add it with --update-golden')
+        elif not tables_match(golden[name]['object_table'], table, rtol=GOLDEN_RTOL):
+            failures.append(f'{name} object table of the sample image differs from {GOLDEN}')
+    return failures
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed relative slowdown per stage')
+    parser.add_argument('--baseline-runs', type=int, default=5, help='history runs the baseline is taken from')
+    parser.add_argument('--history', default=HISTORY)
+    parser.add_argument('--no-record', action='store_true', help='do not append this run to the history')
+    parser.add_argument('--cases', nargs='+', help='only run these cases')
+    parser.add_argument('--update-golden', action='store_true')
+    args = parser.parse_args()
+
+    registry = ModelRegistry()
+    registry.load_all()
+
+    results = {}
+    for name, width, height, rows, cols, full_resolution in CASES:
+        if args.cases and name not in args.cases:
+            continue
+        results[name] = benchmark_case(registry, synthetic_plate(width, height, rows, cols), full_resolution,
+                                       args.repeat)
+
+        print(f'\n{name} ({results[name]["objects"]} objects)')
+        print(f'  {"stage":<10} {"wall s":>9} {"cpu s":>9} {"peak MB":>9}')
+        for stage, timing in results[name]['stages'].items():
+            print(f'  {stage:<10} {timing["wall"]:>9.4f} {timing["cpu"]:>9.4f} {timing["peak_mb"]:>9.1f}')
+
+    history = []
+    if os.path.exists(args.history):
+        with open(args.history) as f:
+            history = json.load(f)
+    failures = find_regressions(history, results, args.threshold, args.baseline_runs)
+    failures += golden_check(registry, args.update_golden)
+
+    if not args.no_record:
+        history.append({
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'cases': results,
+        })
+        with open(args.history, 'w') as f:
+            json.dump(history, f, indent=1)
+
+    if failures:
+        print('\nFAIL')
+        for failure in failures:
+            print(f'  {failure}')
+        sys.exit(1)
+    print('\nOK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""Compare payload size and client parse time of the JSON, msgpack and Arrow result formats.
+
+Results of synthetic plates are encoded the way the server answers them. The
+JSON parse time includes building the DataFrame row by row as the app did,
+the compact formats are timed up to the table as a DataFrame and, separately,
+with the label mask decoded as well. msgpack and pyarrow are optional, a
+format whose library is missing is skipped.
+
+Usage: python benchmarks/bench_response_format.py [--repeat 20]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import cv2
+import numpy as np
+import pandas as pd
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+
+import response_format  # noqa: E402
+from pipeline import build_object_table, measure_objects  # noqa: E402
+
+# name, label image width, height, well rows, well columns
+CASES = [
+    ('12 wells 800x600', 800, 600, 3, 4),
+    ('96 wells 800x533', 800, 533, 8, 12),
+    ('384 wells 800x533', 800, 533, 16, 24),
+    ('384 wells 3000x2000', 3000, 2000, 16, 24),
+]
+
+
+def synthetic_result(width, height, rows, cols, seed=0):
+    """Label image of a well grid and its object table records"""
+    rng = np.random.default_rng(seed)
+    labels = np.zeros((height, width), np.int32)
+    radius = int(0.4 * min(width / cols, height / rows))
+    for row in range(rows):
+        for col in range(cols):
+            center = (int((col + 0.5) * width / cols), int((row + 0.5) * height / rows))
+            cv2.circle(labels, center, radius, row * cols + col + 1, -1)
+    intensity = rng.integers(0, 255, labels.shape).astype(np.uint8)
+    records = build_object_table(measure_objects(labels, intensity)).to_dict(orient='records')
+    payload = {'message': 'Image processed successfully', 'processed_image_url': '/processed_image/x.jpg',
+               'object_table': records, 'cached': False}
+    return payload, labels
+
+
+def parse_json(data, with_labels):
+    payload = json.loads(data)
+    object_data = {}
+    for row in payload['object_table']:
+        object_data[row['Object']] = round(row['Signal'], 2)
+    return pd.DataFrame(list(object_data.items()), columns=['Object', 'Relative Change'])
+
+
+def parse_msgpack(data, with_labels):
+    payload = response_format.decode_msgpack(data)
+    table = payload['object_table']
+    frame = pd.DataFrame({'Object': table['Object'], 'Relative Change': np.round(table['Signal'], 2)})
+    if with_labels:
+        response_format.rle_decode(payload['labels'])
+    return frame
+
+
+def parse_arrow(data, with_labels):
+    import pyarrow as pa
+
+    table = pa.ipc.open_stream(data).read_all()
+    frame = pd.DataFrame({'Object': table.column('Object').to_numpy(),
+                          'Relative Change': np.round(table.column('Signal').to_numpy(), 2)})
+    if with_labels:
+        metadata = table.schema.metadata
+        spec = json.loads(metadata[b'labels'])
+        response_format.rle_decode({'shape': spec['shape'],
+                                    'values': np.frombuffer(metadata[b'labels.values'], spec['values']),
+                                    'lengths': np.frombuffer(metadata[b'labels.lengths'], spec['lengths'])})
+    return frame
+
+
+def median_ms(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return statistics.median(times) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    # name, encode(payload, labels), parse(data, with_labels), whether the payload has the mask
+    formats = [('json', lambda payload, labels: json.dumps(payload).encode(), parse_json, False)]
+    available = response_format.available_formats()
+    for mimetype, name, encode, parse in [
+            (response_format.MSGPACK, 'msgpack', response_format.encode_msgpack, parse_msgpack),
+            (response_format.ARROW, 'arrow', response_format.encode_arrow, parse_arrow)]:
+        if mimetype in available:
+            formats.append((f'{name} table only', lambda payload, labels, encode=encode: encode(
+                response_format.compact(payload)), parse, False))
+            formats.append((f'{name} with mask', lambda payload, labels, encode=encode: encode(
+                response_format.compact(payload, labels)), parse, True))
+
+    for name, width, height, rows, cols in CASES:
+        payload, labels = synthetic_result(width, height, rows, cols)
+        print(f'\n{name} (raw label mask {labels.nbytes / 1024:.0f} KB, JSON has no mask)')
+        print(f'  {"format":<22} {"bytes":>10} {"encode ms":>10} {"table ms":>9} {"+mask ms":>9}')
+        for format_name, encode, parse, has_mask in formats:
+            data = encode(payload, labels)
+            encode_ms = median_ms(lambda: encode(payload, labels), args.repeat)
+            table_ms = median_ms(lambda: parse(data, False), args.repeat)
+            mask = f'{median_ms(lambda: parse(data, True), args.repeat):>9.3f}' if has_mask else f'{"-":>9}'
+            print(f'  {format_name:<22} {len(data):>10} {encode_ms:>10.3f} {table_ms:>9.3f} {mask}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Peak memory and latency of working and full resolution analysis against image size.
+
+Every measurement runs in a fresh process so that peak RSS belongs to one
+image size and mode only.
+
+Usage: python benchmarks/bench_tiling.py [--megapixels 1 4 12 24] [--tile-size 1024] [image]
+"""
+import argparse
+import os
+import sys
+import time
+
+import cv2
+
+from isolated import peak_rss_mb, report, run_child
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+
+SAMPLE_IMAGE = os.path.join(ROOT, 'Sample Images', 'sample 1.jpg')
+
+
+def measure(path, megapixels, mode, tile_size):
+    """Runs in the child process"""
+    from model_registry import ModelRegistry
+    from pipeline import analyze
+
+    image = cv2.imread(path)
+    factor = (megapixels * 1e6 / (image.shape[0] * image.shape[1])) ** 0.5
+    image = cv2.resize(image, (int(image.shape[1] * factor), int(image.shape[0] * factor)),
+                       interpolation=cv2.INTER_CUBIC)
+
+    registry = ModelRegistry()
+    registry.load_all()
+    model_rss = peak_rss_mb()
+
+    def predict(blue_channel_norm, **kwargs):
+        return registry.predict(blue_channel_norm, **kwargs)[0]
+
+    start = time.perf_counter()
+    labels, object_table, _, _ = analyze(image, predict, full_resolution=mode == 'full', tile_size=tile_size)
+    elapsed = time.perf_counter() - start
+
+    report({
+        'megapixels': megapixels,
+        'mode': mode,
+        'shape': list(labels.shape),
+        'objects': len(object_table),
+        'seconds': round(elapsed, 3),
+        'model_rss_mb': model_rss,
+    })
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('image', nargs='?', default=SAMPLE_IMAGE)
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[1, 4, 12, 24])
+    parser.add_argument('--modes', nargs='+', choices=['working', 'full'], default=['working', 'full'])
+    parser.add_argument('--tile-size', type=int, default=1024)
+    parser.add_argument('--child', nargs=2, metavar=('MEGAPIXELS', 'MODE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        measure(args.image, float(args.child[0]), args.child[1], args.tile_size)
+        return
+
+    print(f'{"MP":>5} {"mode":>8} {"labels shape":>14} {"objects":>8} {"seconds":>8} {"peak MB":>8} {"model MB":>9}')
+    for megapixels in args.megapixels:
+        for mode in args.modes:
+            result = run_child(__file__, args.image, '--tile-size', args.tile_size, '--child', megapixels, mode)
+            shape = 'x'.join(str(size) for size in result['shape'])
+            print(f'{megapixels:>5g} {mode:>8} {shape:>14} {result["objects"]:>8} {result["seconds"]:>8.2f} '
+                  f'{result["peak_rss_mb"]:>8.0f} {result["model_rss_mb"]:>9.0f}')
+
+
+if __name__ == '__main__':
+    main()
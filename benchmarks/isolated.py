@@ -0,0 +1,28 @@
+"""Measurements in a fresh process, so that peak RSS belongs to one measurement only.
+
+A benchmark re-runs its own script with --child and the arguments of one
+measurement. The child prints its result with report, the parent reads it
+back from run_child.
+"""
+import json
+import resource
+import subprocess
+import sys
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process so far"""
+    # ru_maxrss is in kilobytes on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def report(result):
+    """Print the child's result as one JSON line, with its peak RSS"""
+    print(json.dumps(dict(result, peak_rss_mb=peak_rss_mb())))
+
+
+def run_child(script, *args):
+    """Run script with args in a new interpreter and return the result it reported"""
+    output = subprocess.run([sys.executable, script, *(str(arg) for arg in args)],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
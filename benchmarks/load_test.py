@@ -0,0 +1,81 @@
+"""Load test the job API and report latency percentiles and throughput.
+
+Every client submits an image to /jobs, polls the status until the job is
+done and fetches the result, backing off when the server answers 429.
+
+Usage: python benchmarks/load_test.py http://localhost:5000 [--clients 1 4 16] [--requests 8]
+"""
+import argparse
+import os
+import threading
+import time
+
+import numpy as np
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_IMAGE = os.path.join(ROOT, 'Sample Images', 'sample 1.jpg')
+
+
+def run_client(base_url, data, n_requests, endpoint, poll_interval, latencies, rejected):
+    session = requests.Session()
+    for _ in range(n_requests):
+        # Trailing bytes after the end of the JPEG are ignored by the decoder but
+        # change the content hash, so every request misses the result cache
+        payload = data + os.urandom(16)
+        start = time.perf_counter()
+        while True:
+            if endpoint == 'process_image':
+                response = session.post(f'{base_url}/process_image', files={'file': ('plate.jpg', payload)})
+                response.raise_for_status()
+                break
+
+            response = session.post(f'{base_url}/jobs', files={'file': ('plate.jpg', payload)})
+            if response.status_code == 429:
+                rejected.append(1)
+                time.sleep(float(response.headers.get('Retry-After', 1)))
+                continue
+            response.raise_for_status()
+            job = response.json()
+            while session.get(base_url + job['status_url']).json()['status'] in ('queued', 'running'):
+                time.sleep(poll_interval)
+            session.get(base_url + job['result_url']).raise_for_status()
+            break
+        latencies.append(time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('url', help='server base URL')
+    parser.add_argument('--image', default=SAMPLE_IMAGE)
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--requests', type=int, default=8, help='requests per client')
+    parser.add_argument('--endpoint', choices=['jobs', 'process_image'], default='jobs')
+    parser.add_argument('--poll-interval', type=float, default=0.1)
+    args = parser.parse_args()
+
+    with open(args.image, 'rb') as f:
+        data = f.read()
+    base_url = args.url.rstrip('/')
+
+    print(f'{"clients":>7} {"requests":>8} {"p50 s":>8} {"p95 s":>8} {"img/s":>8} {"429s":>6}')
+    for n_clients in args.clients:
+        latencies, rejected = [], []
+        threads = [threading.Thread(target=run_client,
+                                    args=(base_url, data, args.requests, args.endpoint, args.poll_interval,
+                                          latencies, rejected))
+                   for _ in range(n_clients)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        p50, p95 = np.percentile(latencies, [50, 95])
+        print(f'{n_clients:>7} {len(latencies):>8} {p50:>8.2f} {p95:>8.2f} {len(latencies) / elapsed:>8.2f} '
+              f'{len(rejected):>6}')
+
+
+if __name__ == '__main__':
+    main()
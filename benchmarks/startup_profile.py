@@ -0,0 +1,81 @@
+"""Profile the server's cold start and check it against a budget.
+
+Reports how long importing flask/app.py takes, broken down with python
+-X importtime by the top-level package of every module app imports
+directly, and how long the models then take to load and warm up. Exits
+with status 1 when the import time is over budget; tests/test_startup.py
+enforces the same budget.
+
+Usage: python benchmarks/startup_profile.py [--budget 2.0] [--top 15] [--skip-models]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FLASK_DIR = os.path.join(ROOT, 'flask')
+
+# Seconds to start an interpreter and import the app, models excluded
+IMPORT_BUDGET = 2.0
+
+
+def profile_imports():
+    """Import the app in a fresh interpreter, return wall time and per package cumulative seconds"""
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=FLASK_DIR,
+                            capture_output=True, text=True, check=True)
+    wall = time.perf_counter() - start
+
+    # importtime lists a module after its imports, indented two spaces per level. The
+    # direct imports of app are the modules one level deep before the 'app' line
+    packages = defaultdict(float)
+    children = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip(' ')) - 1) // 2
+        if depth == 1:
+            children.append((name.strip(), int(cumulative)))
+        elif depth == 0:
+            if name.strip() == 'app':
+                for child, microseconds in children:
+                    packages[child.split('.')[0]] += microseconds / 1e6
+            children = []
+    return wall, packages
+
+
+def time_model_start():
+    code = ('import time; start = time.perf_counter(); import app; '
+            'app.registry.load_all(); print(time.perf_counter() - start)')
+    result = subprocess.run([sys.executable, '-c', code], cwd=FLASK_DIR, capture_output=True, text=True,
+                            check=True)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--budget', type=float, default=IMPORT_BUDGET, help='import time budget in seconds')
+    parser.add_argument('--top', type=int, default=15)
+    parser.add_argument('--skip-models', action='store_true', help='only profile the imports')
+    args = parser.parse_args()
+
+    wall, packages = profile_imports()
+    print(f'{"package":<24} {"seconds":>8}')
+    for name, seconds in sorted(packages.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'{name:<24} {seconds:>8.3f}')
+    print(f'\nimport app (wall, including interpreter start): {wall:.3f} s, budget {args.budget:.3f} s')
+
+    if not args.skip_models:
+        print(f'import app and load/warm up models: {time_model_start():.3f} s')
+
+    if wall > args.budget:
+        print('FAIL: import time is over budget')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
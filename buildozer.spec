@@ -37,7 +37,7 @@ version = 0.1
 
 # (list) Application requirements
 # comma separated e.g. requirements = sqlite3,kivy
-requirements = python3,kivy,kivymd,requests,scipy,pandas,numpy,android,plyer
+requirements = python3,kivy,kivymd,requests,scipy,pandas,numpy,android,plyer,pillow,msgpack
 
 # (str) Custom source folders for requirements
 # Sets custom source for any requirements with recipes
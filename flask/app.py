@@ -1,183 +1,722 @@
-
-import cv2
-#from matplotlib import pyplot as plt
-from networkx import selfloop_edges
-from stardist.models import StarDist2D
-from csbdeep.utils import normalize
-from skimage.measure import regionprops
-import pandas as pd
-import numpy as np
-from flask import Flask, app, request, jsonify, send_file, url_for, abort
-from werkzeug.utils import secure_filename
-import os
-#from flask import send_file, abort
-
-app = Flask(__name__)
-
-# Define main directory and create folders
-main_directory = os.path.dirname(os.path.abspath(__file__))
-upload_folder = os.path.join(main_directory, 'uploads')
-temp_folder = os.path.join(main_directory, 'temp')
-
-for folder in [upload_folder, temp_folder]:
-    if not os.path.exists(folder):
-        os.makedirs(folder)
-
-app.config['uploads'] = upload_folder
-app.config['TEMP_FOLDER'] = temp_folder
-app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif'}
-object_table_data = None
-
-@app.route('/process_image', methods=['POST'])
-def process_image():
-    if 'file' not in request.files:
-        return jsonify({'error': 'No file part', 'message': 'Please upload a file.'})
-
-    selected_file = request.files['file']
-
-    if selected_file.filename == '':
-        return jsonify({'error': 'No selected file', 'message': 'Please select a file.'})
-
-    if selected_file:
-        filename = secure_filename(selected_file.filename)
-        image_path = os.path.join(upload_folder, filename)
-        selected_file.save(image_path)
-
-        # Load the image
-        image = cv2.imread(image_path)
-
-        # Rotate the image if it is in landscape mode
-        if image.shape[1] < 200:
-            image = cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
-
-        def image_resize(image, width = None, height = None, inter = cv2.INTER_AREA):
-            # initialize the dimensions of the image to be resized and grab the image size
-            dim = None
-            (h, w) = image.shape[:2]
-
-            # if both the width and height are None, then return the original image
-            if width is None and height is None:
-                return image
-
-            # check to see if the width is None
-            if width is None:
-                # calculate the ratio of the height and construct the
-                # dimensions
-                r = height / float(h)
-                dim = (int(w * r), height)
-
-            # otherwise, the height is None
-            else:
-                # calculate the ratio of the width and construct the dimensions
-                r = width / float(w)
-                dim = (width, int(h * r))
-
-            # resize the image
-            resized = cv2.resize(image, dim, interpolation = inter)
-
-            # return the resized image
-            return resized
-
-        if image.shape[0] > 1000 or image.shape[1] > 1000:
-            image = image_resize(image, width=800, height=800)
-        else:
-            pass
-        
-        # Convert image to 16-bit grayscale
-        image1 = image
-        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        #manual Operation
-        brightness = 1.5
-        # Adjusts the contrast by scaling the pixel values
-        contrast = 2 
-        image = cv2.addWeighted(image, contrast, np.zeros(image.shape, image.dtype), 0, brightness) 
-        #image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        # Normalize the blue channel
-        blue_channel=image
-        blue_channel_norm = normalize(blue_channel, 1, 99.8, axis=None)
-
-        # Load the AI model
-        model = StarDist2D.from_pretrained('Versatile (fluorescent nuclei)')
-
-        # Predict objects
-        labels, _ = model.predict_instances(blue_channel_norm,nms_thresh=0.01, prob_thresh=0.67)
-
-        # Get properties of labeled objects
-        props = regionprops(labels)
-
-        # Create data table to store object properties
-        object_table = pd.DataFrame(columns=['Object', 'Area'])
-
-        # Draw boundry around objects and label with numbers
-        for i, prop in enumerate(props):
-            y1, x1, y2, x2 = prop.bbox
-            x_center = int((x1 + x2) / 2)
-            y_center = int((y1 + y2) / 2)
-            radius = int((x2 - x1 + y2 - y1) / 4)
-            cv2.circle(image1, (x_center, y_center), radius, (255, 255, 255), 3)
-            font_scale = radius / 30  # Adjust the divisor to control the font size
-            thickness = int(radius / 8)  # Adjust the divisor to control the thickness of the text
-
-            cv2.putText(image1, str(i+1), (x_center-10, y_center+10), cv2.FONT_HERSHEY_SIMPLEX, font_scale, (0, 255, 255), thickness)
-            # Calculate mean Signal and area of objects and store in data table
-            label = i + 1
-            intensity_sum = 0
-            pixel_count = 0
-            for coord in prop.coords:
-                intensity_sum += blue_channel[coord[0], coord[1]]
-                pixel_count += 1
-            mean_intensity = intensity_sum
-            area = prop.area
-            new_data = pd.DataFrame({'Object': [label],'Area': [area],'Signal': [mean_intensity]})
-            object_table = pd.concat([object_table, new_data], ignore_index=True)
-
-        # Calculate difference in Signal for each object
-        max_area = object_table['Area'].max()
-        object_table['Signal/Unit_Area'] = object_table['Signal'] / max_area
-        object_table['Signal'] = object_table['Signal'] / max_area
-        max_obj = object_table['Signal/Unit_Area'].max()
-        for i in range(len(object_table)):
-            #object_table.at[i, 'Relative Difference'] = ((max_composite_metric - object_table.at[i, 'Signal'])/max_composite_metric)*100
-            object_table.at[i, 'Signal/Unit_Area'] = (((max_obj) - (object_table.at[i, 'Signal/Unit_Area'])) / (max_obj))*100
-
-        # Sort the table by Relative Percentage Change in ascending order
-        object_table = object_table.sort_values(by='Signal/Unit_Area', ascending=True)
-        
-        #if want to include 0% change objects(as somtimes there are no objects with change)
-        new_object_table = object_table[object_table['Signal/Unit_Area'] >= 0]
-
-        # Set the new_object_table attribute
-        object_table = new_object_table
-
-        # Create a white canvas to overlay labels
-        processed_image = image1.copy()
-
-        # Save the processed image
-        output_image_path = image_path.replace('.', '_processed.')  # Save with a different name
-        cv2.imwrite(output_image_path, processed_image)
-
-        # Construct the response
-        processed_image_url = url_for('get_processed_image', filename=os.path.basename(output_image_path))
-        print(processed_image_url)
-        print(object_table.to_dict(orient='records'))
-        
-        response = {
-            'message': 'Image processed successfully',
-            'processed_image_url': processed_image_url,
-            'object_table': object_table.to_dict(orient='records')
-        }
-
-        return jsonify(response)
-    else:
-        return jsonify({'error': 'No Image Uploaded', 'message': 'Please upload an image before processing.'})
-    
-@app.route('/processed_image/<filename>', methods=['GET'])
-def get_processed_image(filename):
-    processed_image_path = os.path.join(app.config['uploads'], filename)
-    if os.path.exists(processed_image_path):
-        return send_file(processed_image_path, mimetype='image/jpeg')
-    else:
-        abort(404, description='Image not found')
-
-if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
+
+#from matplotlib import pyplot as plt
+from flask import Flask, app, request, jsonify, send_file, url_for, abort, g, Response, stream_with_context
+import base64
+import io
+import json
+import logging
+from werkzeug.utils import secure_filename
+import os
+import threading
+import time
+import uuid
+from model_registry import ModelNotReady, ModelRegistry, load_model_configs
+import calibration
+import overlay
+import response_format
+from image_store import ImageStore
+from jobs import JobQueue, QueueFull, WorkersUnavailable
+from metrics import COUNT_BUCKETS, SIZE_BUCKETS, Metrics, SampleFilter, StageTimer
+from result_cache import ResultCache
+from storage import FileStore
+from timelapse import DRIFT_THRESHOLD, TimelapseTracker, read_images, read_video
+from pipeline import MAX_DIMENSION, TARGET_WIDTH, ImageTooLarge, decode_image, enhance, model_options, normalize_image, prepare_image, preprocessing_params, quantify, analyze
+from plate_template import AlignmentError, PlateTemplate, TemplateStore, analyze_with_template
+#from flask import send_file, abort
+
+app = Flask(__name__)
+
+# Define main directory and create folders
+main_directory = os.path.dirname(os.path.abspath(__file__))
+upload_folder = os.path.join(main_directory, 'uploads')
+temp_folder = os.path.join(main_directory, 'temp')
+
+for folder in [upload_folder, temp_folder]:
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+app.config['uploads'] = upload_folder
+app.config['TEMP_FOLDER'] = temp_folder
+app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif'}
+object_table_data = None
+
+# Load the AI models once per worker and keep them warm
+app.config['MODEL_LOAD_TIMEOUT'] = 300
+registry = ModelRegistry(load_model_configs())
+
+app.config['BATCH_SIZE'] = 8
+
+# Processed images and their previews are kept in memory, writing uploads to disk is opt-in
+app.config['ARCHIVE_UPLOADS'] = os.environ.get('SCENTINEL_ARCHIVE_UPLOADS', '0') == '1'
+processed_images = ImageStore(max_items=512)
+
+# The archive is bounded: files past the age limit, then the oldest beyond the size limit, are evicted
+app.config['ARCHIVE_MAX_BYTES'] = int(os.environ.get('SCENTINEL_ARCHIVE_BYTES', 1024 ** 3))
+app.config['ARCHIVE_MAX_AGE'] = float(os.environ.get('SCENTINEL_ARCHIVE_MAX_AGE', 7 * 24 * 3600))
+archive = FileStore(upload_folder, max_bytes=app.config['ARCHIVE_MAX_BYTES'], max_age=app.config['ARCHIVE_MAX_AGE'])
+
+# Processed image names never change content, clients and proxies may cache them this many seconds
+app.config['PROCESSED_IMAGE_MAX_AGE'] = int(os.environ.get('SCENTINEL_PROCESSED_IMAGE_MAX_AGE', 24 * 3600))
+
+# Re-uploaded images are answered from the result cache, SCENTINEL_CACHE_DIR adds a disk tier
+app.config['RESULT_CACHE_BYTES'] = int(os.environ.get('SCENTINEL_CACHE_BYTES', 256 * 1024 * 1024))
+result_cache = ResultCache(max_bytes=app.config['RESULT_CACHE_BYTES'],
+                           disk_folder=os.environ.get('SCENTINEL_CACHE_DIR') or None)
+
+# Leveled logging, SCENTINEL_LOG_SAMPLE_RATE keeps only a fraction of the per-request records below WARNING
+logging.basicConfig(level=os.environ.get('SCENTINEL_LOG_LEVEL', 'INFO').upper(),
+                    format='%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s')
+logger = logging.getLogger('scentinel')
+request_logger = logging.getLogger('scentinel.requests')
+request_logger.addFilter(SampleFilter(float(os.environ.get('SCENTINEL_LOG_SAMPLE_RATE', 1.0))))
+
+# Prometheus metrics are served on /metrics, SCENTINEL_SERVER_TIMING=1 adds a Server-Timing header with the stages
+app.config['SERVER_TIMING'] = os.environ.get('SCENTINEL_SERVER_TIMING', '0') == '1'
+metrics = Metrics()
+request_seconds = metrics.histogram('request_seconds', 'Time to answer a request.', ('endpoint', 'method', 'status'))
+request_bytes = metrics.histogram('request_bytes', 'Size of request bodies.', ('endpoint',), SIZE_BUCKETS)
+stage_seconds = metrics.histogram('stage_seconds', 'Time spent in each pipeline stage per image.', ('stage',))
+inference_seconds = metrics.histogram('model_inference_seconds', 'Model prediction time per image.', ('model',))
+objects_found = metrics.histogram('objects', 'Objects found per analysed image.', ('model',), COUNT_BUCKETS)
+results_served = metrics.counter('results_total', 'Image results served, computed or from the cache.',
+                                 ('model', 'cached'))
+
+def record_analysis(durations, model_name, object_table):
+    """Record the stage durations and object count of one segmented image"""
+    for stage, seconds in durations.items():
+        stage_seconds.observe(seconds, stage=stage)
+    if 'predict' in durations:
+        inference_seconds.observe(durations['predict'], model=model_name)
+    objects_found.observe(len(object_table), model=model_name)
+    results_served.inc(model=model_name, cached='false')
+
+# Plate templates measure a fixed well layout without running the model
+templates = TemplateStore(os.environ.get('SCENTINEL_TEMPLATE_DIR') or os.path.join(main_directory, 'plate_templates'))
+
+# Analysis options of an upload without resolution and scale fields, the batch endpoint always uses these
+DEFAULT_ANALYSIS_OPTIONS = {'full_resolution': False, 'scale': None}
+
+def result_key(data, model_name, options=None, template=None):
+    if template is not None:
+        return ResultCache.make_key(data, template=template.key, preprocessing=preprocessing_params(),
+                                    rendering=overlay.rendering_params())
+    # Omitted options are filled in, so equal analyses share a key whichever endpoint ran them
+    return ResultCache.make_key(data, model=model_name, model_config=registry.configs[model_name],
+                                preprocessing=preprocessing_params(), rendering=overlay.rendering_params(),
+                                options=dict(DEFAULT_ANALYSIS_OPTIONS, **(options or {})))
+
+def requested_template():
+    """Plate template named by the optional template form field, raises KeyError for unknown names"""
+    name = request.form.get('template')
+    if not name:
+        return None
+    template = templates.get(name)
+    if template is None:
+        raise KeyError(name)
+    return template
+
+def analysis_options():
+    """Read the optional resolution ('working' or 'full') and scale form fields"""
+    resolution = request.form.get('resolution', 'working')
+    if resolution not in ('working', 'full'):
+        raise ValueError("resolution must be 'working' or 'full'.")
+    scale = request.form.get('scale', type=float)
+    if scale is not None and not 0 < scale <= 2:
+        raise ValueError('scale must be between 0 and 2.')
+    return dict(DEFAULT_ANALYSIS_OPTIONS, full_resolution=resolution == 'full', scale=scale)
+
+def store_processed_image(filename, data, result, cache_key):
+    """Keep the processed image and its preview in memory and archive the images if enabled.
+
+    Returns the image_key and preview_key to fetch them with, the keys derive
+    from the result cache key. Originals are archived under the hash of their
+    bytes, so uploads that share a file name never overwrite each other.
+    """
+    extension, mimetype = overlay.FORMATS[overlay.IMAGE_FORMAT]
+    keys = {'image_key': processed_images.put(result['processed_image'], mimetype, key=cache_key + extension),
+            'preview_key': None}
+    if result['preview'] is not None:
+        preview_extension, preview_mimetype = overlay.FORMATS[overlay.preview_format()]
+        keys['preview_key'] = processed_images.put(result['preview'], preview_mimetype,
+                                                   key=f'{cache_key}_preview{preview_extension}')
+    if app.config['ARCHIVE_UPLOADS']:
+        if data is not None:
+            archive.put(data, os.path.splitext(filename)[1].lower() or '.bin')
+        archive.put(result['processed_image'], name=keys['image_key'])
+        if keys['preview_key']:
+            archive.put(result['preview'], name=keys['preview_key'])
+    return keys
+
+def image_urls(keys):
+    """URLs of the processed image and of its preview, the app shows the small preview first"""
+    urls = {'processed_image_url': url_for('get_processed_image', filename=keys['image_key'])}
+    if keys.get('preview_key'):
+        urls['preview_image_url'] = url_for('get_processed_image', filename=keys['preview_key'])
+    return urls
+
+# Asynchronous jobs run on a pool of worker processes, each with its own warm model
+app.config['JOB_WORKERS'] = int(os.environ.get('SCENTINEL_JOB_WORKERS', 2))
+app.config['JOB_QUEUE_SIZE'] = int(os.environ.get('SCENTINEL_JOB_QUEUE_SIZE', 16))
+app.config['JOB_RETRY_AFTER'] = 5
+
+def finish_job(job, result):
+    """Cache the result of a finished job and keep its processed image in memory"""
+    meta = job['meta']
+    result, durations = result
+    record_analysis(durations, job['model'], result[1])
+    result = result_cache.put(meta['cache_key'], *result)
+    keys = store_processed_image(meta['filename'], meta.get('data'), result, meta['cache_key'])
+    return dict(keys, object_table=result['object_table'])
+
+job_queue = None
+_started = False
+_start_lock = threading.Lock()
+
+def start_worker():
+    """Start loading the models and the job pool of this server process.
+
+    Runs once per process: from gunicorn's post_fork hook, from __main__ or
+    on the first request. Importing this module stays cheap, and job pool
+    processes, which import it as __mp_main__, never start anything.
+    """
+    global job_queue, _started
+    with _start_lock:
+        if _started:
+            return
+        _started = True
+        registry.start()
+        if app.config['ARCHIVE_UPLOADS']:
+            archive.start()
+        if app.config['JOB_WORKERS'] > 0:
+            job_queue = JobQueue(registry.configs, registry.default, workers=app.config['JOB_WORKERS'],
+                                 max_pending=app.config['JOB_QUEUE_SIZE'], on_done=finish_job)
+
+@app.before_request
+def ensure_started():
+    start_worker()
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+    g.timer = StageTimer()
+
+@app.after_request
+def record_request(response):
+    if 'request_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.request_start
+    endpoint = request.endpoint or 'unmatched'
+    request_seconds.observe(elapsed, endpoint=endpoint, method=request.method, status=response.status_code)
+    if request.content_length:
+        request_bytes.observe(request.content_length, endpoint=endpoint)
+    if app.config['SERVER_TIMING']:
+        response.headers['Server-Timing'] = g.timer.server_timing(elapsed)
+    return response
+
+def result_response(payload, labels=None, single=True):
+    """JSON result, or the compact format the Accept header asks for with the label mask included"""
+    mimetype = response_format.negotiate(request.accept_mimetypes, single)
+    if mimetype == response_format.JSON:
+        response = jsonify(payload)
+    else:
+        if single:
+            payload = response_format.compact(payload, labels)
+        else:
+            payload = dict(payload, results=[response_format.compact(result, result_labels)
+                                             for result, result_labels in zip(payload['results'], labels)])
+        response = Response(response_format.encode(payload, mimetype), mimetype=mimetype)
+    response.vary.add('Accept')
+    return response
+
+def unknown_model_response():
+    return jsonify({'error': 'Unknown model', 'message': f'Available models: {sorted(registry.configs)}'}), 400
+
+def unknown_template_response(name):
+    return jsonify({'error': 'Unknown template', 'message': f'There is no plate template {name!r}.'}), 404
+
+@app.route('/health', methods=['GET'])
+def health():
+    status = registry.status()
+    status['jobs'] = job_queue.stats() if job_queue is not None else None
+    return jsonify(status), 200 if status['status'] == 'ready' else 503
+
+# Clients downscale to the working resolution before uploading
+app.config['UPLOAD_JPEG_QUALITY'] = 90
+
+@app.route('/input_spec', methods=['GET'])
+def input_spec():
+    return jsonify({
+        'max_dimension': MAX_DIMENSION,
+        'target_width': TARGET_WIDTH,
+        'format': 'jpeg',
+        'jpeg_quality': app.config['UPLOAD_JPEG_QUALITY'],
+    })
+
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    stats = result_cache.stats()
+    if app.config['ARCHIVE_UPLOADS']:
+        stats['archive'] = archive.stats()
+    return jsonify(stats)
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics.render(), content_type=Metrics.content_type)
+
+@app.route('/process_image', methods=['POST'])
+def process_image():
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file part', 'message': 'Please upload a file.'})
+
+    selected_file = request.files['file']
+
+    if selected_file.filename == '':
+        return jsonify({'error': 'No selected file', 'message': 'Please select a file.'})
+
+    if selected_file:
+        filename = secure_filename(selected_file.filename)
+
+        data = selected_file.read()
+
+        model_name = request.form.get('model') or registry.default
+        if model_name not in registry.configs:
+            return unknown_model_response()
+        try:
+            options = analysis_options()
+            template = requested_template()
+        except ValueError as e:
+            return jsonify({'error': 'Invalid option', 'message': str(e)}), 400
+        except KeyError as e:
+            return unknown_template_response(e.args[0])
+        source = model_name if template is None else 'template'
+
+        # Identical image and parameters were already segmented
+        with g.timer('cache'):
+            cache_key = result_key(data, model_name, options, template)
+            result = result_cache.get(cache_key)
+        cached = result is not None
+        if cached:
+            results_served.inc(model=source, cached='true')
+        else:
+            # Decode the image straight from the request stream
+            with g.timer('decode'):
+                image = decode_image(data)
+            if image is None:
+                return jsonify({'error': 'Invalid image', 'message': 'The file could not be decoded.'}), 400
+
+            # Predict objects with the warm model of the requested profile
+            def predict(blue_channel_norm, **kwargs):
+                return registry.predict(blue_channel_norm, model_name, timeout=app.config['MODEL_LOAD_TIMEOUT'],
+                                        **kwargs)[0]
+
+            try:
+                if template is not None:
+                    # Fixed layout: align the image to the template and measure inside its wells
+                    analysis, alignment = analyze_with_template(image, template, timer=g.timer)
+                    request_logger.info('Aligned %s to template %s: %s', filename, template.name, alignment)
+                else:
+                    analysis = analyze(image, predict, timer=g.timer, **options)
+                result = result_cache.put(cache_key, *analysis)
+            except ImageTooLarge as e:
+                return jsonify({'error': 'Image too large', 'message': str(e)}), 413
+            except AlignmentError as e:
+                return jsonify({'error': 'Alignment failed', 'message': str(e)}), 422
+            except ModelNotReady as e:
+                logger.warning('Model %s not ready: %s', model_name, e)
+                return jsonify({'error': 'Model not ready', 'message': str(e)}), 503
+            record_analysis(g.timer.durations, source, result['object_table'])
+
+        # Keep the processed image and its preview in memory
+        urls = image_urls(store_processed_image(filename, data, result, cache_key))
+
+        # Construct the response
+        processed_image_url = urls['processed_image_url']
+        request_logger.info('Processed %s with %s: %d objects, cached=%s', filename,
+                            model_name if template is None else f'template {template.name}',
+                            len(result['object_table']), cached)
+        request_logger.debug('Object table of %s: %s', processed_image_url, result['object_table'])
+
+        response = {
+            'message': 'Image processed successfully',
+            **urls,
+            'object_table': result['object_table'],
+            'cached': cached
+        }
+        if template is not None:
+            response['template'] = template.name
+        # inline_image=1 embeds the processed image, inline_image=preview only its preview
+        inline_image = request.form.get('inline_image', '0')
+        if inline_image == 'preview' and result['preview'] is not None:
+            response['preview_image'] = base64.b64encode(result['preview']).decode('ascii')
+        elif inline_image in ('1', 'preview'):
+            response['processed_image'] = base64.b64encode(result['processed_image']).decode('ascii')
+
+        return result_response(response, result['labels'])
+    else:
+        return jsonify({'error': 'No Image Uploaded', 'message': 'Please upload an image before processing.'})
+    
+@app.route('/process_batch', methods=['POST'])
+def process_batch():
+    selected_files = [f for f in request.files.getlist('files') + request.files.getlist('file') if f.filename]
+    if not selected_files:
+        return jsonify({'error': 'No file part', 'message': 'Please upload one or more files.'})
+
+    model_name = request.form.get('model') or registry.default
+    if model_name not in registry.configs:
+        return unknown_model_response()
+
+    start = time.perf_counter()
+
+    # Decode and preprocess every upload that is not cached yet, undecodable files get an error entry
+    results = [None] * len(selected_files)
+    labels_by_index = [None] * len(selected_files)
+    batch = []
+    for index, selected_file in enumerate(selected_files):
+        filename = secure_filename(selected_file.filename)
+        data = selected_file.read()
+        cache_key = result_key(data, model_name)
+        result = result_cache.get(cache_key)
+        if result is not None:
+            results_served.inc(model=model_name, cached='true')
+            labels_by_index[index] = result['labels']
+            results[index] = {
+                'filename': filename,
+                **image_urls(store_processed_image(filename, data, result, cache_key)),
+                'object_table': result['object_table'],
+            }
+            continue
+
+        timer = StageTimer()
+        with timer('decode'):
+            image = decode_image(data)
+        if image is None:
+            results[index] = {'filename': filename, 'error': 'Invalid image', 'message': 'The file could not be decoded.'}
+            continue
+        with timer('resize'):
+            image = prepare_image(image)
+        with timer('grayscale'):
+            blue_channel = enhance(image)
+        with timer('normalize'):
+            blue_channel_norm = normalize_image(blue_channel)
+        batch.append({'index': index, 'filename': filename, 'data': data, 'cache_key': cache_key, 'image': image,
+                      'blue_channel': blue_channel, 'blue_channel_norm': blue_channel_norm, 'timer': timer})
+
+    # Segment all remaining images with batched model calls
+    predict_start = time.perf_counter()
+    try:
+        labels_list = registry.predict_batch([item['blue_channel_norm'] for item in batch], model_name,
+                                             timeout=app.config['MODEL_LOAD_TIMEOUT'],
+                                             batch_size=app.config['BATCH_SIZE'])
+    except ModelNotReady as e:
+        logger.warning('Model %s not ready: %s', model_name, e)
+        return jsonify({'error': 'Model not ready', 'message': str(e)}), 503
+    predict_seconds = (time.perf_counter() - predict_start) / max(len(batch), 1)
+
+    for item, labels in zip(batch, labels_list):
+        # Every image is charged an equal share of the batched prediction
+        timer = item['timer']
+        timer.add('predict', predict_seconds)
+        result = result_cache.put(item['cache_key'], *quantify(item['image'], item['blue_channel'], labels, timer))
+        record_analysis(timer.durations, model_name, result['object_table'])
+        g.timer.merge(timer.durations)
+
+        labels_by_index[item['index']] = result['labels']
+        results[item['index']] = {
+            'filename': item['filename'],
+            **image_urls(store_processed_image(item['filename'], item['data'], result, item['cache_key'])),
+            'object_table': result['object_table'],
+        }
+
+    elapsed = time.perf_counter() - start
+    request_logger.info('Processed a batch of %d images with %s, %d from the cache, in %.3f s', len(selected_files),
+                        model_name, len(selected_files) - len(batch), elapsed)
+    return result_response({
+        'message': 'Images processed successfully',
+        'results': results,
+        'timing': {
+            'seconds': round(elapsed, 4),
+            'images_per_second': round(len(batch) / elapsed, 3) if elapsed > 0 else None,
+        },
+    }, labels_by_index, single=False)
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    if job_queue is None:
+        return jsonify({'error': 'Jobs disabled', 'message': 'The server runs without job workers.'}), 501
+
+    selected_file = request.files.get('file')
+    if selected_file is None or selected_file.filename == '':
+        return jsonify({'error': 'No file part', 'message': 'Please upload a file.'}), 400
+
+    filename = secure_filename(selected_file.filename)
+    data = selected_file.read()
+    model_name = request.form.get('model') or registry.default
+    if model_name not in registry.configs:
+        return unknown_model_response()
+    try:
+        options = analysis_options()
+        template = requested_template()
+    except ValueError as e:
+        return jsonify({'error': 'Invalid option', 'message': str(e)}), 400
+    except KeyError as e:
+        return unknown_template_response(e.args[0])
+
+    cache_key = result_key(data, model_name, options, template)
+    meta = {'filename': filename, 'cache_key': cache_key}
+    if app.config['ARCHIVE_UPLOADS']:
+        meta['data'] = data
+
+    result = result_cache.get(cache_key)
+    if result is None and template is not None:
+        # Template jobs are cheap enough to run right away, the client still gets a finished job
+        image = decode_image(data)
+        if image is None:
+            return jsonify({'error': 'Invalid image', 'message': 'The file could not be decoded.'}), 400
+        try:
+            analysis, _ = analyze_with_template(image, template, timer=g.timer)
+        except AlignmentError as e:
+            return jsonify({'error': 'Alignment failed', 'message': str(e)}), 422
+        result = result_cache.put(cache_key, *analysis)
+        record_analysis(g.timer.durations, 'template', result['object_table'])
+    elif result is not None:
+        results_served.inc(model=model_name if template is None else 'template', cached='true')
+
+    if result is not None:
+        keys = store_processed_image(filename, data, result, cache_key)
+        job_id = job_queue.add_done(dict(keys, object_table=result['object_table']), model_name, meta)
+    else:
+        try:
+            job_id = job_queue.submit(data, model_name, meta, options)
+        except QueueFull as e:
+            return (jsonify({'error': 'Queue full', 'message': str(e)}), 429,
+                    {'Retry-After': str(app.config['JOB_RETRY_AFTER'])})
+        except WorkersUnavailable as e:
+            return (jsonify({'error': 'Workers unavailable', 'message': str(e)}), 503,
+                    {'Retry-After': str(app.config['JOB_RETRY_AFTER'])})
+
+    return jsonify({
+        'job_id': job_id,
+        'status_url': url_for('job_status', job_id=job_id),
+        'result_url': url_for('job_result', job_id=job_id),
+    }), 202
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id) if job_queue is not None else None
+    if job is None:
+        abort(404, description='Job not found')
+    return jsonify({
+        'job_id': job_id,
+        'status': job['status'],
+        'error': job['error'],
+        'model': job['model'],
+        'seconds': round((job['finished'] or time.time()) - job['submitted'], 4),
+    })
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = job_queue.get(job_id) if job_queue is not None else None
+    if job is None:
+        abort(404, description='Job not found')
+    if job['status'] == 'failed':
+        return jsonify({'error': 'Job failed', 'message': job['error']}), 500
+    if job['status'] != 'done':
+        return jsonify({'job_id': job_id, 'status': job['status']}), 202, {'Retry-After': '1'}
+
+    # The label mask is only in the result cache, it is left out once evicted
+    cached = result_cache.get(job['meta']['cache_key'])
+    return result_response({
+        'message': 'Image processed successfully',
+        **image_urls(job['result']),
+        'object_table': job['result']['object_table'],
+    }, cached['labels'] if cached is not None else None)
+
+# Longest time series accepted by /process_stream
+app.config['STREAM_MAX_FRAMES'] = 10000
+
+@app.route('/process_stream', methods=['POST'])
+def process_stream():
+    """Per-well signal time series of a video or an image sequence, streamed as NDJSON.
+
+    Upload a 'video' file or the frames as 'files' in order, taken
+    'frame_interval' seconds apart. The wells are segmented on the first
+    frame and again every 'segment_every' frames or when the plate drifts
+    more than 'drift_threshold' pixels, every other frame is measured inside
+    the cached label mask. 'frame_step' keeps every n-th video frame.
+    """
+    video = request.files.get('video')
+    images = [f for f in request.files.getlist('files') if f.filename]
+    if (video is None or video.filename == '') and not images:
+        return jsonify({'error': 'No file part', 'message': 'Please upload a video or a sequence of images.'}), 400
+
+    model_name = request.form.get('model') or registry.default
+    if model_name not in registry.configs:
+        return unknown_model_response()
+    segment_every = request.form.get('segment_every', 0, type=int)
+    drift_threshold = request.form.get('drift_threshold', DRIFT_THRESHOLD, type=float)
+    frame_step = request.form.get('frame_step', 1, type=int)
+    frame_interval = request.form.get('frame_interval', 1.0, type=float)
+    if segment_every < 0 or drift_threshold < 0 or frame_step < 1 or frame_interval <= 0:
+        return jsonify({'error': 'Invalid option', 'message': 'segment_every and drift_threshold must not be '
+                        'negative, frame_step must be at least 1 and frame_interval positive.'}), 400
+
+    video_path = None
+    if images:
+        # Uploaded files are closed once the view returns, read them before the response starts streaming
+        frames = read_images([f.read() for f in images[:app.config['STREAM_MAX_FRAMES']]], frame_interval)
+    else:
+        # OpenCV reads videos from a path, the upload is spooled to the temp folder without loading it in memory
+        video_path = os.path.join(temp_folder, uuid.uuid4().hex + os.path.splitext(secure_filename(video.filename))[1])
+        video.save(video_path)
+        frames = read_video(video_path, frame_step, app.config['STREAM_MAX_FRAMES'])
+
+    def segment(blue_channel_norm, **kwargs):
+        start = time.perf_counter()
+        labels = registry.predict(blue_channel_norm, model_name, timeout=app.config['MODEL_LOAD_TIMEOUT'], **kwargs)[0]
+        inference_seconds.observe(time.perf_counter() - start, model=model_name)
+        return labels
+
+    tracker = TimelapseTracker(segment, segment_every, drift_threshold)
+
+    def generate():
+        try:
+            for record in tracker.process(frames):
+                if record['type'] == 'layout':
+                    objects_found.observe(len(record['wells']), model=model_name)
+                elif record['type'] == 'done':
+                    request_logger.info('Streamed %d frames with %d segmentations in %.3f s', record['frames'],
+                                        record['segmentations'], record['seconds'])
+                yield json.dumps(record) + '\n'
+        except (ModelNotReady, ValueError) as e:
+            logger.warning('Stream failed: %s', e)
+            yield json.dumps({'type': 'error', 'message': str(e)}) + '\n'
+
+    def remove_video():
+        try:
+            os.remove(video_path)
+        except FileNotFoundError:
+            pass
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    if video_path is not None:
+        # Runs when the server closes the response, also if the client left before the stream started
+        response.call_on_close(remove_video)
+    return response
+
+@app.route('/templates', methods=['GET'])
+def list_templates():
+    return jsonify({'templates': templates.names()})
+
+@app.route('/templates', methods=['POST'])
+def register_template():
+    """Register a plate layout from the model's segmentation of a reference image.
+
+    Form fields: 'file', 'name' and the optional 'model'. The wells are
+    numbered in reading order and keep these numbers on every image
+    processed with template=<name>.
+    """
+    selected_file = request.files.get('file')
+    if selected_file is None or selected_file.filename == '':
+        return jsonify({'error': 'No file part', 'message': 'Please upload a reference image.'}), 400
+    name = request.form.get('name', '')
+    try:
+        templates.check_name(name)
+    except ValueError as e:
+        return jsonify({'error': 'Invalid name', 'message': str(e)}), 400
+    model_name = request.form.get('model') or registry.default
+    if model_name not in registry.configs:
+        return unknown_model_response()
+
+    image = decode_image(selected_file.read())
+    if image is None:
+        return jsonify({'error': 'Invalid image', 'message': 'The file could not be decoded.'}), 400
+    image = prepare_image(image)
+    blue_channel = enhance(image)
+    try:
+        labels = registry.predict(normalize_image(blue_channel), model_name, timeout=app.config['MODEL_LOAD_TIMEOUT'],
+                                  **model_options(image.shape))[0]
+    except ModelNotReady as e:
+        return jsonify({'error': 'Model not ready', 'message': str(e)}), 503
+
+    template = PlateTemplate.from_segmentation(name, image, labels,
+                                               meta={'model': model_name, 'source': secure_filename(selected_file.filename)})
+    if template.wells == 0:
+        return jsonify({'error': 'No wells found', 'message': 'The model found no wells on the reference image.'}), 422
+    templates.put(template)
+    return jsonify(template.describe()), 201
+
+@app.route('/templates/<name>', methods=['GET'])
+def get_template(name):
+    try:
+        template = templates.get(name)
+    except ValueError:
+        template = None
+    if template is None:
+        return unknown_template_response(name)
+    return jsonify(template.describe())
+
+@app.route('/templates/<name>', methods=['DELETE'])
+def delete_template(name):
+    try:
+        deleted = templates.delete(name)
+    except ValueError:
+        deleted = False
+    if not deleted:
+        return unknown_template_response(name)
+    return jsonify({'message': f'Template {name!r} deleted.'})
+
+@app.route('/calibrate', methods=['POST'])
+def calibrate():
+    """Fit calibration curves and inverse-predict unknown concentrations.
+
+    The body is one sample ({'concentrations', 'responses', 'unknown_response'})
+    or {'samples': [...]} for many plates at once, with an optional 'model'
+    ('auto', '4pl', '5pl' or 'linear') and 'max_iterations'.
+    """
+    body = request.get_json(silent=True)
+    if not isinstance(body, dict):
+        return jsonify({'error': 'Invalid request', 'message': 'Please send a JSON object.'}), 400
+
+    samples = body.get('samples', [body])
+    model = body.get('model', 'auto')
+    if model != 'auto' and model not in calibration.MODELS:
+        return jsonify({'error': 'Unknown model', 'message': f'Available models: auto, {", ".join(calibration.MODELS)}'}), 400
+
+    try:
+        max_iterations = body.get('max_iterations', calibration.MAX_ITERATIONS)
+        if isinstance(max_iterations, bool) or not isinstance(max_iterations, int) or max_iterations < 1:
+            raise ValueError('max_iterations must be a positive integer.')
+        max_iterations = min(max_iterations, calibration.MAX_ITERATIONS)
+        if not samples or any(len(sample['concentrations']) < 2 for sample in samples):
+            raise ValueError('Every sample needs at least two concentrations.')
+        results = calibration.calibrate(samples, model, max_iterations)
+    except (KeyError, TypeError, ValueError) as e:
+        return jsonify({'error': 'Invalid samples', 'message': str(e)}), 400
+
+    if 'samples' in body:
+        return jsonify({'results': results})
+    return jsonify(results[0])
+
+@app.route('/processed_image/<filename>', methods=['GET'])
+def get_processed_image(filename):
+    # Keys are unique per content, so the key doubles as a strong ETag and responses never go stale
+    options = {'etag': os.path.splitext(filename)[0], 'conditional': True,
+               'max_age': app.config['PROCESSED_IMAGE_MAX_AGE']}
+    item = processed_images.get(filename)
+    if item is not None:
+        data, mimetype = item
+        response = send_file(io.BytesIO(data), mimetype=mimetype, **options)
+    else:
+        # Fall back to the archive for images evicted from memory, sent from the file with sendfile
+        processed_image_path = archive.path(filename)
+        if processed_image_path is None:
+            abort(404, description='Image not found')
+        response = send_file(processed_image_path, mimetype=overlay.mimetype(filename), **options)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+if __name__ == '__main__':
+    start_worker()
+    # The reloader would load the models twice, enable it with FLASK_DEBUG=1
+    app.run(host='0.0.0.0', port=5000, debug=os.environ.get('FLASK_DEBUG', '0') == '1', threaded=True)
@@ -0,0 +1,246 @@
+import numpy as np
+
+# Models tried in order by the 'auto' mode, the first acceptable fit wins
+MODELS = ('4pl', '5pl', 'linear')
+PARAMETER_NAMES = {
+    '4pl': ('A', 'B', 'C', 'D'),
+    '5pl': ('A', 'B', 'C', 'D', 'E'),
+    'linear': ('intercept', 'slope'),
+}
+MIN_R_SQUARED = 0.9
+MAX_ITERATIONS = 200
+TOLERANCE = 1e-10
+
+
+def _logistic_terms(x, B, C):
+    """u = (x/C)^B and du/dB, du/dC, all zero where x is 0"""
+    positive = x > 0
+    ratio = np.where(positive, x, 1.0) / C
+    u = np.where(positive, ratio ** B, 0.0)
+    du_dB = np.where(positive, u * np.log(ratio), 0.0)
+    du_dC = -B / C * u
+    return u, du_dB, du_dC
+
+
+def _4pl(x, p):
+    A, B, C, D = (p[:, i:i + 1] for i in range(4))
+    u, du_dB, du_dC = _logistic_terms(x, B, C)
+    inverse_den = 1.0 / (1.0 + u)
+    f = D + (A - D) * inverse_den
+    scale = -(A - D) * inverse_den ** 2
+    J = np.stack([inverse_den, scale * du_dB, scale * du_dC, 1.0 - inverse_den], axis=-1)
+    return f, J
+
+
+def _5pl(x, p):
+    A, B, C, D, E = (p[:, i:i + 1] for i in range(5))
+    u, du_dB, du_dC = _logistic_terms(x, B, C)
+    den = 1.0 + u
+    g = den ** -E
+    scale = -(A - D) * E * g / den
+    J = np.stack([g, scale * du_dB, scale * du_dC, 1.0 - g, -(A - D) * g * np.log(den)], axis=-1)
+    return D + (A - D) * g, J
+
+
+def _bounds(x, y, n_params):
+    """Per-row lower and upper parameter bounds"""
+    x_max = np.nanmax(x, axis=1)
+    x_min = np.nanmin(np.where(x > 0, x, np.nan), axis=1)
+    x_min = np.where(np.isnan(x_min), x_max, x_min)
+    span = np.nanmax(y, axis=1) - np.nanmin(y, axis=1) + 1e-12
+    y_low = np.nanmin(y, axis=1) - 10 * span
+    y_high = np.nanmax(y, axis=1) + 10 * span
+    lower = [y_low, np.full_like(span, 0.05), x_min / 100, y_low]
+    upper = [y_high, np.full_like(span, 20.0), x_max * 100, y_high]
+    if n_params == 5:
+        lower.append(np.full_like(span, 0.1))
+        upper.append(np.full_like(span, 10.0))
+    return np.stack(lower, axis=1), np.stack(upper, axis=1)
+
+
+def _initial_guess(x, y, n_params):
+    """Response at the lowest and highest concentration as the asymptotes, mid-range concentration as C"""
+    rows = np.arange(len(x))
+    A = y[rows, np.nanargmin(x, axis=1)]
+    D = y[rows, np.nanargmax(x, axis=1)]
+    C = np.nanmedian(np.where(x > 0, x, np.nan), axis=1)
+    C = np.where(np.isnan(C), 1.0, C)
+    p = [A, np.ones_like(A), C, D]
+    if n_params == 5:
+        p.append(np.ones_like(A))
+    return np.stack(p, axis=1)
+
+
+def _levenberg_marquardt(func, x, y, p, lower, upper, max_iterations=MAX_ITERATIONS, tolerance=TOLERANCE):
+    """Fit all rows at once with a damped Gauss-Newton step clipped to the bounds.
+
+    NaN entries of y are ignored. Returns the parameters, residual sum of
+    squares, a converged flag and the number of iterations of every row.
+    """
+    with np.errstate(all='ignore'):
+        return _levenberg_marquardt_rows(func, x, y, p, lower, upper, max_iterations, tolerance)
+
+
+def _levenberg_marquardt_rows(func, x, y, p, lower, upper, max_iterations, tolerance):
+    weights = (~np.isnan(y)).astype(float)
+    x = np.where(np.isnan(x), 0.0, x)
+    y = np.where(np.isnan(y), 0.0, y)
+    p = np.clip(p, lower, upper)
+
+    def cost(params):
+        f, J = func(x, params)
+        r = (y - f) * weights
+        return np.sum(r ** 2, axis=1), r, J * weights[..., np.newaxis]
+
+    rss, r, J = cost(p)
+    damping = np.full(len(p), 1e-3)
+    active = np.ones(len(p), dtype=bool)
+    iterations = np.zeros(len(p), dtype=int)
+    eye = np.eye(p.shape[1])
+
+    for _ in range(max_iterations):
+        if not active.any():
+            break
+        JtJ = np.einsum('bni,bnj->bij', J, J)
+        Jtr = np.einsum('bni,bn->bi', J, r)
+        lhs = JtJ + damping[:, None, None] * (JtJ * eye + 1e-12 * eye)
+        try:
+            step = np.linalg.solve(lhs, Jtr[..., np.newaxis])[..., 0]
+        except np.linalg.LinAlgError:
+            # A singular row makes the batched solve fail, fall back to the pseudo-inverse
+            step = (np.linalg.pinv(lhs) @ Jtr[..., np.newaxis])[..., 0]
+        step = np.where(active[:, None] & np.isfinite(step), step, 0.0)
+
+        candidate = np.clip(p + step, lower, upper)
+        candidate_rss, candidate_r, candidate_J = cost(candidate)
+        improved = active & np.isfinite(candidate_rss) & (candidate_rss <= rss)
+
+        converged = improved & ((rss - candidate_rss) <= tolerance * (1.0 + rss))
+        p = np.where(improved[:, None], candidate, p)
+        r = np.where(improved[:, None], candidate_r, r)
+        J = np.where(improved[:, None, None], candidate_J, J)
+        rss = np.where(improved, candidate_rss, rss)
+        damping = np.where(improved, damping / 3, damping * 2)
+
+        iterations += active
+        # Rows whose damping blew up cannot improve any more
+        active &= ~converged & (damping < 1e12)
+
+    return p, rss, ~active, iterations
+
+
+def _fit_linear(x, y):
+    weights = ~np.isnan(y)
+    n = weights.sum(axis=1)
+    x = np.where(weights, x, 0.0)
+    y = np.where(weights, y, 0.0)
+    x_mean = x.sum(axis=1) / n
+    y_mean = y.sum(axis=1) / n
+    dx = np.where(weights, x - x_mean[:, None], 0.0)
+    slope = (dx * (y - y_mean[:, None])).sum(axis=1) / np.maximum((dx ** 2).sum(axis=1), 1e-300)
+    intercept = y_mean - slope * x_mean
+    p = np.stack([intercept, slope], axis=1)
+    rss = np.sum(np.where(weights, y - (intercept[:, None] + slope[:, None] * x), 0.0) ** 2, axis=1)
+    return p, rss, np.ones(len(p), dtype=bool), np.ones(len(p), dtype=int)
+
+
+def predict(model, params, x):
+    """Evaluate fitted curves, params has one row per curve"""
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    if model == 'linear':
+        return params[:, :1] + params[:, 1:2] * x
+    return (_4pl if model == '4pl' else _5pl)(x, params)[0]
+
+
+def inverse(model, params, y):
+    """Concentration giving response y on each fitted curve, NaN where there is none"""
+    y = np.asarray(y, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if model == 'linear':
+            return (y - params[:, 0]) / params[:, 1]
+        A, B, C, D = params[:, 0], params[:, 1], params[:, 2], params[:, 3]
+        ratio = (A - D) / (y - D)
+        if model == '5pl':
+            ratio = ratio ** (1 / params[:, 4])
+        return C * (ratio - 1) ** (1 / B)
+
+
+def fit(x, y, model='auto', max_iterations=MAX_ITERATIONS, min_r_squared=MIN_R_SQUARED):
+    """Fit calibration curves to many samples in one vectorized call.
+
+    x and y are (samples, points) arrays, pad shorter samples with NaN. With
+    model='auto' the 4PL fit is used where it converges with at least
+    min_r_squared, then 5PL, then linear; if no model reaches it the one with
+    the best adjusted R² is kept. Returns one dict per sample.
+    """
+    x = np.atleast_2d(np.asarray(x, dtype=float))
+    y = np.atleast_2d(np.asarray(y, dtype=float))
+    y = np.where(np.isnan(x), np.nan, y)
+    x = np.where(np.isnan(y), np.nan, x)
+    n_points = (~np.isnan(y)).sum(axis=1)
+    tss = np.nansum((y - np.nanmean(y, axis=1, keepdims=True)) ** 2, axis=1)
+
+    candidates = MODELS if model == 'auto' else (model,)
+    fits = {}
+    for name in candidates:
+        n_params = len(PARAMETER_NAMES[name])
+        if name == 'linear':
+            p, rss, converged, iterations = _fit_linear(x, y)
+        else:
+            lower, upper = _bounds(x, y, n_params)
+            p, rss, converged, iterations = _levenberg_marquardt(
+                _4pl if name == '4pl' else _5pl, x, y, _initial_guess(x, y, n_params), lower, upper,
+                max_iterations)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            r_squared = np.where(tss > 0, 1 - rss / tss, np.where(rss < 1e-20, 1.0, 0.0))
+            dof = n_points - n_params
+            adjusted = np.where(dof > 0, 1 - (1 - r_squared) * (n_points - 1) / np.maximum(dof, 1), -np.inf)
+        enough_points = n_points >= n_params
+        fits[name] = {'params': p, 'rss': rss, 'converged': converged & enough_points, 'iterations': iterations,
+                      'r_squared': r_squared, 'adjusted': np.where(enough_points, adjusted, -np.inf)}
+
+    results = []
+    for i in range(len(x)):
+        chosen = next((name for name in candidates
+                       if fits[name]['converged'][i] and fits[name]['r_squared'][i] >= min_r_squared), None)
+        if chosen is None:
+            chosen = max(candidates, key=lambda name: fits[name]['adjusted'][i])
+        f = fits[chosen]
+        results.append({
+            'model': chosen,
+            'parameters': dict(zip(PARAMETER_NAMES[chosen], (float(v) for v in f['params'][i]))),
+            'params': f['params'][i],
+            'r_squared': float(f['r_squared'][i]),
+            'rmse': float(np.sqrt(f['rss'][i] / max(n_points[i], 1))),
+            'converged': bool(f['converged'][i]),
+            'iterations': int(f['iterations'][i]),
+            'points': int(n_points[i]),
+        })
+    return results
+
+
+def calibrate(samples, model='auto', max_iterations=MAX_ITERATIONS):
+    """Fit every sample and inverse-predict its unknown response.
+
+    samples is a list of dicts with 'concentrations', 'responses' and an
+    optional 'unknown_response'. Returns JSON ready dicts.
+    """
+    n_points = max(len(sample['concentrations']) for sample in samples)
+    x = np.full((len(samples), n_points), np.nan)
+    y = np.full((len(samples), n_points), np.nan)
+    for i, sample in enumerate(samples):
+        if len(sample['concentrations']) != len(sample['responses']):
+            raise ValueError('concentrations and responses must have the same length')
+        x[i, :len(sample['concentrations'])] = sample['concentrations']
+        y[i, :len(sample['responses'])] = sample['responses']
+
+    results = fit(x, y, model, max_iterations)
+    for sample, result in zip(samples, results):
+        params = result.pop('params')
+        unknown = sample.get('unknown_response')
+        result['concentration'] = None
+        if unknown is not None:
+            concentration = float(inverse(result['model'], params[np.newaxis], unknown)[0])
+            if np.isfinite(concentration):
+                result['concentration'] = concentration
+    return results
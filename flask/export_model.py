@@ -0,0 +1,46 @@
+"""Export the StarDist network of a model profile for the ONNX Runtime or TensorFlow Lite backend.
+
+Needs TensorFlow, plus tf2onnx for ONNX. With --int8 the network is
+quantized, calibrated on the given images (the sample image by default)
+after the same preprocessing the server applies. The export lands where
+the profile's backend looks for it, serve it with the profile's 'backend'
+entry or SCENTINEL_INFERENCE_BACKEND.
+
+Usage: python flask/export_model.py [--model versatile] [--backend onnx] [--int8] [image ...]
+"""
+import argparse
+import os
+import sys
+
+import cv2
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from inference import EXTENSIONS, export_model, export_path, load_stardist  # noqa: E402
+from model_registry import DEFAULT_MODEL, load_model_configs  # noqa: E402
+from pipeline import prepare_image, preprocess  # noqa: E402
+
+SAMPLE_IMAGE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Sample Images',
+                            'sample 1.jpg')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('images', nargs='*', default=[SAMPLE_IMAGE], help='calibration images for --int8')
+    parser.add_argument('--model', default=DEFAULT_MODEL, help='model profile')
+    parser.add_argument('--backend', choices=sorted(EXTENSIONS), default='onnx')
+    parser.add_argument('--int8', action='store_true', help='quantize weights and activations to int8')
+    parser.add_argument('--output', help='path of the exported model, by default where the backend looks for it')
+    args = parser.parse_args()
+
+    config = dict(load_model_configs()[args.model], backend=args.backend, quantize=args.int8)
+    path = args.output or export_path(config, args.backend)
+    calibration = [preprocess(prepare_image(cv2.imread(image)))[1] for image in args.images] if args.int8 else []
+
+    metadata = export_model(load_stardist(config), path, args.backend, quantize=args.int8, calibration=calibration)
+    print(f'{path}  {os.path.getsize(path) / 1e6:.1f} MB  grid {metadata["grid"]}  '
+          f'{"int8" if args.int8 else "float32"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,28 @@
+import os
+
+bind = os.environ.get('SCENTINEL_BIND', '0.0.0.0:5000')
+# One worker by default. Jobs, stored images and the result cache live in the
+# memory of the worker that created them, so with several workers a poll or
+# an image request that lands on another worker answers 404. Every worker
+# also starts its own pool of SCENTINEL_JOB_WORKERS job processes. Scale with
+# threads and job workers; more web workers only suit synchronous /process
+# traffic behind sticky sessions
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+threads = int(os.environ.get('SCENTINEL_THREADS', 4))
+timeout = 600
+
+# Import the app and the heavy libraries once in the master, the forked
+# workers share those pages copy-on-write instead of importing them again
+preload_app = True
+
+
+def on_starting(server):
+    if os.environ.get('SCENTINEL_PRELOAD_IMPORTS', '1') == '1':
+        from model_registry import preload_imports
+        preload_imports()
+
+
+def post_fork(server, worker):
+    # Models are loaded in each worker after the fork, TensorFlow runtime state is not fork safe
+    from app import start_worker
+    start_worker()
@@ -0,0 +1,42 @@
+import threading
+import uuid
+from collections import OrderedDict
+
+
+class ImageStore:
+    """Bounded in-memory store for encoded images.
+
+    Entries are evicted least recently used first once either the item count
+    or the total size goes over its limit.
+    """
+
+    def __init__(self, max_items=256, max_bytes=256 * 1024 * 1024):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, data, mimetype='image/jpeg', extension='.jpg', key=None):
+        """Store encoded image bytes and return the key to fetch them with"""
+        key = key or uuid.uuid4().hex + extension
+        with self._lock:
+            if key in self._items:
+                self.total_bytes -= len(self._items.pop(key)[0])
+            self._items[key] = (data, mimetype)
+            self.total_bytes += len(data)
+            while self._items and (len(self._items) > self.max_items or self.total_bytes > self.max_bytes):
+                _, (evicted, _) = self._items.popitem(last=False)
+                self.total_bytes -= len(evicted)
+        return key
+
+    def get(self, key):
+        """Return (data, mimetype) for a key, or None once it has been evicted"""
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+            return item
+
+    def __len__(self):
+        return len(self._items)
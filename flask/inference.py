@@ -0,0 +1,301 @@
+import json
+import os
+import re
+import uuid
+from abc import ABC, abstractmethod
+
+import numpy as np
+
+# Backends that run the StarDist U-Net. 'tensorflow' is the Keras model as
+# trained, the others run a copy exported once with export_model. They
+# only need the runtime and stardist's NMS, not TensorFlow.
+BACKENDS = ('tensorflow', 'onnx', 'tflite')
+EXTENSIONS = {'onnx': '.onnx', 'tflite': '.tflite'}
+EXPORT_DIR = os.environ.get('SCENTINEL_EXPORT_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                                 'exported_models'))
+ONNX_OPSET = 13
+
+
+def load_stardist(config, threads=0):
+    """StarDist2D model of a profile, TensorFlow limited to threads intra-op threads when given"""
+    # TensorFlow comes in with stardist, only import it when a model is needed
+    import tensorflow as tf
+    from stardist.models import StarDist2D
+
+    if threads:
+        try:
+            tf.config.threading.set_intra_op_parallelism_threads(threads)
+        except RuntimeError:
+            # The runtime is already initialized, an earlier model set the thread count
+            pass
+
+    if config.get('basedir'):
+        return StarDist2D(None, name=config['name'], basedir=config['basedir'])
+    return StarDist2D.from_pretrained(config['pretrained'])
+
+
+def export_path(config, backend):
+    """Where the exported network of a profile lives, the 'export' entry of the profile overrides it"""
+    if config.get('export'):
+        return config['export']
+    source = config['name'] if config.get('basedir') else config['pretrained']
+    name = re.sub(r'[^A-Za-z0-9]+', '_', source).strip('_') + ('_int8' if config.get('quantize') else '')
+    return os.path.join(EXPORT_DIR, name + EXTENSIONS[backend])
+
+
+def metadata_path(path):
+    return os.path.splitext(path)[0] + '.json'
+
+
+def load_backend(config, threads=0):
+    """Inference backend of a profile, 'backend' defaults to tensorflow"""
+    backend = config.get('backend', 'tensorflow')
+    if backend == 'tensorflow':
+        return TensorFlowBackend(load_stardist(config, threads))
+    if backend == 'onnx':
+        return OnnxBackend(export_path(config, backend), threads)
+    if backend == 'tflite':
+        return TfliteBackend(export_path(config, backend), threads)
+    raise ValueError(f'Unknown inference backend {backend!r}, expected one of {BACKENDS}')
+
+
+class TensorFlowBackend:
+    """StarDist2D as trained, predict_instances is StarDist's own"""
+
+    name = 'tensorflow'
+
+    def __init__(self, model):
+        self.model = model
+        self.grid = tuple(model.config.grid)
+        self.div_by = tuple(model._axes_div_by('YX'))
+
+    def predict_instances(self, image, **params):
+        return self.model.predict_instances(image, **params)
+
+    def network(self, batch):
+        """prob and dist maps of a batch of padded images"""
+        return self.model.keras_model.predict(batch, batch_size=len(batch), verbose=0)[:2]
+
+    def instances(self, shape, prob, dist, prob_thresh, nms_thresh):
+        labels, _ = self.model._instances_from_prediction(shape, prob, dist, prob_thresh=prob_thresh,
+                                                          nms_thresh=nms_thresh)
+        return labels
+
+
+class ExportedBackend(ABC):
+    """U-Net exported by export_model, with StarDist's polygon NMS run on its output.
+
+    The grid, the size the input has to be divisible by and the tile overlap
+    of the network come from the JSON file written next to the model.
+    Subclasses run the network with their runtime.
+    """
+
+    name = None
+
+    def __init__(self, path, threads=0):
+        if not os.path.exists(path):
+            raise FileNotFoundError(f'No exported model at {path}, create it with flask/export_model.py')
+        with open(metadata_path(path)) as f:
+            self.metadata = json.load(f)
+        self.path = path
+        self.threads = threads
+        self.grid = tuple(self.metadata['grid'])
+        self.div_by = tuple(self.metadata['div_by'])
+        self.tile_overlap = tuple(self.metadata['tile_overlap'])
+
+    @abstractmethod
+    def network(self, batch):
+        """prob and dist maps of a batch of padded images"""
+
+    @staticmethod
+    def _split_outputs(outputs):
+        # prob has one channel and dist one per ray, runtimes do not keep the Keras output order
+        prob, dist = sorted(outputs[:2], key=lambda output: output.shape[-1])
+        return prob, dist
+
+    def _pad(self, image):
+        padding = [(0, -size % d) for size, d in zip(image.shape, self.div_by)]
+        return np.pad(image, padding, mode='reflect')
+
+    def _predict(self, image, n_tiles):
+        """prob and dist of one image, in n_tiles blocks with overlapping borders"""
+        grid = np.array(self.grid)
+        shape = np.array(image.shape)
+        out_shape = -(-shape // grid)
+        if tuple(n_tiles) == (1, 1):
+            prob, dist = self.network(self._pad(image)[np.newaxis, ..., np.newaxis])
+            crop = tuple(slice(0, size) for size in out_shape)
+            return prob[0][crop][..., 0], dist[0][crop]
+
+        prob = np.zeros(tuple(out_shape), np.float32)
+        dist = None
+        # Block edges sit on the grid so the outputs of neighbouring blocks line up
+        edges = [np.unique(np.concatenate(([0], np.round(np.linspace(0, size, n + 1)[1:-1] / g).astype(int) * g,
+                                           [size]))) for size, n, g in zip(shape, n_tiles, grid)]
+        margins = [-(-overlap // g) * g for overlap, g in zip(self.tile_overlap, grid)]
+        for y0, y1 in zip(edges[0][:-1], edges[0][1:]):
+            for x0, x1 in zip(edges[1][:-1], edges[1][1:]):
+                ty0, tx0 = max(0, y0 - margins[0]), max(0, x0 - margins[1])
+                ty1, tx1 = min(shape[0], y1 + margins[0]), min(shape[1], x1 + margins[1])
+                tile_prob, tile_dist = self.network(self._pad(image[ty0:ty1, tx0:tx1])[np.newaxis, ..., np.newaxis])
+                if dist is None:
+                    dist = np.zeros(tuple(out_shape) + (tile_dist.shape[-1],), np.float32)
+                # Keep the block without its margins
+                src = (slice((y0 - ty0) // grid[0], (y0 - ty0) // grid[0] + -(-(y1 - y0) // grid[0])),
+                       slice((x0 - tx0) // grid[1], (x0 - tx0) // grid[1] + -(-(x1 - x0) // grid[1])))
+                dst = (slice(y0 // grid[0], y0 // grid[0] + -(-(y1 - y0) // grid[0])),
+                       slice(x0 // grid[1], x0 // grid[1] + -(-(x1 - x0) // grid[1])))
+                prob[dst] = tile_prob[0][src][..., 0]
+                dist[dst] = tile_dist[0][src]
+        return prob, dist
+
+    def instances(self, shape, prob, dist, prob_thresh, nms_thresh, scale=None):
+        """Label image from prob and dist, the same NMS and rasterization as StarDist2D"""
+        from stardist.geometry import polygons_to_label
+        from stardist.nms import non_maximum_suppression
+
+        points, probi, disti = non_maximum_suppression(dist, prob, grid=self.grid, prob_thresh=prob_thresh,
+                                                       nms_thresh=nms_thresh)
+        rescale = (1.0, 1.0) if scale is None else (1 / scale, 1 / scale)
+        points = points * np.array(rescale).reshape(1, 2)
+        return polygons_to_label(disti, points, prob=probi, shape=shape, scale_dist=rescale)
+
+    def predict_instances(self, image, prob_thresh, nms_thresh, n_tiles=(1, 1), scale=None, **_):
+        """Same arguments and labels as StarDist2D.predict_instances, details only hold the scale"""
+        model_input = image
+        if scale is not None:
+            from scipy import ndimage
+
+            model_input = ndimage.zoom(image, scale, order=1)
+        prob, dist = self._predict(model_input.astype(np.float32, copy=False), n_tiles)
+        return self.instances(image.shape, prob, dist, prob_thresh, nms_thresh, scale), {'scale': scale}
+
+
+class OnnxBackend(ExportedBackend):
+    """Network run by ONNX Runtime on the CPU"""
+
+    name = 'onnx'
+
+    def __init__(self, path, threads=0):
+        super().__init__(path, threads)
+        import onnxruntime
+
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def network(self, batch):
+        return self._split_outputs(self.session.run(None, {self.input_name: batch.astype(np.float32, copy=False)}))
+
+
+class TfliteBackend(ExportedBackend):
+    """Network run by the TensorFlow Lite interpreter, tflite_runtime when it is installed"""
+
+    name = 'tflite'
+
+    def __init__(self, path, threads=0):
+        super().__init__(path, threads)
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+
+        self.interpreter = Interpreter(model_path=path, num_threads=threads or None)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self._input_shape = None
+
+    def network(self, batch):
+        # The interpreter is sized for one input shape, resize it when the shape changes
+        if batch.shape != self._input_shape:
+            self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+            self.interpreter.allocate_tensors()
+            self._input_shape = batch.shape
+        self.interpreter.set_tensor(self.input_index, batch.astype(np.float32, copy=False))
+        self.interpreter.invoke()
+        return self._split_outputs([self.interpreter.get_tensor(output['index'])
+                                    for output in self.interpreter.get_output_details()])
+
+
+def export_model(model, path, backend='onnx', quantize=False, calibration=()):
+    """Export the U-Net of a StarDist2D model for an exported backend.
+
+    With quantize the weights and activations are stored as int8,
+    calibrated on the normalized model inputs in calibration. Writes the
+    model to path and its metadata next to it, returns the metadata.
+    """
+    if quantize and not len(calibration):
+        raise ValueError('int8 quantization needs calibration images')
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    div_by = tuple(model._axes_div_by('YX'))
+    # Calibration inputs are padded like the inputs the backend will see
+    calibration = [np.pad(image, [(0, -size % d) for size, d in zip(image.shape, div_by)],
+                          mode='reflect')[np.newaxis, ..., np.newaxis].astype(np.float32)
+                   for image in calibration]
+
+    if backend == 'onnx':
+        _export_onnx(model.keras_model, path, quantize, calibration)
+    elif backend == 'tflite':
+        _export_tflite(model.keras_model, path, quantize, calibration)
+    else:
+        raise ValueError(f'Cannot export to {backend!r}, expected one of {tuple(EXTENSIONS)}')
+
+    # StarDist hands out numpy integers, which json cannot write
+    metadata = {
+        'backend': backend,
+        'quantized': bool(quantize),
+        'grid': [int(v) for v in model.config.grid],
+        'div_by': [int(v) for v in div_by],
+        'tile_overlap': [int(v) for v in model._axes_tile_overlap('YX')],
+        'n_rays': int(model.config.n_rays),
+        'thresholds': {'prob': float(model.thresholds.prob), 'nms': float(model.thresholds.nms)},
+    }
+    # A failed write must not leave a truncated file that every backend would then fail to read
+    tmp_path = f'{metadata_path(path)}.{uuid.uuid4().hex}.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump(metadata, f, indent=2)
+        os.replace(tmp_path, metadata_path(path))
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return metadata
+
+
+def _export_onnx(keras_model, path, quantize, calibration):
+    import tensorflow as tf
+    import tf2onnx
+
+    float_path = path + '.fp32' if quantize else path
+    signature = (tf.TensorSpec((None, None, None, 1), tf.float32, name='input'),)
+    tf2onnx.convert.from_keras(keras_model, input_signature=signature, opset=ONNX_OPSET, output_path=float_path)
+    if not quantize:
+        return
+
+    from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+    class Reader(CalibrationDataReader):
+        def __init__(self):
+            self.inputs = iter({'input': image} for image in calibration)
+
+        def get_next(self):
+            return next(self.inputs, None)
+
+    try:
+        quantize_static(float_path, path, Reader(), quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+    finally:
+        os.remove(float_path)
+
+
+def _export_tflite(keras_model, path, quantize, calibration):
+    import tensorflow as tf
+
+    converter = tf.lite.TFLiteConverter.from_keras_model(keras_model)
+    if quantize:
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.representative_dataset = lambda: ([image] for image in calibration)
+    with open(path, 'wb') as f:
+        f.write(converter.convert())
@@ -0,0 +1,175 @@
+import multiprocessing
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# Model registry of the current worker process, created by _init_worker
+_registry = None
+
+
+def _init_worker(model_configs, default_model):
+    """Load and warm the models once in every pool process"""
+    global _registry
+    from model_registry import ModelRegistry
+    _registry = ModelRegistry(model_configs, default=default_model)
+    _registry.load_all()
+
+
+def _warm():
+    return _registry.ready
+
+
+def run_job(data, model_name, options):
+    """Decode and segment one image inside a pool process.
+
+    Returns the analyze result and the duration of every stage, metrics are
+    recorded by the server process.
+    """
+    from metrics import StageTimer
+    from pipeline import analyze, decode_image
+
+    timer = StageTimer()
+    with timer('decode'):
+        image = decode_image(data)
+    if image is None:
+        raise ValueError('The file could not be decoded.')
+    result = analyze(image, lambda image, **kwargs: _registry.predict(image, model_name, **kwargs)[0], timer=timer,
+                     **options)
+    return result, timer.durations
+
+
+class QueueFull(Exception):
+    """Raised when a job is submitted while the queue is at capacity"""
+
+
+class WorkersUnavailable(Exception):
+    """Raised when the worker pool is broken and a new one fails as well"""
+
+
+class JobQueue:
+    """Runs segmentation jobs on a pool of worker processes with a bounded queue.
+
+    Each pool process holds its own warm models. Jobs that are queued or
+    running count towards max_pending, further submissions raise QueueFull.
+    Finished jobs are kept for result_ttl seconds. A pool broken by a dying
+    worker process is replaced on the next submission.
+    """
+
+    def __init__(self, model_configs, default_model, workers=2, max_pending=16, result_ttl=600, on_done=None):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.result_ttl = result_ttl
+        self.on_done = on_done
+        self._model_configs = model_configs
+        self._default_model = default_model
+        self._jobs = {}
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._executor = self._start_pool()
+
+    def _start_pool(self):
+        # Spawn rather than fork, TensorFlow state in the parent is not fork safe
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                       initializer=_init_worker, initargs=(self._model_configs, self._default_model))
+        # Start every worker now so the models are warm before the first job
+        for _ in range(self.workers):
+            executor.submit(_warm)
+        return executor
+
+    def _submit(self, *args):
+        """Submit to the pool, replacing it once if a worker process died and broke it"""
+        executor = self._executor
+        try:
+            return executor.submit(*args)
+        except BrokenProcessPool:
+            with self._lock:
+                # Another request may have replaced it already
+                if self._executor is executor:
+                    self._executor = self._start_pool()
+            executor.shutdown(wait=False, cancel_futures=True)
+        try:
+            return self._executor.submit(*args)
+        except BrokenProcessPool as e:
+            raise WorkersUnavailable('The job worker processes could not be restarted') from e
+
+    def submit(self, data, model_name, meta=None, options=None):
+        """Queue an image for segmentation and return the job id.
+
+        options are passed on to pipeline.analyze.
+        """
+        with self._lock:
+            self._prune()
+            if self._pending >= self.max_pending:
+                raise QueueFull(f'{self._pending} jobs are already pending')
+            self._pending += 1
+            job_id = uuid.uuid4().hex
+            job = {'id': job_id, 'status': 'queued', 'submitted': time.time(), 'finished': None,
+                   'model': model_name, 'meta': meta or {}, 'result': None, 'error': None}
+            self._jobs[job_id] = job
+
+        try:
+            future = self._submit(run_job, data, model_name, options or {})
+        except Exception:
+            # The job never reached the pool, free its slot
+            with self._lock:
+                self._pending -= 1
+                del self._jobs[job_id]
+            raise
+        job['future'] = future
+        future.add_done_callback(lambda f: self._finish(job, f))
+        return job_id
+
+    def add_done(self, result, model_name, meta=None):
+        """Record a job whose result is already known, e.g. from the result cache"""
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._prune()
+            self._jobs[job_id] = {'id': job_id, 'status': 'done', 'submitted': time.time(), 'finished': time.time(),
+                                  'model': model_name, 'meta': meta or {}, 'result': result, 'error': None}
+        return job_id
+
+    def _finish(self, job, future):
+        error = future.exception()
+        result = None
+        if error is None:
+            result = future.result()
+            if self.on_done is not None:
+                try:
+                    result = self.on_done(job, result)
+                except Exception as e:
+                    error = e
+        with self._lock:
+            self._pending -= 1
+            job['finished'] = time.time()
+            job['result'] = result
+            job['error'] = f'{type(error).__name__}: {error}' if error else None
+            job['status'] = 'failed' if error else 'done'
+            job.pop('future', None)
+
+    def _prune(self):
+        cutoff = time.time() - self.result_ttl
+        expired = [job_id for job_id, job in self._jobs.items() if job['finished'] and job['finished'] < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def get(self, job_id):
+        """Return a snapshot of the job, None for unknown or expired ids"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            job = dict(job)
+        future = job.pop('future', None)
+        if job['status'] == 'queued' and future is not None and future.running():
+            job['status'] = 'running'
+        return job
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.workers, 'pending': self._pending, 'max_pending': self.max_pending,
+                    'jobs': len(self._jobs)}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,263 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from inference import load_backend
+
+# Named model profiles. Several profiles can share the same pretrained weights
+# with different thresholds, the weights are only loaded once.
+DEFAULT_MODEL = 'versatile'
+MODEL_CONFIGS = {
+    'versatile': {
+        'pretrained': 'Versatile (fluorescent nuclei)',
+        'nms_thresh': 0.01,
+        'prob_thresh': 0.67,
+    },
+}
+
+# Profiles without a 'backend' entry run on this one, see inference.BACKENDS
+DEFAULT_BACKEND = os.environ.get('SCENTINEL_INFERENCE_BACKEND', 'tensorflow')
+# Intra-op threads of every model's runtime, 0 leaves the runtime's default (all cores)
+INFERENCE_THREADS = int(os.environ.get('SCENTINEL_INFERENCE_THREADS', 0))
+
+# Size of the dummy tile used to build the TensorFlow graph before serving
+WARMUP_SHAPE = (256, 256)
+# Number of recent predictions kept for the steady-state latency figures
+LATENCY_WINDOW = 100
+
+
+def preload_imports(configs=None):
+    """Import the heavy libraries without loading any model.
+
+    Called in the gunicorn master so that the workers forked from it share
+    these pages copy-on-write instead of each importing them again. Only the
+    runtimes of the configured backends are imported.
+    """
+    import csbdeep.utils  # noqa: F401
+    import pandas  # noqa: F401
+    import scipy.ndimage  # noqa: F401
+    import stardist.geometry  # noqa: F401
+    import stardist.nms  # noqa: F401
+
+    backends = {config['backend'] for config in (configs or load_model_configs()).values()}
+    if 'tensorflow' in backends:
+        import stardist.models  # noqa: F401
+    if 'onnx' in backends:
+        import onnxruntime  # noqa: F401
+    if 'tflite' in backends:
+        try:
+            import tflite_runtime.interpreter  # noqa: F401
+        except ImportError:
+            import tensorflow.lite  # noqa: F401
+
+
+def load_model_configs(path=None):
+    """Return the model profiles, read from a JSON file when a path is given.
+
+    Every profile names its backend, so that the backend is part of the
+    result cache key.
+    """
+    path = path or os.environ.get('SCENTINEL_MODEL_CONFIG')
+    if path:
+        with open(path) as f:
+            configs = json.load(f)
+    else:
+        configs = MODEL_CONFIGS
+    return {name: {'backend': DEFAULT_BACKEND, **config} for name, config in configs.items()}
+
+
+class ModelNotReady(RuntimeError):
+    """Raised while the models are still loading or after loading failed"""
+
+
+class ModelRegistry:
+    """Loads the configured StarDist models once per worker and keeps them warm.
+
+    Every profile runs on its backend from the inference module, the
+    TensorFlow model as trained or an exported copy of its network.
+    """
+
+    def __init__(self, configs=None, default=DEFAULT_MODEL, warmup_shape=WARMUP_SHAPE, threads=INFERENCE_THREADS):
+        self.configs = dict(configs or load_model_configs())
+        self.default = default if default in self.configs else next(iter(self.configs))
+        self.warmup_shape = warmup_shape
+        self.threads = threads
+        self.error = None
+        self._weights = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        # Set once loading has ended, whether it succeeded or failed
+        self._finished = threading.Event()
+        self._started = None
+        self._ready_after = None
+
+    def start(self):
+        """Load all models in a background thread so the worker can answer health checks"""
+        thread = threading.Thread(target=self.load_all, name='model-loader', daemon=True)
+        thread.start()
+        return thread
+
+    def load_all(self):
+        self._started = time.perf_counter()
+        try:
+            for name in self.configs:
+                self.load(name)
+        except Exception as e:
+            self.error = f'{type(e).__name__}: {e}'
+            raise
+        else:
+            self._ready_after = time.perf_counter() - self._started
+            self._ready.set()
+        finally:
+            # Wake the waiters on failure too, they raise the load error instead of timing out
+            self._finished.set()
+
+    def load(self, name):
+        config = self.configs[name]
+        key = self._weights_key(config)
+
+        # Weight loading and graph setup, paid once per worker
+        start = time.perf_counter()
+        model = self._weights.get(key)
+        if model is None:
+            model = load_backend(config, self.threads)
+            self._weights[key] = model
+        load_seconds = time.perf_counter() - start
+
+        # The first predict call traces the graph, do it on a dummy tile
+        start = time.perf_counter()
+        model.predict_instances(np.zeros(self.warmup_shape, dtype=np.float32),
+                                nms_thresh=config['nms_thresh'], prob_thresh=config['prob_thresh'])
+        warmup_seconds = time.perf_counter() - start
+
+        with self._lock:
+            self._stats[name] = {
+                'load_seconds': load_seconds,
+                'warmup_seconds': warmup_seconds,
+                'predictions': 0,
+                'latencies': deque(maxlen=LATENCY_WINDOW),
+            }
+        return model
+
+    @staticmethod
+    def _weights_key(config):
+        source = (config['basedir'], config['name']) if config.get('basedir') else config['pretrained']
+        return (config.get('backend', 'tensorflow'), config.get('export'), bool(config.get('quantize')), source)
+
+    @property
+    def ready(self):
+        return self._ready.is_set()
+
+    def wait(self, timeout=None):
+        """Block until the models are loaded, raise as soon as loading failed or on timeout"""
+        self._finished.wait(timeout)
+        if self.error:
+            raise ModelNotReady(self.error)
+        if not self._ready.is_set():
+            raise ModelNotReady('Models are still loading')
+
+    def get(self, name=None, timeout=None):
+        """Return the (backend, config) pair for a profile name"""
+        name = name or self.default
+        if name not in self.configs:
+            raise KeyError(name)
+        self.wait(timeout)
+        config = self.configs[name]
+        return self._weights[self._weights_key(config)], config
+
+    def predict(self, image, name=None, timeout=None, **kwargs):
+        """Run predict_instances of the profile's backend with the thresholds of the profile"""
+        name = name or self.default
+        model, config = self.get(name, timeout)
+        params = {'nms_thresh': config['nms_thresh'], 'prob_thresh': config['prob_thresh']}
+        params.update(kwargs)
+
+        start = time.perf_counter()
+        labels, details = model.predict_instances(image, **params)
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            stats = self._stats[name]
+            stats['predictions'] += 1
+            stats['latencies'].append(elapsed)
+        return labels, details
+
+    def predict_batch(self, images, name=None, timeout=None, batch_size=8):
+        """Segment several normalized images with shared TensorFlow calls.
+
+        Images are sorted by size, reflect-padded to a common shape that the
+        U-Net accepts and run through the backend's network batch_size at a
+        time. The StarDist NMS then runs on each cropped output. Returns the
+        label images in input order.
+        """
+        name = name or self.default
+        model, config = self.get(name, timeout)
+        div_by = model.div_by
+        grid = model.grid
+
+        start = time.perf_counter()
+        results = [None] * len(images)
+        order = sorted(range(len(images)), key=lambda i: images[i].shape)
+        for chunk_start in range(0, len(order), batch_size):
+            chunk = order[chunk_start:chunk_start + batch_size]
+            shape = [max(images[i].shape[axis] for i in chunk) for axis in (0, 1)]
+            shape = [-(-size // d) * d for size, d in zip(shape, div_by)]
+
+            batch = np.stack([
+                np.pad(images[i], [(0, shape[0] - images[i].shape[0]), (0, shape[1] - images[i].shape[1])],
+                       mode='reflect')
+                for i in chunk
+            ])[..., np.newaxis].astype(np.float32, copy=False)
+            prob, dist = model.network(batch)
+
+            for j, i in enumerate(chunk):
+                h, w = images[i].shape
+                crop = (slice(0, -(-h // grid[0])), slice(0, -(-w // grid[1])))
+                results[i] = model.instances(images[i].shape, prob[j][crop][..., 0], dist[j][crop],
+                                             prob_thresh=config['prob_thresh'], nms_thresh=config['nms_thresh'])
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            stats = self._stats[name]
+            stats['predictions'] += len(images)
+            if images:
+                stats['latencies'].append(elapsed / len(images))
+        return results
+
+    def status(self):
+        """Readiness plus cold start and steady-state latency per model"""
+        models = {}
+        with self._lock:
+            for name, stats in self._stats.items():
+                latencies = sorted(stats['latencies'])
+                models[name] = {
+                    'backend': self.configs[name].get('backend', 'tensorflow'),
+                    'cold_start_seconds': {
+                        'load': round(stats['load_seconds'], 4),
+                        'warmup': round(stats['warmup_seconds'], 4),
+                    },
+                    'predictions': stats['predictions'],
+                    'steady_state_seconds': {
+                        'mean': round(float(np.mean(latencies)), 4) if latencies else None,
+                        'p50': round(latencies[len(latencies) // 2], 4) if latencies else None,
+                        'p95': round(latencies[int(len(latencies) * 0.95)], 4) if latencies else None,
+                    },
+                }
+        if self.error:
+            status = 'error'
+        elif self.ready:
+            status = 'ready'
+        else:
+            status = 'loading'
+        return {
+            'status': status,
+            'error': self.error,
+            'default_model': self.default,
+            'ready_after_seconds': round(self._ready_after, 4) if self._ready_after else None,
+            'models': models,
+        }
@@ -0,0 +1,214 @@
+import os
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+# How objects are drawn on the processed image: 'contour' outlines every
+# object, 'fill' also tints it with a colour of its own
+OVERLAY_STYLE = os.environ.get('SCENTINEL_OVERLAY', 'contour')
+OVERLAY_ALPHA = 0.35
+CONTOUR_COLOR = (255, 255, 255)
+GLYPH_COLOR = (0, 255, 255)
+FONT = cv2.FONT_HERSHEY_SIMPLEX
+# Digits are rasterized once per font size, sizes are rounded to multiples of GLYPH_STEP pixels
+GLYPH_STEP = 4
+# Outline thickness in pixels at the working width, outlines of wider full
+# resolution images are drawn at that width and scaled up
+CONTOUR_THICKNESS = 2
+
+# Encoding of the processed image and of its preview, a small copy the app shows first.
+# Progressive JPEGs are about 10% smaller but several times slower to encode, WebP
+# smaller still and slower again
+IMAGE_FORMAT = os.environ.get('SCENTINEL_IMAGE_FORMAT', 'jpeg')
+IMAGE_QUALITY = int(os.environ.get('SCENTINEL_IMAGE_QUALITY', 90))
+PROGRESSIVE = os.environ.get('SCENTINEL_IMAGE_PROGRESSIVE', '0') == '1'
+PREVIEW_WIDTH = int(os.environ.get('SCENTINEL_PREVIEW_WIDTH', 320))
+PREVIEW_QUALITY = int(os.environ.get('SCENTINEL_PREVIEW_QUALITY', 60))
+
+# format name: file extension, mimetype
+FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg'),
+    'webp': ('.webp', 'image/webp'),
+    'png': ('.png', 'image/png'),
+}
+if IMAGE_FORMAT not in FORMATS:
+    raise ValueError(f'Unknown image format {IMAGE_FORMAT!r}, expected one of {tuple(FORMATS)}')
+
+
+def rendering_params():
+    """Parameters that shape the processed image bytes, part of every result cache key"""
+    return {
+        'style': OVERLAY_STYLE,
+        'format': IMAGE_FORMAT,
+        'quality': IMAGE_QUALITY,
+        'progressive': PROGRESSIVE,
+        'preview_width': PREVIEW_WIDTH,
+        'preview_quality': PREVIEW_QUALITY,
+    }
+
+
+def preview_format():
+    # A lossless preview would defeat its purpose
+    return 'jpeg' if IMAGE_FORMAT == 'png' else IMAGE_FORMAT
+
+
+def mimetype(name):
+    """Mimetype of a processed image from its file name"""
+    extension = os.path.splitext(name)[1].lower()
+    for format_extension, format_mimetype in FORMATS.values():
+        if extension == format_extension:
+            return format_mimetype
+    return 'application/octet-stream'
+
+
+@lru_cache(maxsize=1)
+def palette():
+    """256 BGR colours for cv2.applyColorMap, labels pick colour label % 256"""
+    # Golden ratio steps around the hue circle keep consecutive labels apart
+    hues = (np.arange(256) * 0.618033988749895 % 1.0 * 180).astype(np.uint8)
+    hsv = np.stack([hues, np.full_like(hues, 200), np.full_like(hues, 255)], axis=-1)[:, np.newaxis]
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+
+
+def boundaries(labels, thickness=1):
+    """uint8 mask, non-zero on the object pixels within thickness of the background or a lower label.
+
+    Comparing the labels with their erosion finds both in one pass; where two
+    objects touch, the outline is drawn on the side of the higher label.
+    """
+    # Morphology runs on uint16 or float32, both hold label numbers exactly
+    labels = labels.astype(np.uint16 if labels.max() < 2 ** 16 else np.float32, copy=False)
+    kernel = np.ones((2 * thickness + 1, 2 * thickness + 1), np.uint8)
+    return cv2.compare(labels, cv2.erode(labels, kernel), cv2.CMP_NE)
+
+
+@lru_cache(maxsize=64)
+def digit_glyphs(size):
+    """Rasterized digits 0-9 at a font size, drawn once and reused for every object number.
+
+    Returns the (rows, cols) pixel offsets of each digit, rows about the text
+    centre line and cols from the left edge of its cell, and the cell width.
+    """
+    font_scale = size / 30
+    thickness = max(1, size // 8)
+    sizes = [cv2.getTextSize(str(digit), FONT, font_scale, thickness) for digit in range(10)]
+    advance = max(width for (width, _), _ in sizes)
+    height = max(height for (_, height), _ in sizes)
+    glyphs = []
+    for digit in range(10):
+        canvas = np.zeros((height + 2 * thickness, advance + 2 * thickness), np.uint8)
+        cv2.putText(canvas, str(digit), (thickness, height + thickness), FONT, font_scale, 255, thickness)
+        rows, cols = np.nonzero(canvas)
+        glyphs.append((rows - canvas.shape[0] // 2, cols - thickness))
+    return glyphs, advance
+
+
+def number_pixels(numbers, centers_y, centers_x, sizes):
+    """Rows and columns of the pixels of every object number, centred on its object.
+
+    Objects are grouped by font size, digit position and digit, so the loops
+    run over those few groups and never over the objects themselves.
+    """
+    digits = np.floor(np.log10(np.maximum(numbers, 1))).astype(np.int64) + 1
+    rows, cols = [], []
+    for size in np.unique(sizes):
+        glyphs, advance = digit_glyphs(int(size))
+        in_size = sizes == size
+        left = centers_x - digits * advance // 2
+        for position in range(int(digits[in_size].max())):
+            digit = numbers // 10 ** np.maximum(digits - 1 - position, 0) % 10
+            for value in range(10):
+                selected = in_size & (digits > position) & (digit == value)
+                if not selected.any():
+                    continue
+                glyph_rows, glyph_cols = glyphs[value]
+                rows.append((centers_y[selected, np.newaxis] + glyph_rows).ravel())
+                cols.append((left[selected, np.newaxis] + position * advance + glyph_cols).ravel())
+    if not rows:
+        return np.empty(0, np.int64), np.empty(0, np.int64)
+    return np.concatenate(rows), np.concatenate(cols)
+
+
+def render(image, labels, measurements, working_width, style=None):
+    """Draw the objects of the label image and their numbers over a copy of the image.
+
+    Outlines (and the tint with style 'fill') come from the label image in
+    a few whole-image operations, whatever the number of objects. Images
+    wider than working_width get them from labels scaled down to it, the
+    masks are scaled back up. Numbers are composed from cached digit
+    glyphs and scattered into the image at once.
+    """
+    style = style or OVERLAY_STYLE
+    if style not in ('contour', 'fill'):
+        raise ValueError(f'Unknown overlay style {style!r}')
+    labels = np.asarray(labels)
+    height, width = image.shape[:2]
+    scale = max(1.0, width / working_width)
+    if scale > 1:
+        # Morphology on full resolution labels costs more than the rest of the overlay together
+        size = (working_width, max(1, int(round(height / scale))))
+        labels = cv2.resize(labels.astype(np.int32, copy=False), size, interpolation=cv2.INTER_NEAREST)
+
+    def full_size(mask, interpolation=cv2.INTER_NEAREST):
+        return mask if scale == 1 else cv2.resize(mask, (width, height), interpolation=interpolation)
+
+    outline = boundaries(labels, thickness=CONTOUR_THICKNESS)
+    if scale > 1:
+        # Interpolating and thresholding the mask rounds off the steps of the smaller grid
+        background = cv2.compare(full_size(outline, cv2.INTER_LINEAR), 127, cv2.CMP_LE)
+    else:
+        background = cv2.bitwise_not(outline)
+
+    if style == 'fill':
+        # uint8 wraps the label numbers around the 256 palette colours
+        tint = full_size(cv2.applyColorMap(labels.astype(np.uint8), palette()))
+        blend = cv2.addWeighted(image, 1 - OVERLAY_ALPHA, tint, OVERLAY_ALPHA, 0)
+        # Only the objects are tinted
+        image = cv2.copyTo(image, full_size((labels == 0).view(np.uint8)), blend)
+    # Filling the output with the outline colour and copying the image around the outlines
+    # beats copying the image and painting over it, and numpy's broadcast fill is slower still
+    output = np.empty_like(image)
+    cv2.rectangle(output, (0, 0), (width, height), CONTOUR_COLOR, -1)
+    cv2.copyTo(image, background, output)
+    image = output
+
+    if len(measurements):
+        # The font grows with the object like before, rounded so that sizes share glyphs
+        radius = ((measurements['BBox_X2'] - measurements['BBox_X1'] + measurements['BBox_Y2']
+                   - measurements['BBox_Y1']) / 4).to_numpy()
+        sizes = np.maximum(np.round(radius / GLYPH_STEP), 1).astype(np.int64) * GLYPH_STEP
+        rows, cols = number_pixels(measurements['Object'].to_numpy(np.int64),
+                                   np.round(measurements['Centroid_Y'].to_numpy()).astype(np.int64),
+                                   np.round(measurements['Centroid_X'].to_numpy()).astype(np.int64), sizes)
+        inside = (rows >= 0) & (rows < image.shape[0]) & (cols >= 0) & (cols < image.shape[1])
+        # Scatter into the flat pixel buffer one channel at a time, numbers cover few pixels
+        index = (rows[inside] * image.shape[1] + cols[inside]) * 3
+        flat = image.reshape(-1)
+        for channel, value in enumerate(GLYPH_COLOR):
+            flat[index + channel] = value
+    return image
+
+
+def encode_image(image, image_format='jpeg', quality=None, progressive=False):
+    """Encode an image to bytes, quality applies to JPEG and WebP"""
+    extension = FORMATS[image_format][0]
+    params = []
+    if image_format == 'jpeg':
+        params = [cv2.IMWRITE_JPEG_QUALITY, 95 if quality is None else quality, cv2.IMWRITE_JPEG_PROGRESSIVE, int(progressive)]
+    elif image_format == 'webp':
+        params = [cv2.IMWRITE_WEBP_QUALITY, 90 if quality is None else quality]
+    ok, buffer = cv2.imencode(extension, image, params)
+    if not ok:
+        raise ValueError(f'Could not encode image as {image_format}')
+    return buffer.tobytes()
+
+
+def encode_variants(image):
+    """The processed image and its preview, encoded with the configured settings"""
+    encoded = encode_image(image, IMAGE_FORMAT, IMAGE_QUALITY, PROGRESSIVE)
+    preview = image
+    if image.shape[1] > PREVIEW_WIDTH:
+        height = max(1, int(round(image.shape[0] * PREVIEW_WIDTH / image.shape[1])))
+        preview = cv2.resize(image, (PREVIEW_WIDTH, height), interpolation=cv2.INTER_AREA)
+    return encoded, encode_image(preview, preview_format(), PREVIEW_QUALITY)
@@ -0,0 +1,242 @@
+from contextlib import nullcontext
+
+import cv2
+import numpy as np
+
+import overlay
+
+# pandas, scipy and csbdeep are imported where they are used, so that the
+# server process starts without paying for them
+
+TABLE_COLUMNS = ['Object', 'Area', 'Signal', 'Signal/Unit_Area']
+
+# Images larger than MAX_DIMENSION on either side are cut down to TARGET_WIDTH
+MAX_DIMENSION = 1000
+TARGET_WIDTH = 800
+
+# Stages of the pipeline in order, as reported by analyze's timer
+STAGES = ('decode', 'resize', 'grayscale', 'normalize', 'predict', 'measure', 'annotate', 'encode')
+
+# Full resolution analysis: largest accepted image, and the model input is
+# predicted in tiles of at most TILE_SIZE pixels on a side
+MAX_PIXELS = 50 * 1000 * 1000
+TILE_SIZE = 1024
+
+# Contrast stretch and normalization percentiles applied before segmentation
+BRIGHTNESS = 1.5
+CONTRAST = 2
+NORMALIZE_PERCENTILES = (1, 99.8)
+
+
+def image_resize(image, width = None, height = None, inter = cv2.INTER_AREA):
+    # initialize the dimensions of the image to be resized and grab the image size
+    dim = None
+    (h, w) = image.shape[:2]
+
+    # if both the width and height are None, then return the original image
+    if width is None and height is None:
+        return image
+
+    # check to see if the width is None
+    if width is None:
+        # calculate the ratio of the height and construct the
+        # dimensions
+        r = height / float(h)
+        dim = (int(w * r), height)
+
+    # otherwise, the height is None
+    else:
+        # calculate the ratio of the width and construct the dimensions
+        r = width / float(w)
+        dim = (width, int(h * r))
+
+    # resize the image
+    resized = cv2.resize(image, dim, interpolation = inter)
+
+    # return the resized image
+    return resized
+
+
+def decode_image(data):
+    """Decode uploaded image bytes to a BGR array, None if they are not an image"""
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+
+
+class ImageTooLarge(ValueError):
+    """Raised for full resolution images above MAX_PIXELS"""
+
+
+def prepare_image(image, full_resolution=False):
+    """Rotate narrow images and cut large ones down to the working resolution.
+
+    With full_resolution the image keeps its size, up to MAX_PIXELS.
+    """
+    # Rotate the image if it is in landscape mode
+    if image.shape[1] < 200:
+        image = cv2.rotate(image, cv2.ROTATE_90_CLOCKWISE)
+
+    if full_resolution:
+        if image.shape[0] * image.shape[1] > MAX_PIXELS:
+            raise ImageTooLarge(f'Images above {MAX_PIXELS / 1e6:.0f} megapixels cannot be analysed at full resolution.')
+    elif image.shape[0] > MAX_DIMENSION or image.shape[1] > MAX_DIMENSION:
+        image = image_resize(image, width=TARGET_WIDTH, height=TARGET_WIDTH)
+    return image
+
+
+def model_options(shape, full_resolution=False, scale=None, tile_size=TILE_SIZE):
+    """Keyword arguments for predict_instances.
+
+    At full resolution the model input is scaled so that wells have the size
+    they have at the working resolution, while the labels come back at full
+    size. n_tiles keeps every tile of model input within tile_size, so the
+    network's memory use depends on the tile size and not on the image size.
+    """
+    if scale is None:
+        scale = min(1.0, TARGET_WIDTH / float(shape[1])) if full_resolution else 1.0
+    n_tiles = tuple(max(1, -(-int(round(size * scale)) // tile_size)) for size in shape[:2])
+    options = {'n_tiles': n_tiles, 'show_tile_progress': False}
+    if scale != 1.0:
+        options['scale'] = scale
+    return options
+
+
+def enhance(image):
+    """Grayscale and contrast stretch a BGR image, the result is what the signal is measured on"""
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    # Adjusts the contrast by scaling the pixel values
+    return cv2.addWeighted(image, CONTRAST, np.zeros(image.shape, image.dtype), 0, BRIGHTNESS)
+
+
+def normalize_image(image):
+    """Percentile normalization of the enhanced image for StarDist"""
+    from csbdeep.utils import normalize
+
+    return normalize(image, *NORMALIZE_PERCENTILES, axis=None)
+
+
+def preprocess(image):
+    """Grayscale and contrast stretch a BGR image, then normalize it for StarDist.
+
+    Returns the contrast adjusted image used for measurement and the
+    normalized model input.
+    """
+    image = enhance(image)
+    return image, normalize_image(image)
+
+
+def preprocessing_params():
+    """Parameters of the preprocessing steps, part of every result cache key"""
+    return {
+        'max_dimension': MAX_DIMENSION,
+        'target_width': TARGET_WIDTH,
+        'brightness': BRIGHTNESS,
+        'contrast': CONTRAST,
+        'normalize_percentiles': NORMALIZE_PERCENTILES,
+    }
+
+
+def measure_objects(labels, intensity):
+    """Measure every labelled object in one pass over the label image.
+
+    Returns a DataFrame with one row per object, numbered 1..n in label order,
+    holding the area, summed and mean signal, centroid and bounding box.
+    """
+    import pandas as pd
+    from scipy import ndimage
+
+    labels = np.asarray(labels)
+    flat = labels.ravel()
+    n_bins = int(flat.max()) + 1 if flat.size else 1
+
+    # Pixel count and summed intensity of each label
+    area = np.bincount(flat, minlength=n_bins)
+    signal = np.bincount(flat, weights=np.asarray(intensity, dtype=np.float64).ravel(), minlength=n_bins)
+
+    # Centroids from the foreground pixel positions only
+    foreground = np.flatnonzero(flat)
+    rows, cols = np.divmod(foreground, labels.shape[1])
+    row_sum = np.bincount(flat[foreground], weights=rows, minlength=n_bins)
+    col_sum = np.bincount(flat[foreground], weights=cols, minlength=n_bins)
+
+    present = np.flatnonzero(area[1:]) + 1
+    slices = ndimage.find_objects(labels)
+    bbox = np.array([[s[0].start, s[1].start, s[0].stop, s[1].stop] for s in (slices[i - 1] for i in present)],
+                    dtype=np.int64).reshape(-1, 4)
+
+    area = area[present]
+    return pd.DataFrame({
+        'Object': np.arange(1, len(present) + 1),
+        'Label': present,
+        'Area': area,
+        'Signal': signal[present],
+        'Mean_Signal': signal[present] / np.maximum(area, 1),
+        'Centroid_Y': row_sum[present] / np.maximum(area, 1),
+        'Centroid_X': col_sum[present] / np.maximum(area, 1),
+        'BBox_Y1': bbox[:, 0],
+        'BBox_X1': bbox[:, 1],
+        'BBox_Y2': bbox[:, 2],
+        'BBox_X2': bbox[:, 3],
+    })
+
+
+def build_object_table(measurements):
+    """Turn object measurements into the relative change table sent to the client"""
+    import pandas as pd
+
+    object_table = measurements[['Object', 'Area', 'Signal']].copy()
+    if object_table.empty:
+        return pd.DataFrame(columns=TABLE_COLUMNS)
+
+    # Calculate difference in Signal for each object
+    max_area = object_table['Area'].max()
+    object_table['Signal'] = object_table['Signal'] / max_area
+    max_obj = object_table['Signal'].max()
+    object_table['Signal/Unit_Area'] = ((max_obj - object_table['Signal']) / max_obj) * 100
+
+    # Sort the table by Relative Percentage Change in ascending order
+    object_table = object_table.sort_values(by='Signal/Unit_Area', ascending=True)
+
+    #if want to include 0% change objects(as somtimes there are no objects with change)
+    return object_table[object_table['Signal/Unit_Area'] >= 0]
+
+
+def _untimed(stage):
+    return nullcontext()
+
+
+def quantify(image, blue_channel, labels, timer=None):
+    """Measure, tabulate and annotate a segmented image.
+
+    Returns the label image, the object table records, the encoded
+    processed image and its encoded preview.
+    """
+    timer = timer or _untimed
+    with timer('measure'):
+        measurements = measure_objects(labels, blue_channel)
+        object_table = build_object_table(measurements).to_dict(orient='records')
+
+    # Draw boundry around objects and label with numbers
+    with timer('annotate'):
+        processed_image = overlay.render(image, labels, measurements, TARGET_WIDTH)
+    with timer('encode'):
+        encoded, preview = overlay.encode_variants(processed_image)
+    return labels, object_table, encoded, preview
+
+
+def analyze(image, predict, full_resolution=False, scale=None, tile_size=TILE_SIZE, timer=None):
+    """Run the whole pipeline on a decoded BGR image.
+
+    predict maps the normalized model input and the predict_instances
+    keyword arguments to a label image. timer, if given, is called with each
+    stage name from STAGES and must return a context manager wrapping it.
+    """
+    timer = timer or _untimed
+    with timer('resize'):
+        image = prepare_image(image, full_resolution)
+    with timer('grayscale'):
+        blue_channel = enhance(image)
+    with timer('normalize'):
+        blue_channel_norm = normalize_image(blue_channel)
+    with timer('predict'):
+        labels = predict(blue_channel_norm, **model_options(image.shape, full_resolution, scale, tile_size))
+    return quantify(image, blue_channel, labels, timer)
@@ -0,0 +1,253 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import nullcontext
+
+import cv2
+import numpy as np
+
+from pipeline import enhance, measure_objects, prepare_image, quantify
+from timelapse import estimate_drift
+
+TEMPLATE_NAME = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# Images are registered on copies cut down to this width
+ALIGN_WIDTH = 400
+# ORB features per image and the RANSAC inliers needed to trust the feature match
+ORB_FEATURES = 1000
+MIN_MATCHES = 12
+# ECC refinement, and the correlation with the reference below which an alignment is rejected
+ECC_ITERATIONS = 50
+ECC_EPSILON = 1e-4
+MIN_CORRELATION = 0.4
+
+
+class AlignmentError(ValueError):
+    """Raised when an image cannot be registered to a plate template"""
+
+
+def reading_order(labels):
+    """Renumber the objects of a label image row by row, left to right.
+
+    Wells whose centres are less than half a well diameter apart vertically
+    are in the same row, so slightly tilted plates keep their rows.
+    """
+    measurements = measure_objects(labels, np.zeros(labels.shape))
+    if measurements.empty:
+        return np.zeros_like(labels)
+    cy = measurements['Centroid_Y'].to_numpy()
+    cx = measurements['Centroid_X'].to_numpy()
+    diameter = np.sqrt(4 * np.median(measurements['Area'].to_numpy()) / np.pi)
+
+    by_y = np.argsort(cy)
+    row = np.empty(len(cy), dtype=np.int64)
+    row[by_y] = np.cumsum(np.diff(cy[by_y], prepend=cy[by_y[0]]) > diameter / 2)
+    order = np.lexsort((cx, row))
+
+    lookup = np.zeros(int(labels.max()) + 1, dtype=np.int32)
+    lookup[measurements['Label'].to_numpy()[order]] = np.arange(1, len(order) + 1)
+    return lookup[labels]
+
+
+def _downscale(image):
+    scale = min(1.0, ALIGN_WIDTH / float(image.shape[1]))
+    if scale < 1.0:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    return image, scale
+
+
+def _orb_features(image):
+    return cv2.ORB_create(ORB_FEATURES).detectAndCompute(image, None)
+
+
+def _feature_warp(reference_features, image):
+    """Similarity transform from reference to image coordinates, None without enough matching features"""
+    reference_keypoints, reference_descriptors = reference_features
+    keypoints, descriptors = _orb_features(image)
+    if reference_descriptors is None or descriptors is None:
+        return None
+    matches = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=True).match(reference_descriptors, descriptors)
+    if len(matches) < MIN_MATCHES:
+        return None
+    source = np.float32([reference_keypoints[m.queryIdx].pt for m in matches])
+    target = np.float32([keypoints[m.trainIdx].pt for m in matches])
+    warp, inliers = cv2.estimateAffinePartial2D(source, target, method=cv2.RANSAC, ransacReprojThreshold=3.0)
+    if warp is None or int(inliers.sum()) < MIN_MATCHES:
+        return None
+    return warp
+
+
+def _shift_warp(reference, image):
+    """Stretch to the reference size plus the phase correlation shift, for plates without usable features"""
+    sy, sx = image.shape[0] / float(reference.shape[0]), image.shape[1] / float(reference.shape[1])
+    resized = cv2.resize(image, (reference.shape[1], reference.shape[0]), interpolation=cv2.INTER_AREA)
+    dy, dx = estimate_drift(reference, resized)
+    return np.array([[sx, 0, dx * sx], [0, sy, dy * sy]])
+
+
+class PlateTemplate:
+    """Well layout of a plate.
+
+    labels holds the wells numbered in reading order at the working
+    resolution, reference is the contrast adjusted image they were found on.
+    Images are aligned to the reference and measured inside the labels, so a
+    well keeps its number on every image.
+    """
+
+    def __init__(self, name, labels, reference, meta=None):
+        self.name = name
+        self.labels = labels
+        self.reference = reference
+        self.meta = meta or {}
+        self.wells = int(labels.max())
+        self.key = hashlib.sha256(labels.tobytes() + reference.tobytes()).hexdigest()[:16]
+        self._small_reference, self._reference_scale = _downscale(reference)
+        self._reference_features = _orb_features(self._small_reference)
+
+    @classmethod
+    def from_segmentation(cls, name, image, labels, meta=None):
+        """Template from a prepared BGR image and its label image"""
+        meta = dict(meta or {}, created=time.time())
+        return cls(name, reading_order(labels), enhance(image), meta)
+
+    def align(self, intensity):
+        """Find the affine warp from template to image coordinates.
+
+        ORB features give a first estimate, the phase correlation shift when
+        there are too few, and ECC refines it. Returns the 2x3 warp, the
+        method and the correlation of the aligned image with the reference.
+        """
+        small, scale = _downscale(intensity)
+        warp = _feature_warp(self._reference_features, small)
+        method = 'orb'
+        if warp is None:
+            warp = _shift_warp(self._small_reference, small)
+            method = 'shift'
+
+        criteria = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, ECC_ITERATIONS, ECC_EPSILON)
+        try:
+            _, refined = cv2.findTransformECC(self._small_reference.astype(np.float32), small.astype(np.float32),
+                                              warp.astype(np.float32), cv2.MOTION_AFFINE, criteria, None, 5)
+            warp = refined
+            method += '+ecc'
+        except cv2.error:
+            pass
+
+        aligned = cv2.warpAffine(small, warp, self._small_reference.shape[::-1],
+                                 flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+        correlation = float(np.corrcoef(aligned.ravel(), self._small_reference.ravel())[0, 1])
+        if not correlation >= MIN_CORRELATION:
+            raise AlignmentError(f'The image does not match plate template {self.name!r} '
+                                 f'(correlation {correlation:.2f}).')
+
+        # Back from the downscaled copies to full size coordinates
+        warp = np.asarray(warp, dtype=np.float64)
+        warp[:, :2] *= self._reference_scale / scale
+        warp[:, 2] /= scale
+        return warp, method, correlation
+
+    def warp(self, image, warp):
+        """Resample an image onto the template's pixel grid"""
+        return cv2.warpAffine(image, warp, self.labels.shape[::-1], flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP)
+
+    def describe(self):
+        measurements = measure_objects(self.labels, np.zeros(self.labels.shape))
+        return {
+            'name': self.name,
+            'key': self.key,
+            'wells': self.wells,
+            'shape': list(self.labels.shape),
+            'meta': self.meta,
+            'layout': [{'well': int(row.Label), 'area': int(row.Area),
+                        'centroid': [round(float(row.Centroid_X), 2), round(float(row.Centroid_Y), 2)]}
+                       for row in measurements.itertuples()],
+        }
+
+
+def analyze_with_template(image, template, timer=None):
+    """Measure a decoded BGR image inside the wells of a plate template.
+
+    Takes the place of pipeline.analyze: the image is aligned to the
+    template instead of segmented. Returns the same (labels, object table
+    records, encoded image, encoded preview) plus the alignment details.
+    """
+    timer = timer or (lambda stage: nullcontext())
+    with timer('resize'):
+        image = prepare_image(image)
+    with timer('grayscale'):
+        intensity = enhance(image)
+    with timer('align'):
+        warp, method, correlation = template.align(intensity)
+        image = template.warp(image, warp)
+        intensity = template.warp(intensity, warp)
+    alignment = {'method': method, 'correlation': round(correlation, 4)}
+    return quantify(image, intensity, template.labels, timer), alignment
+
+
+class TemplateStore:
+    """Plate templates by name, saved to a folder so every server process sees them"""
+
+    def __init__(self, folder):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def check_name(name):
+        if not TEMPLATE_NAME.match(name):
+            raise ValueError('Template names may only contain letters, digits, - and _ (at most 64).')
+
+    def _path(self, name):
+        self.check_name(name)
+        return os.path.join(self.folder, name + '.npz')
+
+    def put(self, template):
+        path = self._path(template.name)
+        # A unique temporary file, so processes registering the same name at once do not write into each other
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, labels=template.labels, reference=template.reference,
+                                meta=np.array(json.dumps(template.meta)))
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._templates[template.name] = (os.path.getmtime(path), template)
+
+    def get(self, name):
+        """Return the template of that name, None if there is none"""
+        path = self._path(name)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            with self._lock:
+                self._templates.pop(name, None)
+            return None
+        with self._lock:
+            cached = self._templates.get(name)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        # Registered or replaced by another process
+        with np.load(path) as f:
+            template = PlateTemplate(name, f['labels'], f['reference'], json.loads(str(f['meta'])))
+        with self._lock:
+            self._templates[name] = (mtime, template)
+        return template
+
+    def delete(self, name):
+        """Remove a template, return whether it existed"""
+        path = self._path(name)
+        with self._lock:
+            self._templates.pop(name, None)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def names(self):
+        return sorted(os.path.splitext(name)[0] for name in os.listdir(self.folder) if name.endswith('.npz'))
@@ -0,0 +1,140 @@
+import json
+
+import numpy as np
+
+from pipeline import TABLE_COLUMNS
+
+# Response formats in order of preference for clients that accept several.
+# msgpack and pyarrow are optional, a format is only offered when its
+# library is installed.
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+ARROW = 'application/vnd.apache.arrow.stream'
+
+COLUMN_DTYPES = {'Object': np.int32, 'Area': np.int64, 'Signal': np.float64, 'Signal/Unit_Area': np.float64}
+
+
+def _importable(module):
+    try:
+        __import__(module)
+    except ImportError:
+        return False
+    return True
+
+
+def available_formats(single=True):
+    """Mimetypes that can be produced, Arrow only holds single results"""
+    formats = [JSON]
+    if _importable('msgpack'):
+        formats.append(MSGPACK)
+    if single and _importable('pyarrow'):
+        formats.append(ARROW)
+    return formats
+
+
+def negotiate(accept, single=True):
+    """Best response mimetype for an Accept header, JSON when the client does not ask for another"""
+    return accept.best_match(available_formats(single), default=JSON)
+
+
+def rle_encode(labels):
+    """Run-length encode a label image in row-major order.
+
+    Returns the shape plus the value and length of every run, each in the
+    smallest unsigned type that holds them. Plate label images are mostly
+    background, so this is a small fraction of the raw mask.
+    """
+    flat = np.asarray(labels).ravel()
+    if flat.size == 0:
+        return {'shape': list(labels.shape), 'values': np.empty(0, np.uint8), 'lengths': np.empty(0, np.uint8)}
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(flat)) + 1))
+    lengths = np.diff(np.concatenate((starts, [flat.size])))
+    values = flat[starts]
+    return {'shape': list(labels.shape), 'values': values.astype(np.min_scalar_type(int(values.max()))),
+            'lengths': lengths.astype(np.min_scalar_type(int(lengths.max())))}
+
+
+def rle_decode(rle):
+    """Label image back from rle_encode's output"""
+    return np.repeat(np.asarray(rle['values']), np.asarray(rle['lengths'])).reshape(rle['shape'])
+
+
+def table_columns(records):
+    """Object table records as one typed array per column"""
+    return {column: np.fromiter((row[column] for row in records), dtype=COLUMN_DTYPES[column], count=len(records))
+            for column in TABLE_COLUMNS}
+
+
+def compact(payload, labels=None):
+    """Copy of a JSON result payload with the object table as columns and the RLE label mask"""
+    payload = dict(payload)
+    if 'object_table' in payload:
+        payload['object_table'] = table_columns(payload['object_table'])
+    if labels is not None:
+        payload['labels'] = rle_encode(labels)
+    return payload
+
+
+def _pack_array(value):
+    if isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        return {'__ndarray__': True, 'dtype': value.dtype.str, 'shape': list(value.shape), 'data': value.tobytes()}
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Cannot serialize {type(value).__name__}')
+
+
+def encode_msgpack(payload):
+    """msgpack envelope, numpy arrays become raw little-endian buffers with their dtype and shape"""
+    import msgpack
+
+    return msgpack.packb(payload, default=_pack_array, use_bin_type=True)
+
+
+def decode_msgpack(data):
+    """Inverse of encode_msgpack, arrays are read-only views on the message without a copy"""
+    import msgpack
+
+    def unpack_array(value):
+        if value.get('__ndarray__'):
+            return np.frombuffer(value['data'], dtype=np.dtype(value['dtype'])).reshape(value['shape'])
+        return value
+
+    return msgpack.unpackb(data, raw=False, object_hook=unpack_array)
+
+
+def encode_arrow(payload):
+    """Arrow IPC stream holding the object table.
+
+    The other fields of the payload go into the schema metadata, as JSON
+    under b'result', and the label runs as raw little-endian buffers whose
+    shape and dtypes are under b'labels'.
+    """
+    import pyarrow as pa
+
+    payload = dict(payload)
+    columns = payload.pop('object_table')
+    metadata = {}
+    labels = payload.pop('labels', None)
+    if labels is not None:
+        values = labels['values'].astype(labels['values'].dtype.newbyteorder('<'))
+        lengths = labels['lengths'].astype(labels['lengths'].dtype.newbyteorder('<'))
+        metadata[b'labels'] = json.dumps({'shape': labels['shape'], 'values': values.dtype.str,
+                                          'lengths': lengths.dtype.str}).encode()
+        metadata[b'labels.values'] = values.tobytes()
+        metadata[b'labels.lengths'] = lengths.tobytes()
+    metadata[b'result'] = json.dumps(payload).encode()
+
+    table = pa.table({column: pa.array(values) for column, values in columns.items()}).replace_schema_metadata(metadata)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def encode(payload, mimetype):
+    if mimetype == MSGPACK:
+        return encode_msgpack(payload)
+    if mimetype == ARROW:
+        return encode_arrow(payload)
+    raise ValueError(f'Unsupported response format {mimetype}')
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+from collections import OrderedDict
+
+import numpy as np
+
+
+class ResultCache:
+    """Content-addressed cache of segmentation results.
+
+    Entries are keyed by a hash of the image bytes and the parameters that
+    affect the result, and hold the label image, the object table records,
+    the encoded processed image and its preview. The memory tier is size
+    bounded with LRU eviction; the optional disk tier keeps entries across
+    restarts. Its size is tracked as entries are written, the folder is
+    only scanned once at the first write and again when it goes over quota.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, disk_folder=None, max_disk_bytes=2 * 1024 ** 3):
+        self.max_bytes = max_bytes
+        self.disk_folder = disk_folder
+        self.max_disk_bytes = max_disk_bytes
+        self.total_bytes = 0
+        # Bytes in the disk tier, None until the folder has been scanned
+        self.disk_bytes = None
+        self.counters = {'hits': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0}
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if disk_folder:
+            os.makedirs(disk_folder, exist_ok=True)
+
+    @staticmethod
+    def make_key(data, **params):
+        """Hash the image bytes together with the parameters that shape the result"""
+        digest = hashlib.sha256(data)
+        digest.update(json.dumps(params, sort_keys=True, default=str).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached entry for a key, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.counters['hits'] += 1
+                self.counters['memory_hits'] += 1
+                return entry
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            self.counters['hits'] += 1
+            self.counters['disk_hits'] += 1
+            self._insert(key, entry)
+        return entry
+
+    def put(self, key, labels, object_table, processed_image, preview=None):
+        """Cache a result; object_table is the list of records sent to the client"""
+        entry = {'labels': labels, 'object_table': object_table, 'processed_image': processed_image,
+                 'preview': preview}
+        with self._lock:
+            self._insert(key, entry)
+        self._write_disk(key, entry)
+        return entry
+
+    def _insert(self, key, entry):
+        if key in self._entries:
+            self.total_bytes -= self._size(self._entries.pop(key))
+        self._entries[key] = entry
+        self.total_bytes += self._size(entry)
+        while len(self._entries) > 1 and self.total_bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.total_bytes -= self._size(evicted)
+            self.counters['evictions'] += 1
+
+    @staticmethod
+    def _size(entry):
+        return (entry['labels'].nbytes + len(entry['processed_image']) + len(entry['preview'] or b'')
+                + 64 * len(entry['object_table']))
+
+    def _path(self, key):
+        return os.path.join(self.disk_folder, key + '.npz')
+
+    def _read_disk(self, key):
+        if not self.disk_folder or not os.path.exists(self._path(key)):
+            return None
+        try:
+            with np.load(self._path(key), allow_pickle=False) as f:
+                entry = {
+                    'labels': f['labels'],
+                    'object_table': json.loads(str(f['object_table'])),
+                    'processed_image': f['processed_image'].tobytes(),
+                    # Entries written before previews existed have none
+                    'preview': f['preview'].tobytes() if 'preview' in f.files else None,
+                }
+        except (OSError, ValueError, KeyError):
+            return None
+        # Touch the file so that disk eviction is least recently used as well
+        try:
+            os.utime(self._path(key))
+        except FileNotFoundError:
+            # Evicted since it was read
+            pass
+        return entry
+
+    def _write_disk(self, key, entry):
+        if not self.disk_folder:
+            return
+        # Write to a unique temporary file so a crash never leaves a partial entry and
+        # concurrent writers of the same key never move each other's file away
+        path = self._path(key)
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        arrays = {'labels': entry['labels'], 'object_table': np.array(json.dumps(entry['object_table'])),
+                  'processed_image': np.frombuffer(entry['processed_image'], np.uint8)}
+        if entry['preview'] is not None:
+            arrays['preview'] = np.frombuffer(entry['preview'], np.uint8)
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **arrays)
+        size = os.path.getsize(tmp_path)
+        try:
+            replaced = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced = 0
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            if self.disk_bytes is not None:
+                self.disk_bytes += size - replaced
+            scan = self.disk_bytes is None or self.disk_bytes > self.max_disk_bytes
+        if scan:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """Remove the least recently used entries until the disk tier fits, and recount its bytes"""
+        files = []
+        with os.scandir(self.disk_folder) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.npz'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        with self._lock:
+            self.disk_bytes = total
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self.total_bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else None
+        stats['disk_tier'] = bool(self.disk_folder)
+        stats['disk_bytes'] = self.disk_bytes
+        return stats
@@ -0,0 +1,139 @@
+import hashlib
+import os
+import re
+import threading
+import time
+import uuid
+
+# Names the store hands out: a hex digest, an optional suffix and an extension
+STORED_NAME = re.compile(r'^[0-9a-f]{16,64}(_[A-Za-z0-9-]+)?\.[A-Za-z0-9]{1,5}$')
+EXTENSION = re.compile(r'^\.[A-Za-z0-9]{1,5}$')
+# Temporary files older than this are leftovers of crashed writers
+TMP_MAX_AGE = 3600
+
+
+class FileStore:
+    """Folder of content-addressed files kept within a size and age quota.
+
+    Files are named after the SHA-256 of their bytes unless the caller
+    passes a name, so concurrent uploads never overwrite each other and
+    storing the same bytes twice writes them once. A background thread
+    removes files older than max_age seconds and then the oldest files until
+    the folder is below max_bytes. Several processes may share a folder.
+    """
+
+    def __init__(self, folder, max_bytes=1024 ** 3, max_age=7 * 24 * 3600, evict_interval=60):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.evict_interval = evict_interval
+        self.counters = {'writes': 0, 'deduplicated': 0, 'evicted': 0, 'evicted_bytes': 0}
+        self._total_bytes = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        os.makedirs(folder, exist_ok=True)
+
+    @staticmethod
+    def content_name(data, extension):
+        """SHA-256 of the bytes plus the extension, .bin for extensions the store does not accept"""
+        return hashlib.sha256(data).hexdigest() + (extension if EXTENSION.match(extension) else '.bin')
+
+    def put(self, data, extension='.bin', name=None):
+        """Store bytes and return their file name"""
+        name = name or self.content_name(data, extension)
+        path = self.path(name, must_exist=False)
+        if os.path.exists(path):
+            # Same name, same bytes: refresh the age instead of writing again
+            os.utime(path)
+            with self._lock:
+                self.counters['deduplicated'] += 1
+            return name
+
+        # Write to a unique temporary file so a crash or a concurrent writer never leaves a partial file
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.counters['writes'] += 1
+            if self._total_bytes is not None:
+                self._total_bytes += len(data)
+                if self._total_bytes > self.max_bytes:
+                    self._wake.set()
+        return name
+
+    def path(self, name, must_exist=True):
+        """Absolute path of a stored file, None for names the store does not hand out or missing files"""
+        if not STORED_NAME.match(name):
+            if must_exist:
+                return None
+            raise ValueError(f'Invalid stored file name {name!r}')
+        path = os.path.join(self.folder, name)
+        if must_exist and not os.path.isfile(path):
+            return None
+        return path
+
+    def evict(self, now=None):
+        """Remove expired files, then the oldest ones until the folder fits max_bytes"""
+        now = now or time.time()
+        files = []
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.is_file():
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in files)
+        evicted = evicted_bytes = 0
+        for mtime, size, path in sorted(files):
+            # Temporary files may still be written to, so they only go once they are past TMP_MAX_AGE
+            temporary = path.endswith('.tmp')
+            expired = now - mtime > (TMP_MAX_AGE if temporary else self.max_age)
+            if not expired and (temporary or total <= self.max_bytes):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+            evicted_bytes += size
+
+        with self._lock:
+            self._total_bytes = total
+            self.counters['evicted'] += evicted
+            self.counters['evicted_bytes'] += evicted_bytes
+        return evicted
+
+    def start(self):
+        """Evict in a background thread every evict_interval seconds, sooner when a write goes over quota"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='file-evictor', daemon=True)
+            self._thread.start()
+        return self._thread
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.evict()
+            except OSError:
+                pass
+            self._wake.wait(self.evict_interval)
+            self._wake.clear()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats['bytes'] = self._total_bytes
+        stats['max_bytes'] = self.max_bytes
+        stats['max_age_seconds'] = self.max_age
+        return stats
@@ -0,0 +1,206 @@
+import time
+
+import cv2
+import numpy as np
+
+from pipeline import decode_image, enhance, measure_objects, model_options, normalize_image, prepare_image
+
+# Frames are cut down to this width before their shift against the reference frame is estimated
+DRIFT_WIDTH = 256
+# Shift in pixels of the working resolution above which the wells are segmented again
+DRIFT_THRESHOLD = 5.0
+
+
+def read_video(path, step=1, max_frames=None):
+    """Yield (seconds, BGR frame) for every step-th frame of a video file"""
+    capture = cv2.VideoCapture(path)
+    if not capture.isOpened():
+        raise ValueError('The video could not be decoded.')
+    fps = capture.get(cv2.CAP_PROP_FPS) or 0
+    try:
+        index = used = 0
+        while max_frames is None or used < max_frames:
+            # grab() skips decoding the frames that are not used
+            if not capture.grab():
+                break
+            if index % step == 0:
+                ok, frame = capture.retrieve()
+                if not ok:
+                    break
+                yield (index / fps if fps > 0 else float(index)), frame
+                used += 1
+            index += 1
+    finally:
+        capture.release()
+
+
+def read_images(images, interval=1.0, max_frames=None):
+    """Yield (seconds, BGR frame) for a sequence of encoded images taken interval seconds apart.
+
+    Images that cannot be decoded yield None as the frame.
+    """
+    for index, data in enumerate(images):
+        if max_frames is not None and index >= max_frames:
+            break
+        yield index * interval, decode_image(data)
+
+
+def estimate_drift(reference, image):
+    """Shift (dy, dx) of image against reference in pixels, by phase correlation of downscaled copies"""
+    scale = min(1.0, DRIFT_WIDTH / float(reference.shape[1]))
+    size = (max(1, int(reference.shape[1] * scale)), max(1, int(reference.shape[0] * scale)))
+    a = cv2.resize(reference, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+    b = cv2.resize(image, size, interpolation=cv2.INTER_AREA).astype(np.float32)
+    window = cv2.createHanningWindow(size, cv2.CV_32F)
+    (dx, dy), _ = cv2.phaseCorrelate(a, b, window)
+    return np.array([dy, dx]) / scale
+
+
+def match_wells(previous, current, max_distance):
+    """Match current well centroids to previous ones.
+
+    Returns, for every current centroid, the index of the previous centroid it
+    was matched to, or -1 when no previous well lies within max_distance.
+    """
+    matches = np.full(len(current), -1)
+    if len(previous) == 0 or len(current) == 0:
+        return matches
+    from scipy.optimize import linear_sum_assignment
+
+    distance = np.linalg.norm(current[:, np.newaxis, :] - previous[np.newaxis, :, :], axis=2)
+    rows, cols = linear_sum_assignment(distance)
+    close = distance[rows, cols] <= max_distance
+    matches[rows[close]] = cols[close]
+    return matches
+
+
+class WellMask:
+    """Label image prepared for measuring many frames with the same wells.
+
+    The foreground pixel positions and their well index are computed once, so
+    measuring a frame is one gather and one bincount.
+    """
+
+    def __init__(self, labels, label_values, well_ids):
+        flat = np.asarray(labels).ravel()
+        self.shape = labels.shape
+        self.pixels = np.flatnonzero(flat)
+        # Wells in well id order, index maps every foreground pixel to its well
+        order = np.argsort(well_ids)
+        self.well_ids = np.asarray(well_ids)[order]
+        lookup = np.zeros(int(flat.max()) + 1 if flat.size else 1, dtype=np.int64)
+        lookup[np.asarray(label_values)[order]] = np.arange(len(order))
+        self.index = lookup[flat[self.pixels]]
+        self.area = np.bincount(self.index, minlength=len(order))
+
+    def measure(self, intensity):
+        """Summed and mean intensity of every well, in well id order"""
+        signal = np.bincount(self.index, weights=intensity.ravel()[self.pixels], minlength=len(self.area))
+        return signal, signal / np.maximum(self.area, 1)
+
+
+class TimelapseTracker:
+    """Measures the per-well signal of a time series while segmenting it as rarely as possible.
+
+    The wells are segmented on the first frame, then again every
+    segment_every frames (0 for never), when a frame drifts more than
+    drift_threshold pixels from the frame they were segmented on (0 turns
+    the check off) or when the frame size changes. All other frames are
+    measured inside the cached label mask. Well ids stay the same across
+    segmentations by matching the new wells to the old ones by centroid.
+
+    segment maps the normalized model input and the predict_instances
+    keyword arguments to a label image, like the predict argument of
+    pipeline.analyze.
+    """
+
+    def __init__(self, segment, segment_every=0, drift_threshold=DRIFT_THRESHOLD):
+        self.segment = segment
+        self.segment_every = segment_every
+        self.drift_threshold = drift_threshold
+        self.mask = None
+        self.reference = None
+        self.centroids = np.empty((0, 2))
+        self.well_ids = np.empty(0, dtype=np.int64)
+        self.last_segmented = None
+        self.next_id = 1
+        self.segmentations = 0
+
+    def _segment_reason(self, index, intensity):
+        """Why the frame has to be segmented, None if it does not, and its shift against the reference frame"""
+        if self.mask is None:
+            return 'first', None
+        if intensity.shape != self.mask.shape:
+            return 'size', None
+        shift = estimate_drift(self.reference, intensity) if self.drift_threshold else None
+        if self.segment_every and index - self.last_segmented >= self.segment_every:
+            return 'interval', shift
+        if shift is not None and np.hypot(*shift) > self.drift_threshold:
+            return 'drift', shift
+        return None, shift
+
+    def _segment(self, index, image, intensity, reason, shift):
+        labels = self.segment(normalize_image(intensity), **model_options(image.shape))
+        measurements = measure_objects(labels, intensity)
+        centroids = measurements[['Centroid_Y', 'Centroid_X']].to_numpy(dtype=float)
+
+        # Keep the ids of wells found again, new wells get the next free ids
+        areas = measurements['Area'].to_numpy()
+        max_distance = 0.5 * np.sqrt(4 * np.median(areas) / np.pi) if len(areas) else 0
+        # The old wells are moved by the plate's shift before they are matched
+        previous = self.centroids + shift if shift is not None else self.centroids
+        matches = match_wells(previous, centroids, max_distance)
+        well_ids = np.zeros(len(centroids), dtype=np.int64)
+        new = matches < 0
+        well_ids[~new] = self.well_ids[matches[~new]]
+        well_ids[new] = np.arange(self.next_id, self.next_id + new.sum())
+        self.next_id += int(new.sum())
+
+        self.mask = WellMask(labels, measurements['Label'].to_numpy(), well_ids)
+        self.reference = intensity
+        self.centroids = centroids
+        self.well_ids = well_ids
+        self.last_segmented = index
+        self.segmentations += 1
+
+        wells = []
+        for well_id, row in sorted(zip(well_ids, measurements.itertuples()), key=lambda pair: pair[0]):
+            wells.append({
+                'well': int(well_id),
+                'area': int(row.Area),
+                'centroid': [round(float(row.Centroid_X), 2), round(float(row.Centroid_Y), 2)],
+                'bbox': [int(row.BBox_X1), int(row.BBox_Y1), int(row.BBox_X2), int(row.BBox_Y2)],
+            })
+        return {'type': 'layout', 'frame': index, 'reason': reason, 'wells': wells}
+
+    def process(self, frames):
+        """Yield a layout record whenever the wells are segmented and a signal record per frame"""
+        start = time.perf_counter()
+        count = 0
+        for index, (seconds, frame) in enumerate(frames):
+            if frame is None:
+                yield {'type': 'error', 'frame': index, 'message': 'The frame could not be decoded.'}
+                continue
+            image = prepare_image(frame)
+            intensity = enhance(image)
+
+            reason, shift = self._segment_reason(index, intensity)
+            drift = float(np.hypot(*shift)) if shift is not None else None
+            if reason is not None:
+                yield self._segment(index, image, intensity, reason, shift)
+                drift = 0.0
+
+            signal, mean_signal = self.mask.measure(intensity)
+            count += 1
+            yield {
+                'type': 'frame',
+                'frame': index,
+                'time': round(seconds, 4),
+                'drift': round(drift, 2) if drift is not None else None,
+                'wells': self.mask.well_ids.tolist(),
+                'signal': signal.tolist(),
+                'mean_signal': np.round(mean_signal, 4).tolist(),
+            }
+
+        yield {'type': 'done', 'frames': count, 'segmentations': self.segmentations,
+               'seconds': round(time.perf_counter() - start, 4)}
@@ -0,0 +1,202 @@
+"""Well detection and signal measurement on the device, used when the server cannot be reached.
+
+Only numpy, scipy and Pillow are needed, so this runs on the phone and on
+any desktop. The image goes through the same resizing and contrast stretch
+as on the server, the wells are found with an Otsu threshold and
+scipy.ndimage.label instead of StarDist, and the object table has the same
+columns as a compact server result.
+
+Usage: python offline.py image [output_folder]
+"""
+import os
+import sys
+import time
+import uuid
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont, ImageOps
+from scipy import ndimage
+
+# Working resolution and contrast stretch, match flask/pipeline.py
+MAX_DIMENSION = 1000
+TARGET_WIDTH = 800
+BRIGHTNESS = 1.5
+CONTRAST = 2
+
+# Wells are detected on a copy at most DETECT_WIDTH wide and measured at the working resolution
+DETECT_WIDTH = 400
+SMOOTHING_SIGMA = 1.5
+# Objects smaller than this fraction of the median object, or than MIN_AREA detection pixels, are noise
+MIN_AREA_FRACTION = 0.2
+MIN_AREA = 12
+
+COLUMN_DTYPES = {'Object': np.int32, 'Area': np.int64, 'Signal': np.float64, 'Signal/Unit_Area': np.float64}
+
+
+def upright(image):
+    """Image with the orientation phones store in EXIF applied to its pixels"""
+    return ImageOps.exif_transpose(image)
+
+
+def result_path(folder, name, extension):
+    """Path of a processed image in folder.
+
+    Kivy caches textures by path, so name has to be unique for every result.
+    """
+    return os.path.join(folder, f'processed_{name}{extension}')
+
+
+def load_image(path):
+    """RGB array of an image at the server's working resolution"""
+    with Image.open(path) as image:
+        # JPEGs are decoded at the smallest DCT scale that still covers the working resolution
+        image.draft('RGB', (TARGET_WIDTH, TARGET_WIDTH))
+        image = upright(image).convert('RGB')
+    # Rotate the image if it is in landscape mode, like the server
+    if image.width < 200:
+        image = image.transpose(Image.ROTATE_270)
+    if image.width > MAX_DIMENSION or image.height > MAX_DIMENSION:
+        image = image.resize((TARGET_WIDTH, int(image.height * TARGET_WIDTH / float(image.width))), Image.BOX)
+    return np.asarray(image)
+
+
+def enhance(image):
+    """Grayscale and contrast stretch an RGB array, the result is what the signal is measured on"""
+    gray = image.astype(np.float32) @ np.array([0.299, 0.587, 0.114], np.float32)
+    return np.clip(np.rint(np.rint(gray) * CONTRAST + BRIGHTNESS), 0, 255).astype(np.uint8)
+
+
+def otsu_threshold(image):
+    """Grey level of a uint8 image that maximizes the between-class variance of the log intensity.
+
+    On the log scale dim wells stay on the bright side of the threshold
+    instead of being split off from the brightest ones.
+    """
+    histogram = np.bincount(image.ravel(), minlength=256).astype(np.float64)
+    levels = np.log1p(np.arange(256))
+    weight = np.cumsum(histogram)
+    total = weight[-1]
+    cumulative_mean = np.cumsum(histogram * levels)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = (cumulative_mean[-1] * weight - cumulative_mean * total) ** 2 / (weight * (total - weight))
+    variance = variance[:-1]
+    if not total or np.isnan(variance).all():
+        # An empty or single grey level image has nothing above its brightest level
+        return int(image.max()) if total else 0
+    return int(np.nanargmax(variance))
+
+
+def detect_wells(intensity):
+    """Label image of the bright wells of an enhanced image, numbered in raster order"""
+    height, width = intensity.shape
+    factor = min(1.0, DETECT_WIDTH / float(width))
+    small = intensity
+    if factor < 1.0:
+        small = np.asarray(Image.fromarray(intensity).resize((DETECT_WIDTH, max(1, int(round(height * factor)))),
+                                                             Image.BOX))
+
+    smooth = ndimage.gaussian_filter(small, SMOOTHING_SIGMA)
+    mask = smooth > otsu_threshold(smooth)
+    mask = ndimage.binary_opening(mask, iterations=2)
+    mask = ndimage.binary_fill_holes(mask)
+    labels, count = ndimage.label(mask)
+
+    # Drop specks, relabel the remaining objects 1..n
+    area = np.bincount(labels.ravel(), minlength=count + 1)
+    area[0] = 0
+    kept = area >= max(MIN_AREA, MIN_AREA_FRACTION * np.median(area[1:])) if count else area > 0
+    kept[0] = False
+    relabel = np.zeros(count + 1, np.int32)
+    relabel[kept] = np.arange(1, int(kept.sum()) + 1)
+    labels = relabel[labels]
+
+    if factor < 1.0:
+        labels = np.asarray(Image.fromarray(labels).resize((width, height), Image.NEAREST))
+    return labels
+
+
+def measure_objects(labels, intensity):
+    """Area, summed signal and bounding box of every labelled object, in one pass"""
+    flat = labels.ravel()
+    n_bins = int(flat.max()) + 1 if flat.size else 1
+    area = np.bincount(flat, minlength=n_bins)[1:]
+    signal = np.bincount(flat, weights=intensity.ravel().astype(np.float64), minlength=n_bins)[1:]
+    boxes = [(s[0].start, s[1].start, s[0].stop, s[1].stop) for s in ndimage.find_objects(labels) if s is not None]
+    return area, signal, np.array(boxes, np.int64).reshape(-1, 4)
+
+
+def object_table(area, signal):
+    """Relative change table as columns, the same values and order as the server's object table"""
+    if not len(area):
+        return {column: np.empty(0, dtype) for column, dtype in COLUMN_DTYPES.items()}
+    objects = np.arange(1, len(area) + 1)
+    signal = signal / area.max()
+    change = (signal.max() - signal) / signal.max() * 100
+    order = np.argsort(change, kind='stable')
+    order = order[change[order] >= 0]
+    return {'Object': objects[order].astype(np.int32), 'Area': area[order].astype(np.int64),
+            'Signal': signal[order], 'Signal/Unit_Area': change[order]}
+
+
+@lru_cache(maxsize=32)
+def _font(size):
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        # Pillow before 10.1 has a single bitmap font size
+        return ImageFont.load_default()
+
+
+def annotate(image, boxes):
+    """Draw a circle and the object number over every object"""
+    image = Image.fromarray(image)
+    draw = ImageDraw.Draw(image)
+    for number, (y1, x1, y2, x2) in enumerate(boxes, start=1):
+        x_center, y_center = (x1 + x2) // 2, (y1 + y2) // 2
+        radius = max(1, int((x2 - x1 + y2 - y1) / 4))
+        draw.ellipse((x_center - radius, y_center - radius, x_center + radius, y_center + radius),
+                     outline=(255, 255, 255), width=3)
+        font = _font(max(8, int(radius * 0.8)))
+        left, top, right, bottom = draw.textbbox((0, 0), str(number), font=font)
+        draw.text((x_center - (left + right) / 2, y_center - (top + bottom) / 2), str(number), fill=(255, 255, 0),
+                  font=font)
+    return image
+
+
+def analyze(image_path, output_folder, progress=None):
+    """Analyse an image on the device.
+
+    Returns the result payload, shaped like a compact server result with
+    'offline' set, and the path of the annotated image written to
+    output_folder. progress, if given, receives a status text and a fraction.
+    """
+    progress = progress or (lambda text, fraction: None)
+    start = time.perf_counter()
+    progress('Analysing on the device', 0.2)
+    image = load_image(image_path)
+    intensity = enhance(image)
+
+    progress('Detecting wells', 0.4)
+    labels = detect_wells(intensity)
+    area, signal, boxes = measure_objects(labels, intensity)
+
+    progress('Drawing results', 0.8)
+    local_path = result_path(output_folder, f'offline_{uuid.uuid4().hex}', '.jpg')
+    annotate(image, boxes).save(local_path, format='JPEG', quality=90)
+
+    payload = {
+        'message': 'Image processed on the device',
+        'object_table': object_table(area, signal),
+        'offline': True,
+        'seconds': round(time.perf_counter() - start, 3),
+    }
+    return payload, local_path
+
+
+if __name__ == '__main__':
+    result, path = analyze(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else '.')
+    table = result['object_table']
+    for row in zip(*(table[column] for column in COLUMN_DTYPES)):
+        print(f'{row[0]:>4} {row[1]:>8} {row[2]:>10.2f} {row[3]:>8.2f}')
+    print(f'{len(table["Object"])} objects in {result["seconds"]:.3f} s, annotated image {path}')
@@ -0,0 +1,370 @@
+import io
+import os
+import threading
+import time
+
+import numpy as np
+import requests
+from kivy.clock import Clock
+from PIL import Image
+
+from offline import result_path, upright
+
+# Results come as msgpack with the table as columns when the library is packaged, JSON otherwise
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK = 'application/x-msgpack'
+RESULT_ACCEPT = f'{MSGPACK}, application/json;q=0.9' if msgpack is not None else 'application/json'
+
+# Working resolution used when the server does not advertise one, matches flask/pipeline.py
+DEFAULT_INPUT_SPEC = {'max_dimension': 1000, 'target_width': 800, 'format': 'jpeg', 'jpeg_quality': 90}
+
+
+def prepare_upload(image_path, spec, quality=None):
+    """Return the file name and bytes to upload for an image.
+
+    Images larger than the server's working resolution are resized the same
+    way the server would (to target_width, keeping the aspect ratio) and
+    re-encoded as JPEG, anything else is sent unchanged.
+    """
+    filename = os.path.basename(image_path)
+    with open(image_path, 'rb') as f:
+        data = f.read()
+
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+        if width <= spec['max_dimension'] and height <= spec['max_dimension']:
+            return filename, data
+
+        image = upright(image)
+        width, height = image.size
+        if width <= spec['max_dimension'] and height <= spec['max_dimension']:
+            size = (width, height)
+        else:
+            size = (spec['target_width'], int(height * spec['target_width'] / float(width)))
+        image = image.convert('RGB').resize(size, Image.BOX)
+
+        buffer = io.BytesIO()
+        image.save(buffer, format='JPEG', quality=quality or spec.get('jpeg_quality', 90))
+        return os.path.splitext(filename)[0] + '.jpg', buffer.getvalue()
+
+
+def _unpack_array(value):
+    if value.get('__ndarray__'):
+        # A view on the received bytes, the array data is not copied
+        return np.frombuffer(value['data'], dtype=np.dtype(value['dtype'])).reshape(value['shape'])
+    return value
+
+
+class Cancelled(Exception):
+    """Raised inside the worker thread when the user cancels a task"""
+
+
+class ServerError(Exception):
+    """Raised for server answers the app cannot use, the args are (title, message)"""
+
+
+class ServerUnavailable(ServerError):
+    """Raised when the server fails, is too slow or is not a Scentinel server, the image can go to the fallback"""
+
+
+class Task:
+    """Handle of a request running in the background"""
+
+    def __init__(self):
+        self._cancelled = threading.Event()
+        self.thread = None
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+    def sleep(self, seconds):
+        """Wait for the given time, waking up early when cancelled"""
+        if self._cancelled.wait(seconds):
+            raise Cancelled()
+
+
+class ServerClient:
+    """Talks to the Scentinel server without blocking the Kivy main loop.
+
+    Requests run on a worker thread with one reused HTTP session. Connection
+    errors, timeouts, 429 and 5xx answers are retried with exponential
+    backoff. Callbacks are always called on the main loop. Images are
+    downscaled to the server's working resolution before they are uploaded,
+    upload_quality overrides the JPEG quality the server suggests. With a
+    fallback, images the server has not answered within fallback_after
+    seconds are analysed on the device instead.
+    """
+
+    def __init__(self, download_folder, timeout=(5, 60), retries=3, backoff=1.0, poll_interval=1.0,
+                 max_wait=600, upload_quality=None, fallback_after=20):
+        self.download_folder = download_folder
+        self.upload_quality = upload_quality
+        self.fallback_after = fallback_after
+        self._input_specs = {}
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.session = requests.Session()
+
+    def process_image(self, base_url, image_path, on_success, on_error, on_progress=None, options=None,
+                      fallback=None, offline=False, on_preview=None):
+        """Upload an image, wait for the result and download the processed image.
+
+        on_success receives the result payload and the local path of the
+        processed image, on_error a title and a message and on_progress a
+        status text and a fraction between 0 and 1. on_preview, if given,
+        receives the local path of the server's small preview of the
+        processed image before the full image is downloaded. options are sent
+        as form fields, e.g. {'template': name} to measure a registered plate layout.
+        fallback(image_path, progress) analyses the image on the device and
+        returns the same pair. It is used when the server is unreachable,
+        fails or is slower than fallback_after, and straight away with offline.
+        """
+        return self._start(lambda task, progress: self._process_image(task, base_url.rstrip('/'), image_path, progress,
+                                                                      options or {}, fallback, offline,
+                                                                      on_preview is not None),
+                           on_success, on_error, on_progress, on_preview)
+
+    def calibrate(self, base_url, sample, on_success, on_error, fallback=None):
+        """Fit the calibration curve of a sample on the server.
+
+        sample holds 'concentrations', 'responses' and 'unknown_response'.
+        When the server is unreachable or has no /calibrate endpoint,
+        fallback(sample) computes the result on the device instead, still off
+        the main loop. on_success receives the result dict.
+        """
+        return self._start(lambda task, progress: self._calibrate(task, base_url.rstrip('/'), sample, fallback),
+                           on_success, on_error)
+
+    def _start(self, work, on_success, on_error, on_progress=None, on_preview=None):
+        """Run work(task, progress) on a worker thread and deliver its result tuple to on_success"""
+        task = Task()
+
+        # Callbacks of a cancelled task are dropped
+        def deliver(callback, *args):
+            Clock.schedule_once(lambda dt: None if task.cancelled else callback(*args))
+
+        def progress(text, fraction, preview=None):
+            if on_progress is not None:
+                deliver(on_progress, text, fraction)
+            if preview is not None and on_preview is not None:
+                deliver(on_preview, preview)
+
+        def run():
+            try:
+                result = work(task, progress)
+            except Cancelled:
+                return
+            except ServerError as e:
+                deliver(on_error, *e.args)
+                return
+            except requests.RequestException as e:
+                deliver(on_error, 'Connection Error', f'Could not reach the server: {e}')
+                return
+            except Exception as e:
+                # Unreadable images, failures of the offline analysis and plain bugs must still
+                # reach the UI, an exception ending the thread would leave the progress popup open
+                deliver(on_error, 'Error', f'{type(e).__name__}: {e}')
+                return
+            deliver(on_success, *result)
+
+        task.thread = threading.Thread(target=run, name='server-request', daemon=True)
+        task.thread.start()
+        return task
+
+    def _calibrate(self, task, base_url, sample, fallback):
+        try:
+            response = self._request(task, 'post', base_url + '/calibrate', json=sample, retries=1)
+            if response.status_code == 200:
+                return (self._json(response),)
+            if fallback is None or response.status_code not in (404, 405):
+                raise ServerError('Calibration Error', self._json(response).get('message', 'Calibration failed.'))
+        except requests.RequestException:
+            if fallback is None:
+                raise
+        # The server is unreachable or too old, fit on the device instead
+        task.check()
+        return (fallback(sample),)
+
+    def _process_image(self, task, base_url, image_path, progress, options, fallback, offline, preview):
+        if fallback is None:
+            return self._process_on_server(task, base_url, image_path, progress, options, preview)
+        if not offline:
+            try:
+                # Give up on the server early, the device answers in about a second
+                return self._process_on_server(task, base_url, image_path, progress, options, preview,
+                                               deadline=time.monotonic() + self.fallback_after, retries=1)
+            except (requests.RequestException, ServerUnavailable):
+                pass
+        task.check()
+        data, local_path = fallback(image_path, progress)
+        task.check()
+        self._remove_old_downloads(local_path)
+        return data, local_path
+
+    def _process_on_server(self, task, base_url, image_path, progress, options, preview=False, deadline=None,
+                           retries=None):
+        def request(method, path, **kwargs):
+            return self._request(task, method, base_url + path, retries=retries, deadline=deadline, **kwargs)
+
+        progress('Preparing image', 0.05)
+        filename, payload = prepare_upload(image_path, self._input_spec(base_url, request), self.upload_quality)
+        task.check()
+
+        progress('Uploading image', 0.1)
+        files = {'file': (filename, payload)}
+
+        response = request('post', '/jobs', files=files, data=options)
+        if response.status_code in (404, 405, 501):
+            # Servers without the job API process the image in the request itself
+            progress('Processing image', 0.5)
+            response = request('post', '/process_image', files=files, data=options, headers={'Accept': RESULT_ACCEPT})
+            data = self._result(response)
+        else:
+            job = self._json(self._available(response))
+            started = time.monotonic()
+            while True:
+                status = self._json(self._available(request('get', job['status_url'])))
+                if status['status'] == 'done':
+                    break
+                if status['status'] == 'failed':
+                    raise ServerError('Server Error', status.get('error') or 'Processing failed.')
+                if time.monotonic() - started > self.max_wait:
+                    raise ServerUnavailable('Timeout', 'The server took too long to process the image.')
+                progress('Waiting in queue' if status['status'] == 'queued' else 'Processing image', 0.5)
+                task.sleep(self.poll_interval)
+            data = self._result(request('get', job['result_url'], headers={'Accept': RESULT_ACCEPT}))
+
+        if 'object_table' not in data:
+            raise ServerError(data.get('error', 'Server Error'), data.get('message', 'Please check the URL and try again.'))
+
+        # The small preview comes first so there is something to show while the full image downloads
+        preview_path = None
+        if preview and data.get('preview_image_url'):
+            progress('Downloading preview', 0.8)
+            preview_path = self._download(request, data['preview_image_url'])
+            task.check()
+        progress('Downloading processed image', 0.9, preview=preview_path)
+        local_path = None
+        if data.get('processed_image_url'):
+            local_path = self._download(request, data['processed_image_url'])
+        if local_path is not None:
+            self._remove_old_downloads(local_path, preview_path)
+        task.check()
+        return data, local_path
+
+    def _download(self, request, url):
+        """Save an image of the server to the download folder, None when it is gone"""
+        response = request('get', url)
+        if response.status_code != 200:
+            return None
+        # The server names every result after its cache key
+        name = os.path.splitext(os.path.basename(url))[0]
+        local_path = result_path(self.download_folder, name, self._extension(response))
+        with open(local_path, 'wb') as f:
+            f.write(response.content)
+        return local_path
+
+    def _input_spec(self, base_url, request):
+        """Working resolution advertised by the server, fetched once per server"""
+        if base_url not in self._input_specs:
+            spec = DEFAULT_INPUT_SPEC
+            try:
+                response = request('get', '/input_spec')
+                if response.status_code == 200:
+                    spec = dict(DEFAULT_INPUT_SPEC, **response.json())
+            except ValueError:
+                pass
+            self._input_specs[base_url] = spec
+        return self._input_specs[base_url]
+
+    def _request(self, task, method, url, retries=None, deadline=None, **kwargs):
+        """Send a request, retrying transient failures with exponential backoff until the deadline"""
+        retries = self.retries if retries is None else retries
+        for attempt in range(retries + 1):
+            task.check()
+            last_attempt = attempt == retries
+            timeout = self.timeout
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ServerUnavailable('Timeout', 'The server took too long to process the image.')
+                timeout = tuple(min(seconds, remaining) for seconds in self.timeout)
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if last_attempt:
+                    raise
+                task.sleep(self.backoff * 2 ** attempt)
+                continue
+
+            if response.status_code == 429 or response.status_code in (502, 503, 504):
+                if last_attempt:
+                    return response
+                retry_after = response.headers.get('Retry-After')
+                task.sleep(float(retry_after) if retry_after and retry_after.isdigit() else self.backoff * 2 ** attempt)
+                continue
+            return response
+
+    def _remove_old_downloads(self, *keep):
+        for name in os.listdir(self.download_folder):
+            path = os.path.join(self.download_folder, name)
+            if name.startswith('processed_') and path not in keep:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def _available(response):
+        """The response, unless the server failed to answer it or is too busy"""
+        if response.status_code == 429 or response.status_code >= 500:
+            try:
+                body = response.json()
+            except ValueError:
+                body = {}
+            raise ServerUnavailable(body.get('error', 'Server Error'),
+                                    body.get('message', f'The server answered with status {response.status_code}.'))
+        return response
+
+    @staticmethod
+    def _json(response):
+        # Anything but JSON comes from a stopped app or a wrong URL, not from the Scentinel server
+        try:
+            return response.json()
+        except ValueError:
+            raise ServerUnavailable('Server Error', 'Please check the URL and try again.')
+
+    @classmethod
+    def _result(cls, response):
+        """Result payload, the object table is a dict of column arrays in msgpack answers"""
+        cls._available(response)
+        if response.headers.get('Content-Type', '').startswith(MSGPACK):
+            try:
+                return msgpack.unpackb(response.content, raw=False, object_hook=_unpack_array)
+            except ValueError:
+                raise ServerUnavailable('Server Error', 'Please check the URL and try again.')
+        return cls._json(response)
+
+    @staticmethod
+    def _extension(response):
+        content_type = response.headers.get('Content-Type', '')
+        if 'png' in content_type:
+            return '.png'
+        if 'webp' in content_type:
+            return '.webp'
+        return '.jpg'
@@ -0,0 +1,121 @@
+"""Calibration curve fits, their inverse and the /calibrate validation.
+
+Run with python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+
+import calibration  # noqa: E402
+
+CONCENTRATIONS = np.logspace(0, 3, 10)
+CURVES = {
+    '4pl': [2.0, 1.5, 50.0, 0.1],
+    '5pl': [2.0, 1.2, 40.0, 0.1, 2.0],
+}
+
+
+def responses(model, params, x=CONCENTRATIONS):
+    return calibration.predict(model, np.array([params]), x)[0]
+
+
+@pytest.mark.parametrize('model', ['4pl', '5pl'])
+def test_recovers_known_parameters(model):
+    result = calibration.fit(CONCENTRATIONS, responses(model, CURVES[model]), model)[0]
+    assert result['model'] == model and result['converged']
+    np.testing.assert_allclose(result['params'], CURVES[model], rtol=1e-4)
+    assert result['r_squared'] > 0.9999
+
+
+def test_recovers_parameters_from_noisy_data():
+    rng = np.random.default_rng(0)
+    y = responses('4pl', CURVES['4pl']) + rng.normal(0, 0.01, len(CONCENTRATIONS))
+    result = calibration.fit(CONCENTRATIONS, y, '4pl')[0]
+    np.testing.assert_allclose(result['params'], CURVES['4pl'], rtol=0.1, atol=0.02)
+
+
+@pytest.mark.parametrize('model', ['4pl', '5pl', 'linear'])
+def test_inverse_round_trip(model):
+    params = np.array([CURVES.get(model, [0.5, 0.02])])
+    x = np.array([2.0, 30.0, 400.0])
+    np.testing.assert_allclose(calibration.inverse(model, params, calibration.predict(model, params, x)[0]), x,
+                               rtol=1e-6)
+
+
+def test_inverse_outside_the_asymptotes_is_nan():
+    params = np.array([CURVES['4pl']])
+    assert np.isnan(calibration.inverse('4pl', params, 5.0)[0])
+
+
+def test_ragged_batch_matches_single_fits():
+    rng = np.random.default_rng(1)
+    samples = []
+    for length, params in [(10, CURVES['4pl']), (6, [1.5, 2.0, 20.0, 0.2]), (8, [3.0, 0.8, 200.0, 0.0])]:
+        x = np.logspace(0, 3, length)
+        samples.append({'concentrations': list(x),
+                        'responses': list(responses('4pl', params, x) + rng.normal(0, 0.005, length)),
+                        'unknown_response': 1.0})
+
+    batch = calibration.calibrate(samples)
+    for sample, result in zip(samples, batch):
+        alone = calibration.calibrate([sample])[0]
+        assert result['model'] == alone['model'] and result['points'] == alone['points']
+        for name, value in alone['parameters'].items():
+            assert result['parameters'][name] == pytest.approx(value, rel=1e-6)
+        assert result['concentration'] == pytest.approx(alone['concentration'], rel=1e-6)
+
+
+def test_linear_fallback_with_too_few_points_for_a_logistic():
+    result = calibration.calibrate([{'concentrations': [1, 2, 3], 'responses': [1.0, 2.1, 2.9],
+                                     'unknown_response': 2.0}])[0]
+    assert result['model'] == 'linear'
+    assert set(result['parameters']) == {'intercept', 'slope'}
+    assert result['concentration'] == pytest.approx(2.0, rel=0.05)
+
+
+def test_linear_model_on_request():
+    x = np.linspace(0, 100, 8)
+    result = calibration.fit(x, 0.5 + 0.02 * x, 'linear')[0]
+    np.testing.assert_allclose(result['params'], [0.5, 0.02])
+
+
+@pytest.fixture(scope='module')
+def client():
+    import app
+    # Calibration needs neither the models nor the job pool the first request would start
+    app._started = True
+    return app.app.test_client()
+
+
+VALID = {'concentrations': [1, 10, 100, 1000], 'responses': [0.1, 0.5, 1.5, 2.0], 'unknown_response': 1.0}
+
+
+@pytest.mark.parametrize('body', [
+    [1, 2, 3],
+    dict(VALID, model='7pl'),
+    dict(VALID, max_iterations='x'),
+    dict(VALID, max_iterations=0),
+    dict(VALID, max_iterations=-3),
+    dict(VALID, max_iterations=2.5),
+    dict(VALID, concentrations=[1]),
+    dict(VALID, responses=[0.1, 0.5]),
+    {'responses': [0.1, 0.5]},
+    {'samples': []},
+])
+def test_calibrate_rejects_invalid_requests(client, body):
+    response = client.post('/calibrate', json=body)
+    assert response.status_code == 400
+    assert response.get_json()['error']
+
+
+def test_calibrate_single_and_batch(client):
+    single = client.post('/calibrate', json=VALID)
+    assert single.status_code == 200 and single.get_json()['concentration'] is not None
+    batch = client.post('/calibrate', json={'samples': [VALID, VALID], 'model': 'linear'})
+    assert batch.status_code == 200
+    assert [result['model'] for result in batch.get_json()['results']] == ['linear', 'linear']
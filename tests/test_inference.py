@@ -0,0 +1,61 @@
+"""A StarDist model exported by export_model loads back through its backend and gives the same network output.
+
+Needs stardist, TensorFlow, tf2onnx and onnxruntime, the tests are skipped
+without them. Run with python -m pytest tests
+"""
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+
+pytest.importorskip('stardist')
+pytest.importorskip('tf2onnx')
+pytest.importorskip('onnxruntime')
+
+import inference  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def tiny_model(tmp_path_factory):
+    """An untrained StarDist2D small enough to export in a few seconds"""
+    from stardist.models import Config2D, StarDist2D
+
+    config = Config2D(n_rays=8, grid=(2, 2), n_channel_in=1, unet_n_depth=1, unet_n_filter_base=4,
+                      train_patch_size=(32, 32))
+    return StarDist2D(config, name='tiny', basedir=str(tmp_path_factory.mktemp('models')))
+
+
+@pytest.fixture(scope='module')
+def exported(tiny_model, tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('exported') / 'tiny.onnx')
+    return path, inference.export_model(tiny_model, path, 'onnx')
+
+
+def test_metadata_is_plain_json(exported):
+    path, metadata = exported
+    with open(inference.metadata_path(path)) as f:
+        assert json.load(f) == metadata
+    assert metadata['tile_overlap'] and all(type(v) is int for v in metadata['tile_overlap'])
+    assert not [name for name in os.listdir(os.path.dirname(path)) if name.endswith('.tmp')]
+
+
+def test_exported_backend_matches_keras(tiny_model, exported):
+    path, metadata = exported
+    backend = inference.load_backend({'backend': 'onnx', 'export': path})
+    assert backend.grid == tuple(metadata['grid'])
+    assert backend.tile_overlap == tuple(metadata['tile_overlap'])
+
+    image = np.random.default_rng(0).random((64, 80)).astype(np.float32)
+    batch = backend._pad(image)[np.newaxis, ..., np.newaxis]
+    prob, dist = backend.network(batch)
+    expected_prob, expected_dist = inference.TensorFlowBackend(tiny_model).network(batch)
+    np.testing.assert_allclose(prob, expected_prob, atol=1e-5)
+    np.testing.assert_allclose(dist, expected_dist, atol=1e-5)
+
+    labels, _ = backend.predict_instances(image, prob_thresh=0.5, nms_thresh=0.4)
+    assert labels.shape == image.shape
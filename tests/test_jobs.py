@@ -0,0 +1,118 @@
+"""The job queue bounds its pending jobs and frees their slots when the pool fails them.
+
+The worker functions below replace model loading and segmentation, spawned
+pool processes import them from this module. Run with python -m pytest tests
+"""
+import os
+import sys
+import time
+from concurrent.futures import Future
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+
+import jobs  # noqa: E402
+
+
+def load_nothing(model_configs, default_model):
+    pass
+
+
+def segment(data, model_name, options):
+    return {'wells': len(data)}, {'decode': 0.0}
+
+
+def crash(data, model_name, options):
+    os._exit(1)
+
+
+class HeldPool:
+    """Executor whose jobs stay queued until the test finishes them"""
+
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, *args):
+        self.futures.append(Future())
+        return self.futures[-1]
+
+    def shutdown(self, **kwargs):
+        pass
+
+
+class BrokenPool(HeldPool):
+    def submit(self, *args):
+        raise jobs.BrokenProcessPool('A worker process died')
+
+
+def fake_queue(monkeypatch, pools, **kwargs):
+    pools = iter(pools)
+    monkeypatch.setattr(jobs.JobQueue, '_start_pool', lambda self: next(pools))
+    return jobs.JobQueue({}, 'default', **kwargs)
+
+
+def wait_for(queue, job_id, timeout=60):
+    deadline = time.time() + timeout
+    while queue.get(job_id)['status'] in ('queued', 'running'):
+        assert time.time() < deadline, 'job did not finish'
+        time.sleep(0.05)
+    return queue.get(job_id)
+
+
+def test_full_queue_rejects_and_frees_slots_as_jobs_finish(monkeypatch):
+    pool = HeldPool()
+    queue = fake_queue(monkeypatch, [pool], max_pending=2)
+    first = queue.submit(b'a', 'default')
+    queue.submit(b'b', 'default')
+    with pytest.raises(jobs.QueueFull):
+        queue.submit(b'c', 'default')
+
+    pool.futures[0].set_result(({'wells': 1}, {}))
+    assert queue.get(first)['status'] == 'done' and queue.stats()['pending'] == 1
+    queue.submit(b'c', 'default')
+    assert queue.stats()['pending'] == 2
+
+
+def test_rejected_submit_releases_its_slot(monkeypatch):
+    # Every submission replaces the broken pool once, with another broken one
+    queue = fake_queue(monkeypatch, [BrokenPool() for _ in range(4)], max_pending=1)
+    for _ in range(3):
+        with pytest.raises(jobs.WorkersUnavailable):
+            queue.submit(b'a', 'default')
+    assert queue.stats()['pending'] == 0 and queue.stats()['jobs'] == 0
+
+
+def test_broken_pool_is_replaced_once(monkeypatch):
+    replacement = HeldPool()
+    queue = fake_queue(monkeypatch, [BrokenPool(), replacement])
+    queue.submit(b'a', 'default')
+    assert queue._executor is replacement and len(replacement.futures) == 1
+    assert queue.stats()['pending'] == 1
+
+
+def test_failed_job_frees_its_slot(monkeypatch):
+    pool = HeldPool()
+    queue = fake_queue(monkeypatch, [pool], max_pending=1)
+    job_id = queue.submit(b'a', 'default')
+    pool.futures[0].set_exception(ValueError('The file could not be decoded.'))
+    job = queue.get(job_id)
+    assert job['status'] == 'failed' and job['error'].startswith('ValueError')
+    assert queue.stats()['pending'] == 0
+
+
+def test_crashed_worker_process_is_replaced(monkeypatch):
+    monkeypatch.setattr(jobs, '_init_worker', load_nothing)
+    monkeypatch.setattr(jobs, 'run_job', crash)
+    queue = jobs.JobQueue({}, 'default', workers=1, max_pending=2)
+    try:
+        crashed = wait_for(queue, queue.submit(b'a', 'default'))
+        assert crashed['status'] == 'failed' and 'BrokenProcessPool' in crashed['error']
+
+        monkeypatch.setattr(jobs, 'run_job', segment)
+        job = wait_for(queue, queue.submit(b'abc', 'default'))
+        assert job['status'] == 'done' and job['result'] == ({'wells': 3}, {'decode': 0.0})
+        assert queue.stats()['pending'] == 0
+    finally:
+        queue.shutdown()
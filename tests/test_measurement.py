@@ -0,0 +1,88 @@
+"""The vectorized measurement gives the same object table as the original per-object loop.
+
+No model is needed: the label images are synthetic or thresholded from the
+sample image. Run with python -m pytest tests
+"""
+import json
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from bench_pipeline import (GOLDEN, GOLDEN_RTOL, reference_object_table, tables_match,  # noqa: E402
+                            threshold_labels)
+from pipeline import (TABLE_COLUMNS, build_object_table, decode_image, enhance, measure_objects,  # noqa: E402
+                      prepare_image)
+
+SAMPLE_IMAGE = os.path.join(ROOT, 'Sample Images', 'sample 1.jpg')
+
+
+def assert_tables_match(expected, actual):
+    assert list(actual.columns) == TABLE_COLUMNS
+    assert len(actual) == len(expected)
+    # Both tables are sorted by relative change
+    assert np.all(np.diff(actual['Signal/Unit_Area'].astype(float)) >= 0)
+    # Rows with equal relative change may come in either order
+    expected = expected.sort_values('Object').reset_index(drop=True)
+    actual = actual.sort_values('Object').reset_index(drop=True)
+    np.testing.assert_array_equal(actual['Object'].astype(int), expected['Object'].astype(int))
+    np.testing.assert_array_equal(actual['Area'].astype(int), expected['Area'].astype(int))
+    for column in ('Signal', 'Signal/Unit_Area'):
+        np.testing.assert_allclose(actual[column].astype(float), expected[column].astype(float), rtol=1e-9,
+                                   atol=1e-9)
+
+
+def synthetic_labels(seed):
+    """Overlapping and touching discs with gaps in the label numbers, and a random intensity image"""
+    rng = np.random.default_rng(seed)
+    labels = np.zeros((300, 400), np.int32)
+    for label in range(1, 41):
+        center = (int(rng.integers(0, 400)), int(rng.integers(0, 300)))
+        cv2.circle(labels, center, int(rng.integers(3, 30)), label, -1)
+    # Labels hidden under later discs leave gaps in the numbering
+    intensity = rng.integers(0, 256, labels.shape).astype(np.uint8)
+    return labels, intensity
+
+
+def sample_labels():
+    """Wells of the sample image, thresholded like the golden check instead of segmented by the model"""
+    intensity = enhance(prepare_image(cv2.imread(SAMPLE_IMAGE)))
+    return threshold_labels(intensity), intensity
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_synthetic_labels_match_original_loop(seed):
+    labels, intensity = synthetic_labels(seed)
+    assert len(np.unique(labels)) - 1 < labels.max()
+    assert_tables_match(reference_object_table(labels, intensity),
+                        build_object_table(measure_objects(labels, intensity)))
+
+
+def test_sample_image_labels_match_original_loop():
+    labels, intensity = sample_labels()
+    assert labels.max() > 1
+    assert_tables_match(reference_object_table(labels, intensity),
+                        build_object_table(measure_objects(labels, intensity)))
+
+
+def test_sample_image_matches_golden_output():
+    with open(SAMPLE_IMAGE, 'rb') as f:
+        intensity = enhance(prepare_image(decode_image(f.read())))
+    with open(GOLDEN) as f:
+        golden = json.load(f)['threshold']
+    object_table = build_object_table(measure_objects(threshold_labels(intensity), intensity))
+    assert len(object_table) == golden['objects']
+    assert tables_match(golden['object_table'], object_table.to_dict(orient='records'), rtol=GOLDEN_RTOL)
+
+
+def test_image_without_objects_gives_empty_table():
+    labels = np.zeros((50, 60), np.int32)
+    object_table = build_object_table(measure_objects(labels, np.full(labels.shape, 100, np.uint8)))
+    assert object_table.empty
+    assert list(object_table.columns) == TABLE_COLUMNS
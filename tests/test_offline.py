@@ -0,0 +1,61 @@
+"""The app's on-device analysis finds every well of a synthetic plate and writes its annotated image.
+
+Only numpy, scipy and Pillow are needed. Run with python -m pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pytest
+from PIL import Image
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+import offline  # noqa: E402
+from bench_offline import synthetic_plate  # noqa: E402
+
+
+@pytest.mark.parametrize('width, height, rows, cols', [(640, 480, 3, 4), (800, 1066, 4, 6), (4000, 3000, 8, 12)])
+def test_synthetic_plate(tmp_path, width, height, rows, cols):
+    image_path = tmp_path / 'plate.jpg'
+    image_path.write_bytes(synthetic_plate(width, height, rows, cols))
+    fractions = []
+
+    payload, annotated_path = offline.analyze(str(image_path), str(tmp_path),
+                                              progress=lambda text, fraction: fractions.append(fraction))
+
+    table = payload['object_table']
+    assert list(table) == list(offline.COLUMN_DTYPES)
+    for column, dtype in offline.COLUMN_DTYPES.items():
+        assert table[column].dtype == dtype
+    assert len(table['Object']) == rows * cols
+    assert sorted(table['Object']) == list(range(1, rows * cols + 1))
+    assert np.all(np.diff(table['Signal/Unit_Area']) >= 0)
+    assert payload['offline'] is True
+    assert fractions == sorted(fractions)
+
+    assert os.path.dirname(annotated_path) == str(tmp_path)
+    with Image.open(annotated_path) as annotated:
+        assert annotated.format == 'JPEG'
+        assert annotated.width == min(width, offline.TARGET_WIDTH if max(width, height) > offline.MAX_DIMENSION
+                                      else width)
+
+
+def test_every_result_gets_its_own_file(tmp_path):
+    image_path = tmp_path / 'plate.jpg'
+    image_path.write_bytes(synthetic_plate(640, 480, 3, 4))
+    _, first = offline.analyze(str(image_path), str(tmp_path))
+    _, second = offline.analyze(str(image_path), str(tmp_path))
+    assert first != second and os.path.exists(first) and os.path.exists(second)
+
+
+def test_empty_plate_gives_typed_empty_table(tmp_path):
+    image_path = tmp_path / 'dark.jpg'
+    Image.new('RGB', (320, 240), (8, 8, 15)).save(image_path)
+    payload, annotated_path = offline.analyze(str(image_path), str(tmp_path))
+    table = payload['object_table']
+    assert list(table) == list(offline.COLUMN_DTYPES)
+    assert all(len(values) == 0 for values in table.values())
+    assert os.path.exists(annotated_path)
@@ -0,0 +1,48 @@
+"""Processed image rendering and encoding.
+
+Run with python -m pytest tests
+"""
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+
+import overlay  # noqa: E402
+from pipeline import TARGET_WIDTH, measure_objects  # noqa: E402
+
+
+def plate(width):
+    """Grey image and labels of two wells, scaled to width"""
+    scale = width / TARGET_WIDTH
+    labels = np.zeros((int(600 * scale), width), np.int32)
+    cv2.circle(labels, (int(200 * scale), int(300 * scale)), int(80 * scale), 1, -1)
+    cv2.circle(labels, (int(500 * scale), int(300 * scale)), int(80 * scale), 2, -1)
+    image = np.full(labels.shape + (3,), 40, np.uint8)
+    return image, labels
+
+
+@pytest.mark.parametrize('width', [TARGET_WIDTH, 3 * TARGET_WIDTH])
+def test_outlines_scale_with_the_image(width):
+    image, labels = plate(width)
+    rendered = overlay.render(image, labels, measure_objects(labels, image[..., 0]), TARGET_WIDTH)
+    assert rendered.shape == image.shape
+    outline = np.all(rendered == overlay.CONTOUR_COLOR, axis=-1)
+    # Outlines keep their thickness relative to the image, about 2 pixels of every 800
+    thickness = outline.sum() / (2 * 2 * np.pi * 80 * width / TARGET_WIDTH)
+    assert thickness == pytest.approx(overlay.CONTOUR_THICKNESS * width / TARGET_WIDTH, rel=0.35)
+    # Scaled up outlines lie within a pixel of the working width grid of the objects
+    reach = 2 * (width // TARGET_WIDTH) - 1
+    near = cv2.dilate((labels > 0).astype(np.uint8), np.ones((reach, reach), np.uint8))
+    assert not outline[near == 0].any()
+
+
+@pytest.mark.parametrize('image_format', ['jpeg', 'webp'])
+def test_explicit_quality_zero_is_used(image_format):
+    image = np.random.default_rng(0).integers(0, 255, (120, 160, 3), dtype=np.uint8)
+    lowest = overlay.encode_image(image, image_format, 0)
+    assert len(lowest) < len(overlay.encode_image(image, image_format))
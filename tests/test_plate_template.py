@@ -0,0 +1,115 @@
+"""Plate templates survive a round trip through the store and align moved images to their wells.
+
+Run with python -m pytest tests
+"""
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+
+from plate_template import AlignmentError, PlateTemplate, TemplateStore, analyze_with_template  # noqa: E402
+
+ROWS, COLS = 3, 4
+
+
+def plate_image(seed=0):
+    """BGR plate with numbered corner marks for features and wells of increasing brightness"""
+    rng = np.random.default_rng(seed)
+    image = np.full((480, 640, 3), 12, np.uint8)
+    cv2.rectangle(image, (40, 30), (600, 450), (40, 40, 40), 3)
+    for x, y in rng.integers([50, 40], [590, 440], size=(60, 2)):
+        cv2.rectangle(image, (int(x), int(y)), (int(x) + 6, int(y) + 4), (70, 70, 70), -1)
+    for row in range(ROWS):
+        for col in range(COLS):
+            brightness = 80 + 12 * (row * COLS + col)
+            cv2.circle(image, (110 + 140 * col, 100 + 140 * row), 35, (brightness,) * 3, -1)
+    return image
+
+
+def well_labels(image):
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return cv2.connectedComponents((gray >= 80).astype(np.uint8), connectivity=4, ltype=cv2.CV_32S)[1]
+
+
+def template(name='plate-96'):
+    image = plate_image()
+    return PlateTemplate.from_segmentation(name, image, well_labels(image), meta={'rows': ROWS})
+
+
+def moved(image, angle=3.0, shift=(12, -9)):
+    warp = cv2.getRotationMatrix2D((320, 240), angle, 1.0)
+    warp[:, 2] += shift
+    return cv2.warpAffine(image, warp, (640, 480), borderValue=(12, 12, 12)), warp
+
+
+def test_wells_are_numbered_in_reading_order():
+    layout = template().describe()['layout']
+    assert len(layout) == ROWS * COLS
+    centroids = [well['centroid'] for well in sorted(layout, key=lambda well: well['well'])]
+    assert centroids == sorted(centroids, key=lambda c: (round(c[1] / 140), c[0]))
+
+
+def test_store_round_trip(tmp_path):
+    store = TemplateStore(str(tmp_path))
+    original = template()
+    store.put(original)
+    assert store.names() == ['plate-96']
+    assert [name for name in os.listdir(tmp_path) if name.endswith('.tmp')] == []
+
+    loaded = TemplateStore(str(tmp_path)).get('plate-96')
+    np.testing.assert_array_equal(loaded.labels, original.labels)
+    np.testing.assert_array_equal(loaded.reference, original.reference)
+    assert loaded.meta == original.meta and loaded.key == original.key
+
+
+def test_store_sees_templates_replaced_by_another_process(tmp_path):
+    store, other = TemplateStore(str(tmp_path)), TemplateStore(str(tmp_path))
+    original = template()
+    store.put(original)
+    assert store.get('plate-96').meta['rows'] == ROWS
+
+    other.put(PlateTemplate('plate-96', original.labels, original.reference, {'rows': 8}))
+    path = os.path.join(str(tmp_path), 'plate-96.npz')
+    # A later modification time than the cached one, the file system may only store seconds
+    os.utime(path, (os.path.getmtime(path) + 5,) * 2)
+    assert store.get('plate-96').meta['rows'] == 8
+
+    assert other.delete('plate-96') and not other.delete('plate-96')
+    assert store.get('plate-96') is None and store.names() == []
+
+
+@pytest.mark.parametrize('name', ['', '../plate', 'plate.npz', 'x' * 65])
+def test_store_rejects_invalid_names(tmp_path, name):
+    with pytest.raises(ValueError):
+        TemplateStore(str(tmp_path)).get(name)
+
+
+def test_align_recovers_a_moved_plate():
+    reference = template()
+    image, expected = moved(plate_image())
+    warp, method, correlation = reference.align(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY))
+    assert method.endswith('+ecc') and correlation > 0.9
+    np.testing.assert_allclose(warp[:, :2], expected[:, :2], atol=0.01)
+    np.testing.assert_allclose(warp[:, 2], expected[:, 2], atol=1.5)
+
+
+def test_analyze_with_template_keeps_the_well_numbers():
+    reference = template()
+    (labels, still, _, _), _ = analyze_with_template(plate_image(), reference)
+    (_, table, encoded, _), alignment = analyze_with_template(moved(plate_image())[0], reference)
+    assert labels is reference.labels and alignment['correlation'] > 0.9 and encoded
+    by_well = {row['Object']: row for row in still}
+    assert len(table) == ROWS * COLS
+    for row in table:
+        assert row['Signal'] == pytest.approx(by_well[row['Object']]['Signal'], rel=0.02)
+
+
+def test_unrelated_image_is_rejected():
+    noise = np.random.default_rng(1).integers(0, 255, (480, 640, 3), dtype=np.uint8)
+    with pytest.raises(AlignmentError):
+        analyze_with_template(noise, template())
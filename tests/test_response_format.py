@@ -0,0 +1,85 @@
+"""Compact result formats round-trip the object table and the label mask.
+
+Run with python -m pytest tests
+"""
+import json
+import os
+import sys
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+
+import response_format  # noqa: E402
+
+
+def plate_labels():
+    labels = np.zeros((60, 80), np.int32)
+    labels[5:15, 10:30] = 1
+    labels[20:40, 40:50] = 2
+    labels[50:, :] = 3
+    return labels
+
+
+@pytest.mark.parametrize('labels', [
+    plate_labels(),
+    np.zeros((0, 0), np.int32),
+    np.zeros((4, 7), np.int32),
+    np.full((3, 5), 7, np.uint8),
+    np.array([[0, 70000, 70000], [1, 1, 65536]], np.int64),
+])
+def test_rle_round_trip(labels):
+    rle = response_format.rle_encode(labels)
+    assert rle['shape'] == list(labels.shape)
+    decoded = response_format.rle_decode(rle)
+    assert decoded.shape == labels.shape
+    np.testing.assert_array_equal(decoded, labels)
+
+
+def test_rle_uses_the_smallest_types():
+    rle = response_format.rle_encode(plate_labels())
+    assert rle['values'].dtype == np.uint8
+    assert len(rle['values']) == len(rle['lengths']) and rle['lengths'].sum() == 60 * 80
+
+    rle = response_format.rle_encode(np.array([[0, 70000]]))
+    assert rle['values'].dtype == np.uint32
+
+
+def test_empty_mask_encodes_to_no_runs():
+    rle = response_format.rle_encode(np.zeros((0, 5), np.int32))
+    assert len(rle['values']) == 0 and len(rle['lengths']) == 0
+    assert response_format.rle_decode(rle).shape == (0, 5)
+
+
+def compact_payload():
+    records = [{'Object': 1, 'Area': 200, 'Signal': 1000.0, 'Signal/Unit_Area': 5.0},
+               {'Object': 2, 'Area': 200, 'Signal': 1500.0, 'Signal/Unit_Area': 7.5}]
+    return response_format.compact({'object_table': records, 'wells': 2}, plate_labels())
+
+
+def test_msgpack_round_trip():
+    pytest.importorskip('msgpack')
+    payload = compact_payload()
+    decoded = response_format.decode_msgpack(response_format.encode_msgpack(payload))
+    assert decoded['wells'] == 2
+    for column, values in payload['object_table'].items():
+        np.testing.assert_array_equal(decoded['object_table'][column], values)
+        assert decoded['object_table'][column].dtype == values.dtype
+    np.testing.assert_array_equal(response_format.rle_decode(decoded['labels']), plate_labels())
+
+
+def test_arrow_round_trip():
+    pa = pytest.importorskip('pyarrow')
+    payload = compact_payload()
+    table = pa.ipc.open_stream(response_format.encode_arrow(payload)).read_all()
+    assert table.column_names == list(payload['object_table'])
+    np.testing.assert_array_equal(table.column('Signal').to_numpy(), payload['object_table']['Signal'])
+    metadata = table.schema.metadata
+    assert json.loads(metadata[b'result']) == {'wells': 2}
+    dtypes = json.loads(metadata[b'labels'])
+    labels = {'shape': dtypes['shape'],
+              'values': np.frombuffer(metadata[b'labels.values'], dtype=dtypes['values']),
+              'lengths': np.frombuffer(metadata[b'labels.lengths'], dtype=dtypes['lengths'])}
+    np.testing.assert_array_equal(response_format.rle_decode(labels), plate_labels())
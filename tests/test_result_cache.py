@@ -0,0 +1,70 @@
+"""Disk tier of the result cache: concurrent writers, quota and read-back.
+
+Run with python -m pytest tests
+"""
+import os
+import sys
+import threading
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+
+from result_cache import ResultCache  # noqa: E402
+
+
+def store(cache, key, seed=0, size=64):
+    # Random labels do not compress, so every entry takes about the same room on disk
+    labels = np.random.default_rng(seed).integers(0, 2 ** 16, (size, size)).astype(np.int32)
+    return cache.put(key, labels, [{'Object': 1}], b'image', b'preview')
+
+
+def test_concurrent_writers_of_one_key(tmp_path):
+    cache = ResultCache(disk_folder=str(tmp_path))
+    errors = []
+
+    def write(seed):
+        try:
+            for _ in range(10):
+                store(cache, 'same', seed)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=write, args=(seed,)) for seed in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert os.listdir(tmp_path) == ['same.npz']
+
+
+def test_disk_entry_survives_a_restart(tmp_path):
+    entry = store(ResultCache(disk_folder=str(tmp_path)), 'key')
+    restarted = ResultCache(disk_folder=str(tmp_path))
+    cached = restarted.get('key')
+    np.testing.assert_array_equal(cached['labels'], entry['labels'])
+    assert cached['object_table'] == entry['object_table']
+    assert (cached['processed_image'], cached['preview']) == (b'image', b'preview')
+    assert restarted.stats()['disk_hits'] == 1
+
+
+def test_disk_quota_evicts_oldest_and_scans_only_when_over(tmp_path, monkeypatch):
+    cache = ResultCache(disk_folder=str(tmp_path))
+    store(cache, 'probe')
+    entry_bytes = cache.disk_bytes
+    os.remove(tmp_path / 'probe.npz')
+
+    cache = ResultCache(disk_folder=str(tmp_path), max_disk_bytes=int(3.5 * entry_bytes))
+    scans = []
+    evict_disk = cache._evict_disk
+    monkeypatch.setattr(cache, '_evict_disk', lambda: scans.append(1) or evict_disk())
+    for index in range(5):
+        store(cache, f'key{index}', seed=index)
+        os.utime(tmp_path / f'key{index}.npz', (index, index))
+
+    # The first write counts the folder, then only writes over quota scan it
+    assert len(scans) == 3
+    assert sorted(os.listdir(tmp_path)) == ['key2.npz', 'key3.npz', 'key4.npz']
+    assert cache.disk_bytes == sum(os.path.getsize(tmp_path / name) for name in os.listdir(tmp_path))
@@ -0,0 +1,28 @@
+"""Importing the app stays within the cold start budget and leaves the heavy libraries unloaded.
+
+Run with python -m pytest tests
+"""
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from startup_profile import FLASK_DIR, IMPORT_BUDGET, profile_imports  # noqa: E402
+
+# Imported on demand, when a model loads or a table is built
+LAZY_MODULES = ['tensorflow', 'pandas', 'scipy', 'csbdeep', 'stardist', 'networkx']
+
+
+def test_import_app_within_budget():
+    wall, packages = profile_imports()
+    assert 'flask' in packages and 'model_registry' in packages
+    assert wall < IMPORT_BUDGET, f'import app took {wall:.3f} s, budget {IMPORT_BUDGET:.3f} s'
+
+
+def test_import_app_leaves_heavy_libraries_unloaded():
+    code = f'import sys, app; print(" ".join(m for m in {LAZY_MODULES!r} if m in sys.modules))'
+    result = subprocess.run([sys.executable, '-c', code], cwd=FLASK_DIR, capture_output=True, text=True,
+                            check=True)
+    assert result.stdout.strip() == ''
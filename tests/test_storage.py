@@ -0,0 +1,84 @@
+"""The upload store deduplicates files and keeps its folder within the age and size quota.
+
+Run with python -m pytest tests
+"""
+import os
+import sys
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+
+from storage import TMP_MAX_AGE, FileStore  # noqa: E402
+
+NOW = 1_000_000_000
+
+
+def put_aged(store, data, age):
+    name = store.put(data, '.jpg')
+    os.utime(store.path(name), (NOW - age, NOW - age))
+    return name
+
+
+def test_put_deduplicates_by_content(tmp_path):
+    store = FileStore(str(tmp_path))
+    first = store.put(b'plate', '.jpg')
+    assert store.put(b'plate', '.jpg') == first
+    assert store.put(b'other', '.jpg') != first
+    assert store.counters['writes'] == 2 and store.counters['deduplicated'] == 1
+    assert sorted(os.listdir(tmp_path)) == sorted([first, store.content_name(b'other', '.jpg')])
+
+
+def test_path_rejects_names_the_store_does_not_hand_out(tmp_path):
+    store = FileStore(str(tmp_path))
+    assert store.path('../app.py') is None
+    assert store.path('0' * 64 + '.jpg') is None
+    with pytest.raises(ValueError):
+        store.path('../app.py', must_exist=False)
+
+
+def test_evict_removes_expired_files(tmp_path):
+    store = FileStore(str(tmp_path), max_age=100)
+    fresh = put_aged(store, b'fresh', 10)
+    put_aged(store, b'stale', 200)
+    assert store.evict(NOW) == 1
+    assert os.listdir(tmp_path) == [fresh]
+    assert store.stats()['bytes'] == len(b'fresh')
+
+
+def test_evict_removes_the_oldest_files_over_quota(tmp_path):
+    store = FileStore(str(tmp_path), max_bytes=250)
+    names = [put_aged(store, bytes([i]) * 100, age) for i, age in enumerate([30, 20, 10])]
+    assert store.evict(NOW) == 1
+    assert sorted(os.listdir(tmp_path)) == sorted(names[1:])
+    assert store.counters['evicted_bytes'] == 100 and store.stats()['bytes'] == 200
+
+
+def test_evict_keeps_temporary_files_until_they_are_abandoned(tmp_path):
+    store = FileStore(str(tmp_path), max_bytes=0, max_age=10)
+    writing = tmp_path / ('a' * 64 + '.jpg.0123.tmp')
+    abandoned = tmp_path / ('b' * 64 + '.jpg.4567.tmp')
+    for path, age in [(writing, TMP_MAX_AGE - 60), (abandoned, TMP_MAX_AGE + 60)]:
+        path.write_bytes(b'partial')
+        os.utime(path, (NOW - age, NOW - age))
+
+    assert store.evict(NOW) == 1
+    assert os.listdir(tmp_path) == [writing.name]
+
+
+def test_writes_over_quota_wake_the_evictor(tmp_path):
+    store = FileStore(str(tmp_path), max_bytes=150, evict_interval=3600)
+    store.start()
+    try:
+        for i in range(3):
+            store.put(bytes([i]) * 100, '.jpg')
+            time.sleep(0.05)
+        deadline = time.time() + 5
+        while store.stats()['bytes'] is None or store.stats()['bytes'] > 150:
+            assert time.time() < deadline
+            time.sleep(0.01)
+    finally:
+        store.stop()
+    assert len(os.listdir(tmp_path)) == 1
@@ -0,0 +1,48 @@
+"""/process_stream removes the spooled video however the stream ends.
+
+Run with python -m pytest tests
+"""
+import io
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+
+
+@pytest.fixture(scope='module')
+def app():
+    import app
+    # These requests fail before a model is needed, nothing has to be loaded
+    app._started = True
+    return app
+
+
+def spooled(app):
+    return set(os.listdir(app.temp_folder))
+
+
+def video_upload():
+    return {'data': {'video': (io.BytesIO(b'not a video'), 'plate.mp4')}, 'content_type': 'multipart/form-data'}
+
+
+def test_video_is_removed_after_the_stream(app):
+    before = spooled(app)
+    response = app.app.test_client().post('/process_stream', **video_upload())
+    records = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+    assert records == [{'type': 'error', 'message': 'The video could not be decoded.'}]
+    response.close()
+    assert spooled(app) == before
+
+
+def test_video_is_removed_when_the_client_leaves_before_the_stream_starts(app):
+    before = spooled(app)
+    # The test client always reads the first record, so call the view and close its response unread
+    with app.app.test_request_context('/process_stream', method='POST', **video_upload()):
+        response = app.process_stream()
+    assert len(spooled(app) - before) == 1
+    response.close()
+    assert spooled(app) == before
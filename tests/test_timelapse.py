@@ -0,0 +1,102 @@
+"""Time series wells keep their ids when the plate moves and is segmented again.
+
+The tracker is given a threshold segmentation in place of the model, so
+StarDist is not needed. Run with python -m pytest tests
+"""
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'flask'))
+
+pytest.importorskip('csbdeep')
+from timelapse import TimelapseTracker, match_wells  # noqa: E402
+
+# Centre (x, y) and brightness of the wells of a 2 x 3 plate
+WELLS = [((100 + 150 * col, 120 + 200 * row), 50 + 12 * (3 * row + col)) for row in range(2) for col in range(3)]
+
+
+def frame(shift=(0, 0), wells=WELLS):
+    """BGR frame of the plate moved by shift (dx, dy) pixels"""
+    image = np.full((480, 640, 3), 10, np.uint8)
+    for (x, y), brightness in wells:
+        cv2.circle(image, (x + shift[0], y + shift[1]), 30, (brightness,) * 3, -1)
+    return image
+
+
+class Segmenter:
+    """Threshold segmentation that numbers the wells in a different order every call, like a new model run"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, normalized, **kwargs):
+        count, labels = cv2.connectedComponents((normalized > 0.25).astype(np.uint8), connectivity=4)
+        self.calls += 1
+        # Rotate the label numbers so no segmentation agrees with the previous one
+        order = np.roll(np.arange(1, count), self.calls)
+        relabel = np.zeros(count, np.int32)
+        relabel[order] = np.arange(1, count)
+        return relabel[labels]
+
+
+def records(tracker, frames):
+    result = list(tracker.process((float(index), image) for index, image in enumerate(frames)))
+    return [r for r in result if r['type'] == 'layout'], [r for r in result if r['type'] == 'frame']
+
+
+def signal_by_well(record):
+    return dict(zip(record['wells'], record['signal']))
+
+
+def test_match_wells_follows_moved_and_reordered_wells():
+    previous = np.array([[10.0, 10.0], [10.0, 50.0], [50.0, 10.0]])
+    current = previous[[2, 0, 1]] + [1.5, -2.0]
+    np.testing.assert_array_equal(match_wells(previous, current, 5), [2, 0, 1])
+
+
+def test_match_wells_leaves_distant_wells_unmatched():
+    previous = np.array([[10.0, 10.0], [10.0, 50.0]])
+    current = np.array([[11.0, 49.0], [80.0, 80.0]])
+    np.testing.assert_array_equal(match_wells(previous, current, 5), [1, -1])
+    np.testing.assert_array_equal(match_wells(np.empty((0, 2)), current, 5), [-1, -1])
+    assert len(match_wells(previous, np.empty((0, 2)), 5)) == 0
+
+
+def test_ids_persist_across_resegmentation():
+    frames = [frame(), frame((3, -2)), frame((-2, 4))]
+    layouts, signals = records(TimelapseTracker(Segmenter(), segment_every=1), frames)
+    assert [layout['reason'] for layout in layouts] == ['first', 'interval', 'interval']
+
+    first = {well['well']: well['centroid'] for well in layouts[0]['wells']}
+    assert sorted(first) == list(range(1, len(WELLS) + 1))
+    for layout, (dx, dy) in zip(layouts[1:], [(3, -2), (-2, 4)]):
+        for well in layout['wells']:
+            x, y = first[well['well']]
+            np.testing.assert_allclose(well['centroid'], [x + dx, y + dy], atol=0.5)
+
+    # Every well has a brightness of its own, so its signal shows which physical well an id points to
+    for record in signals[1:]:
+        assert signal_by_well(record) == pytest.approx(signal_by_well(signals[0]), rel=1e-6)
+
+
+def test_ids_persist_across_a_drift_larger_than_the_wells():
+    segment = Segmenter()
+    tracker = TimelapseTracker(segment)
+    layouts, signals = records(tracker, [frame(), frame((1, 1)), frame((45, 30))])
+    assert [layout['reason'] for layout in layouts] == ['first', 'drift']
+    assert segment.calls == 2 and signals[1]['drift'] < tracker.drift_threshold
+    assert signal_by_well(signals[2]) == pytest.approx(signal_by_well(signals[0]), rel=1e-6)
+
+
+def test_new_wells_get_the_next_free_id():
+    extra = WELLS + [((560, 400), 110)]
+    layouts, signals = records(TimelapseTracker(Segmenter(), segment_every=1), [frame(), frame(wells=extra)])
+    assert signals[1]['wells'] == list(range(1, len(WELLS) + 2))
+    assert {well['well']: well['centroid'] for well in layouts[1]['wells']}[len(WELLS) + 1] == [560, 400]
+    before, after = signal_by_well(signals[0]), signal_by_well(signals[1])
+    assert {well: after[well] for well in before} == pytest.approx(before, rel=1e-6)